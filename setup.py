@@ -101,6 +101,7 @@ setup(
     package_dir={"": "src/python"},
     ext_modules=[CMakeExtension("argolid/libargolid")],
     test_suite="tests",
+    entry_points={"console_scripts": ["argolid-dedup=argolid.dedup:main"]},
     install_requires=["pydantic", "filepattern", "tensorstore", "bfio"],
     zip_safe=False,
     python_requires=">=3.8",
@@ -15,6 +15,8 @@
 #include <chrono>
 #include <future>
 #include <cmath>
+#include <algorithm>
+#include <optional>
 
 #include "tensorstore/tensorstore.h"
 #include "tensorstore/context.h"
@@ -22,6 +24,7 @@
 #include "tensorstore/driver/zarr/dtype.h"
 #include "tensorstore/index_space/dim_expression.h"
 #include "tensorstore/kvstore/kvstore.h"
+#include "tensorstore/kvstore/operations.h"
 #include "tensorstore/open.h"
 
 #include <nlohmann/json.hpp>
@@ -43,7 +46,6 @@ void ChunkedBaseToPyramid::CreatePyramidImages( const std::string& input_chunked
                                                 const std::unordered_map<std::int64_t, DSType>& channel_ds_config,
                                                 BS::thread_pool<BS::tp::none>& th_pool)
 {
-    int resolution = 1; // this gets doubled in each level up
     auto input_spec = [v, &input_chunked_dir, &base_level_key](){
       if (v == VisType::NG_Zarr | v == VisType::Viv){
         return GetZarrSpecToRead(input_chunked_dir+"/"+std::to_string(base_level_key));
@@ -78,50 +80,66 @@ void ChunkedBaseToPyramid::CreatePyramidImages( const std::string& input_chunked
     auto min_level = static_cast<int>(ceil(log2(min_dim)));
     auto max_key = max_level-min_level+1+base_level_key;
 
+    switch(data_type){
+      case 1:
+        CreatePyramidLevels<uint8_t>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      case 2:
+        CreatePyramidLevels<uint16_t>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      case 4:
+        CreatePyramidLevels<uint32_t>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      case 8:
+        CreatePyramidLevels<uint64_t>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      case 16:
+        CreatePyramidLevels<int8_t>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      case 32:
+        CreatePyramidLevels<int16_t>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      case 64:
+        CreatePyramidLevels<int32_t>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      case 128:
+        CreatePyramidLevels<int64_t>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      case 256:
+        CreatePyramidLevels<float>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      case 512:
+        CreatePyramidLevels<double>(input_chunked_dir, output_root_dir, base_level_key, max_key, v, channel_ds_config, th_pool);
+        break;
+      default:
+        break;
+    }
+}
+
+template <typename T>
+void ChunkedBaseToPyramid::CreatePyramidLevels( const std::string& input_chunked_dir,
+                                                const std::string& output_root_dir, 
+                                                int base_level_key,
+                                                int max_key,
+                                                VisType v, 
+                                                const std::unordered_map<std::int64_t, DSType>& channel_ds_config,
+                                                BS::thread_pool<BS::tp::none>& th_pool)
+{
+    int resolution = 1; // this gets doubled in each level up
+    std::optional<UniformChunkMap<T>> uniform_chunks; // nothing is known about the base level
     for (int i=base_level_key; i<max_key; ++i){
         resolution *= 2;
-        switch(data_type){
-          case 1:
-            WriteDownsampledImage<uint8_t>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          case 2:
-            WriteDownsampledImage<uint16_t>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          case 4:
-            WriteDownsampledImage<uint32_t>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          case 8:
-            WriteDownsampledImage<uint64_t>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          case 16:
-            WriteDownsampledImage<int8_t>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          case 32:
-            WriteDownsampledImage<int16_t>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          case 64:
-            WriteDownsampledImage<int32_t>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          case 128:
-            WriteDownsampledImage<int64_t>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          case 256:
-            WriteDownsampledImage<float>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          case 512:
-            WriteDownsampledImage<double>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), resolution, v, channel_ds_config, th_pool);
-            break;
-          default:
-            break;
-          }
+        uniform_chunks = WriteDownsampledImage<T>(input_chunked_dir, std::to_string(i), output_root_dir, std::to_string(i+1), 
+                                                  resolution, v, channel_ds_config, uniform_chunks, th_pool);
     } 
 }
 
 template <typename T>
-void ChunkedBaseToPyramid::WriteDownsampledImage(   const std::string& input_file, const std::string& input_scale_key, 
+UniformChunkMap<T> ChunkedBaseToPyramid::WriteDownsampledImage(   const std::string& input_file, const std::string& input_scale_key, 
                                                     const std::string& output_file, const std::string& output_scale_key,
                                                     int resolution, VisType v, 
                                                     const std::unordered_map<std::int64_t, DSType>& channel_ds_config,
+                                                    const std::optional<UniformChunkMap<T>>& prev_uniform_chunks,
                                                     BS::thread_pool<BS::tp::none>& th_pool)
 {
     auto [x_dim, y_dim, c_dim, num_dims] = GetZarrParams(v);
@@ -160,9 +178,13 @@ void ChunkedBaseToPyramid::WriteDownsampledImage(   const std::string& input_fil
     auto num_rows = static_cast<std::int64_t>(ceil(1.0*cur_y_max/chunk_shape[y_dim]));
     auto num_cols = static_cast<std::int64_t>(ceil(1.0*cur_x_max/chunk_shape[x_dim]));
 
+    // channels that share a chunk are processed by a single task, so that each chunk is written once
+    std::int64_t channel_chunk_size = num_channels; // precomputed chunks hold all the channels
     auto open_mode = tensorstore::OpenMode::create;
     if (v == VisType::NG_Zarr | v == VisType::Viv){
         new_image_shape[c_dim] = prev_image_shape[c_dim];
+        channel_chunk_size = std::clamp(static_cast<std::int64_t>(chunk_layout.read_chunk_shape()[c_dim]), std::int64_t{1}, num_channels);
+        chunk_shape[c_dim] = channel_chunk_size;
         open_mode = open_mode | tensorstore::OpenMode::delete_existing;
     }
 
@@ -180,24 +202,39 @@ void ChunkedBaseToPyramid::WriteDownsampledImage(   const std::string& input_fil
                             output_spec,
                             open_mode,
                             tensorstore::ReadWriteMode::write).result());
+    // a precomputed scale is added to the existing dataset, since deleting it would delete every
+    // scale, so it may hold the chunks of an earlier run
+    auto output_kvstore = store2.kvstore();
 
-    std::unique_ptr<std::vector<T>> (*downsampling_func_ptr)(std::vector<T>&, std::int64_t, std::int64_t);   
-    downsampling_func_ptr = &DownsampleAverage; // default
+    using DownsampleFunc = std::unique_ptr<std::vector<T>> (*)(std::vector<T>&, std::int64_t, std::int64_t);
+    std::vector<DownsampleFunc> downsampling_funcs(num_channels, &DownsampleAverage<T>); // default
     for(std::int64_t c=0; c<num_channels; ++c){
         auto it = channel_ds_config.find(c);
         if (it != channel_ds_config.end()){
             
             if (it->second == DSType::Mode_Max){
-                downsampling_func_ptr = &DownsampleModeMax;
+                downsampling_funcs[c] = &DownsampleModeMax;
                 PLOG_DEBUG<< "Channel ID " << it->first <<" Downsampling method Mode Max";
             } else if (it->second == DSType::Mode_Min){
-                downsampling_func_ptr = &DownsampleModeMin;
+                downsampling_funcs[c] = &DownsampleModeMin;
                 PLOG_DEBUG<< "Channel ID " << it->first <<" Downsampling method Mode Min";
             } else if (it->second == DSType::Mean){
                 PLOG_DEBUG<< "Channel ID " << it->first <<" Downsampling method Mean";
-                downsampling_func_ptr = &DownsampleAverage;
+                downsampling_funcs[c] = &DownsampleAverage;
             } 
         }
+    }
+
+    auto num_channel_blocks = static_cast<std::int64_t>(ceil(1.0*num_channels/channel_chunk_size));
+    UniformChunkMap<T> uniform_chunks;
+    uniform_chunks.num_rows = num_rows;
+    uniform_chunks.num_cols = num_cols;
+    uniform_chunks.is_uniform.resize(num_channel_blocks*num_rows*num_cols, 0);
+    uniform_chunks.values.resize(num_channel_blocks*num_rows*num_cols);
+
+    for(std::int64_t c_start=0; c_start<num_channels; c_start+=channel_chunk_size){
+        auto c_size = std::min({channel_chunk_size, num_channels-c_start});
+        auto c_block = c_start/channel_chunk_size;
         for(std::int64_t i=0; i<num_rows; ++i){
             auto y_start = i*chunk_shape[y_dim];
             auto y_end = std::min({(i+1)*chunk_shape[y_dim], cur_y_max});
@@ -209,40 +246,82 @@ void ChunkedBaseToPyramid::WriteDownsampledImage(   const std::string& input_fil
                 auto x_end = std::min({(j+1)*chunk_shape[x_dim], cur_x_max});
                 auto prev_x_start = 2*x_start;
                 auto prev_x_end = std::min({2*x_end, prev_x_max});
-                th_pool.detach_task([ &store1, &store2, 
+                th_pool.detach_task([ &store1, &store2, &output_kvstore, &output_scale_key, &downsampling_funcs, &prev_uniform_chunks, &uniform_chunks,
                                     prev_x_start, prev_x_end, prev_y_start, prev_y_end, 
-                                    x_start, x_end, y_start, y_end, 
-                                    x_dim=x_dim, y_dim=y_dim, c_dim=c_dim, c, v, downsampling_func_ptr](){  
-                    std::vector<T> read_buffer((prev_x_end-prev_x_start)*(prev_y_end-prev_y_start));
-                    auto array = tensorstore::Array(read_buffer.data(), {prev_y_end-prev_y_start, prev_x_end-prev_x_start}, tensorstore::c_order);
-
-                    tensorstore::IndexTransform<> input_transform = tensorstore::IdentityTransform(store1.domain());
-                    
-                    if(v == VisType::PCNG){
-                      input_transform = (std::move(input_transform) | tensorstore::Dims(2, 3).IndexSlice({0,c})).value();
-                    } else 
-                    if (v == VisType::Viv || v == VisType::NG_Zarr){
-                      input_transform = (std::move(input_transform) | tensorstore::Dims(c_dim).SizedInterval(c,1)).value();
-                    } 
-
-                    input_transform = (std::move(input_transform) | tensorstore::Dims(y_dim).ClosedInterval(prev_y_start, prev_y_end-1) 
-                                                        | tensorstore::Dims(x_dim).ClosedInterval(prev_x_start, prev_x_end-1)).value(); 
-
-                    tensorstore::Read(store1 | input_transform, tensorstore::UnownedToShared(array)).value();
-
-                    auto result = downsampling_func_ptr(read_buffer, (prev_y_end-prev_y_start), (prev_x_end-prev_x_start));
-                    auto result_array = tensorstore::Array(result->data(), {y_end-y_start, x_end-x_start}, tensorstore::c_order);
-
-
-                    tensorstore::IndexTransform<> output_transform = tensorstore::IdentityTransform(store2.domain());
-                    if(v == VisType::PCNG){
-                      output_transform = (std::move(output_transform) | tensorstore::Dims(2, 3).IndexSlice({0,c})).value();
-                    } else
-                    if (v == VisType::Viv || v == VisType::NG_Zarr){
-                      output_transform = (std::move(output_transform) | tensorstore::Dims(c_dim).SizedInterval(c,1)).value();
-                    } 
-                    output_transform = (std::move(output_transform) | tensorstore::Dims(y_dim).ClosedInterval(y_start, y_end-1) 
-                                                                    | tensorstore::Dims(x_dim).ClosedInterval(x_start, x_end-1)).value(); 
+                                    x_start, x_end, y_start, y_end, c_start, c_size, c_block, i, j, v](){  
+                    auto prev_plane_size = (prev_x_end-prev_x_start)*(prev_y_end-prev_y_start);
+                    auto plane_size = (x_end-x_start)*(y_end-y_start);
+
+                    // a chunk whose children are all uniform with the same value is uniform too,
+                    // so it can be generated without reading the previous level
+                    bool is_uniform = false;
+                    T uniform_value{};
+                    if (prev_uniform_chunks.has_value()){
+                        const auto& prev = prev_uniform_chunks.value();
+                        is_uniform = true;
+                        bool first_child = true;
+                        for(auto prev_i: {2*i, 2*i+1}){
+                            for(auto prev_j: {2*j, 2*j+1}){
+                                if (prev_i >= prev.num_rows || prev_j >= prev.num_cols) continue;
+                                auto prev_index = (c_block*prev.num_rows + prev_i)*prev.num_cols + prev_j;
+                                if (!prev.is_uniform[prev_index] || (!first_child && prev.values[prev_index] != uniform_value)){
+                                    is_uniform = false;
+                                }
+                                uniform_value = prev.values[prev_index];
+                                first_child = false;
+                            }
+                        }
+                    }
+
+                    std::vector<T> result_buffer;
+                    if (!is_uniform){
+                        std::vector<T> read_buffer(c_size*prev_plane_size);
+                        auto array = tensorstore::Array(read_buffer.data(), {c_size, prev_y_end-prev_y_start, prev_x_end-prev_x_start}, tensorstore::c_order);
+
+                        auto input_transform = GetChannelBlockTransform(tensorstore::IdentityTransform(store1.domain()), v,
+                                                                        c_start, c_size,
+                                                                        prev_y_start, prev_y_end-prev_y_start,
+                                                                        prev_x_start, prev_x_end-prev_x_start);
+
+                        tensorstore::Read(store1 | input_transform, tensorstore::UnownedToShared(array)).value();
+
+                        uniform_value = read_buffer[0];
+                        is_uniform = std::all_of(read_buffer.begin(), read_buffer.end(), [uniform_value](T x){return x == uniform_value;});
+                        if (!is_uniform){
+                            result_buffer.resize(c_size*plane_size);
+                            for(std::int64_t k=0; k<c_size; ++k){
+                                std::vector<T> channel_buffer(read_buffer.begin()+k*prev_plane_size, read_buffer.begin()+(k+1)*prev_plane_size);
+                                auto result = downsampling_funcs[c_start+k](channel_buffer, (prev_y_end-prev_y_start), (prev_x_end-prev_x_start));
+                                std::copy(result->begin(), result->end(), result_buffer.begin()+k*plane_size);
+                            }
+                        }
+                    }
+                    auto chunk_index = (c_block*uniform_chunks.num_rows + i)*uniform_chunks.num_cols + j;
+                    uniform_chunks.is_uniform[chunk_index] = is_uniform;
+                    uniform_chunks.values[chunk_index] = uniform_value;
+
+                    // chunks equal to the fill value are not written, readers get the fill value for
+                    // them. Zarr levels are created empty, the chunk of an earlier run is removed from
+                    // a precomputed scale.
+                    auto skip_chunk = [&](){
+                        if (v == VisType::PCNG){
+                            auto chunk_key = output_scale_key + "/" + std::to_string(x_start) + "-" + std::to_string(x_end) +
+                                             "_" + std::to_string(y_start) + "-" + std::to_string(y_end) + "_0-1";
+                            tensorstore::kvstore::Delete(output_kvstore, chunk_key).result().value();
+                        }
+                    };
+                    if (is_uniform){
+                        if (uniform_value == T{}) return skip_chunk();
+                        result_buffer.assign(c_size*plane_size, uniform_value);
+                    } else if (std::all_of(result_buffer.begin(), result_buffer.end(), [](T x){return x == T{};})){
+                        return skip_chunk();
+                    }
+                    auto result_array = tensorstore::Array(result_buffer.data(), {c_size, y_end-y_start, x_end-x_start}, tensorstore::c_order);
+
+                    auto output_transform = GetChannelBlockTransform(tensorstore::IdentityTransform(store2.domain()), v,
+                                                                     c_start, c_size,
+                                                                     y_start, y_end-y_start,
+                                                                     x_start, x_end-x_start);
 
                     tensorstore::Write(tensorstore::UnownedToShared(result_array), store2 | output_transform).value();  
                 }); 
@@ -251,5 +330,6 @@ void ChunkedBaseToPyramid::WriteDownsampledImage(   const std::string& input_fil
        
     }
     th_pool.wait();
+    return uniform_chunks;
 }
 } // ns argolid
\ No newline at end of file
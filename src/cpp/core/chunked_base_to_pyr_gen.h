@@ -1,9 +1,20 @@
 #pragma once
 #include <string>
 #include <unordered_map>
+#include <vector>
+#include <optional>
 #include "BS_thread_pool.hpp"
 #include "../utilities/utilities.h"
 namespace argolid{
+// Tracks which chunks of a level hold a single value, indexed by (channel block, row, col).
+// Uniform chunks at one level let the next level skip reading them.
+template<typename T>
+struct UniformChunkMap{
+    std::int64_t num_rows{0}, num_cols{0};
+    std::vector<std::uint8_t> is_uniform;
+    std::vector<T> values;
+};
+
 class ChunkedBaseToPyramid{
 public:
     ChunkedBaseToPyramid() = default;
@@ -17,10 +28,20 @@ public:
 
 private:
     template<typename T>
-    void WriteDownsampledImage( const std::string& input_file, const std::string& input_scale_key, 
+    void CreatePyramidLevels(   const std::string& input_chunked_dir,
+                                const std::string& output_root_dir, 
+                                int base_level_key,
+                                int max_key, 
+                                VisType v, 
+                                const std::unordered_map<std::int64_t, DSType>& channel_ds_config,
+                                BS::thread_pool<BS::tp::none>& th_pool);
+
+    template<typename T>
+    UniformChunkMap<T> WriteDownsampledImage( const std::string& input_file, const std::string& input_scale_key, 
                                 const std::string& output_file, const std::string& output_scale_key,
                                 int resolution, VisType v,
                                 const std::unordered_map<std::int64_t, DSType>& channel_ds_config, 
+                                const std::optional<UniformChunkMap<T>>& prev_uniform_chunks,
                                 BS::thread_pool<BS::tp::none>& th_pool);
 };
 } // ns argolid
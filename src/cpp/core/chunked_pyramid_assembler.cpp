@@ -9,7 +9,10 @@
 #include <iostream>
 #include <regex>
 #include <vector>
+#include <array>
 #include <list>
+#include <map>
+#include <algorithm>
 #include <cstring>
 #include <unordered_set>
 #include <string>
@@ -31,6 +34,7 @@
 #include "tensorstore/index_space/dim_expression.h"
 #include "tensorstore/kvstore/kvstore.h"
 #include "tensorstore/open.h"
+#include "tensorstore/transaction.h"
 
 #include "filepattern/filepattern.h"
 
@@ -61,6 +65,7 @@ ImageInfo OmeTiffCollToChunked::Assemble(const std::string& input_dir,
                                     const std::string& output_file, 
                                     const std::string& scale_key, 
                                     VisType v, 
+                                    std::int64_t channel_chunk_size,
                                     BS::thread_pool<BS::tp::none>& th_pool)
 {
   int grid_x_max = 0, grid_y_max = 0, grid_c_max = 0;
@@ -116,6 +121,10 @@ ImageInfo OmeTiffCollToChunked::Assemble(const std::string& input_dir,
     whole_image._data_type = test_source.dtype().name();
     if (v == VisType::NG_Zarr || v == VisType::Viv){
       new_image_shape[c_dim] = whole_image._num_channels;
+      channel_chunk_size = std::clamp(channel_chunk_size, std::int64_t{1}, whole_image._num_channels);
+      chunk_shape[c_dim] = channel_chunk_size;
+    } else {
+      channel_chunk_size = whole_image._num_channels; // precomputed chunks hold all the channels
     }
 
     auto output_spec = [&](){
@@ -134,44 +143,93 @@ ImageInfo OmeTiffCollToChunked::Assemble(const std::string& input_dir,
                                 tensorstore::ReadWriteMode::write).result());
     
     auto t4 = std::chrono::high_resolution_clock::now();
-    for(const auto& i: image_vec){        
-      th_pool.detach_task([&dest, i, x_dim=x_dim, y_dim=y_dim, c_dim=c_dim, v, &whole_image, grid_c_min, grid_x_min, grid_y_min]() {
-
-
-        TENSORSTORE_CHECK_OK_AND_ASSIGN(auto source, tensorstore::Open(
-                                    GetOmeTiffSpecToRead(i.file_name),
-                                    tensorstore::OpenMode::open,
-                                    tensorstore::ReadWriteMode::read).result());
-        PLOG_INFO << "Opening "<< i.file_name;
-        auto image_shape = source.domain().shape();
-        auto image_width = image_shape[4];
-        auto image_height = image_shape[3];
-        auto array = tensorstore::AllocateArray({image_height, image_width},tensorstore::c_order,
-                                                          tensorstore::value_init, source.dtype());
-
-        // initiate a read
-        tensorstore::Read(source | 
-              tensorstore::Dims(3).ClosedInterval(0, image_height-1) |
-              tensorstore::Dims(4).ClosedInterval(0, image_width-1) ,
-              array).value();
-
-        tensorstore::IndexTransform<> transform = tensorstore::IdentityTransform(dest.domain());
-        if(v == VisType::PCNG){
-          transform = (std::move(transform) | tensorstore::Dims("z", "channel").IndexSlice({0, i._c_grid-grid_c_min}) 
-                                            | tensorstore::Dims(y_dim).SizedInterval((i._y_grid-grid_y_min)*whole_image._chunk_size_y, image_height) 
-                                            | tensorstore::Dims(x_dim).SizedInterval((i._x_grid-grid_x_min)*whole_image._chunk_size_x, image_width)
-                                            | tensorstore::Dims(x_dim, y_dim).Transpose({y_dim, x_dim})).value();
-
-        } else if (v == VisType::NG_Zarr){
-          transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(i._c_grid-grid_c_min, 1) 
-                                            | tensorstore::Dims(y_dim).SizedInterval((i._y_grid-grid_y_min)*whole_image._chunk_size_y, image_height) 
-                                            | tensorstore::Dims(x_dim).SizedInterval((i._x_grid-grid_x_min)*whole_image._chunk_size_x, image_width)).value();
-        } else if (v == VisType::Viv){
-          transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(i._c_grid-grid_c_min, 1) 
-                                            | tensorstore::Dims(y_dim).SizedInterval((i._y_grid-grid_y_min)*whole_image._chunk_size_y, image_height) 
-                                            | tensorstore::Dims(x_dim).SizedInterval((i._x_grid-grid_x_min)*whole_image._chunk_size_x, image_width)).value();
+    // open every image and read its shape, since an image that is not the size of the first
+    // one does not fit in a single output chunk. The stores are kept for the chunk tasks.
+    std::vector<tensorstore::TensorStore<>> sources(image_vec.size());
+    std::vector<std::pair<std::int64_t, std::int64_t>> image_shapes(image_vec.size());
+    th_pool.detach_loop(std::size_t{0}, image_vec.size(), [&image_vec, &sources, &image_shapes](std::size_t k) {
+      TENSORSTORE_CHECK_OK_AND_ASSIGN(auto source, tensorstore::Open(
+                                  GetOmeTiffSpecToRead(image_vec[k].file_name),
+                                  tensorstore::OpenMode::open,
+                                  tensorstore::ReadWriteMode::read).result());
+      PLOG_INFO << "Opening "<< image_vec[k].file_name;
+      auto image_shape = source.domain().shape();
+      image_shapes[k] = {image_shape[3], image_shape[4]};
+      sources[k] = std::move(source);
+    });
+    th_pool.wait();
+
+    // group the parts of the images by output chunk, so that each chunk is written once
+    std::map<std::tuple<std::int64_t, std::int64_t, std::int64_t>, std::vector<std::size_t>> chunk_groups;
+    for(std::size_t k=0; k<image_vec.size(); ++k){
+      const auto& i = image_vec[k];
+      auto y_start = (i._y_grid-grid_y_min)*whole_image._chunk_size_y;
+      auto x_start = (i._x_grid-grid_x_min)*whole_image._chunk_size_x;
+      auto y_end = std::min(y_start + image_shapes[k].first, whole_image._full_image_height);
+      auto x_end = std::min(x_start + image_shapes[k].second, whole_image._full_image_width);
+      for(auto chunk_y = y_start/whole_image._chunk_size_y; chunk_y*whole_image._chunk_size_y < y_end; ++chunk_y){
+        for(auto chunk_x = x_start/whole_image._chunk_size_x; chunk_x*whole_image._chunk_size_x < x_end; ++chunk_x){
+          chunk_groups[{chunk_y, chunk_x, (i._c_grid-grid_c_min)/channel_chunk_size}].push_back(k);
+        }
+      }
+    }
+
+    for(const auto& [chunk_key, segments]: chunk_groups){        
+      th_pool.detach_task([&dest, &image_vec, &sources, &image_shapes, chunk_key=chunk_key, segments=segments, x_dim=x_dim, y_dim=y_dim, c_dim=c_dim, v, &whole_image, grid_c_min, grid_x_min, grid_y_min]() {
+        const auto chunk_y_start = std::get<0>(chunk_key)*whole_image._chunk_size_y;
+        const auto chunk_x_start = std::get<1>(chunk_key)*whole_image._chunk_size_x;
+        tensorstore::Transaction txn(tensorstore::isolated);
+        TENSORSTORE_CHECK_OK_AND_ASSIGN(auto dest_txn, dest | txn);
+        std::vector<std::array<std::int64_t, 5>> written_regions;
+        for(auto k: segments){
+          const auto& i = image_vec[k];
+          // the part of the image that is inside the chunk
+          auto y_start = (i._y_grid-grid_y_min)*whole_image._chunk_size_y;
+          auto x_start = (i._x_grid-grid_x_min)*whole_image._chunk_size_x;
+          auto y_min = std::max(y_start, chunk_y_start);
+          auto x_min = std::max(x_start, chunk_x_start);
+          auto y_max = std::min({y_start + image_shapes[k].first, chunk_y_start + whole_image._chunk_size_y, whole_image._full_image_height});
+          auto x_max = std::min({x_start + image_shapes[k].second, chunk_x_start + whole_image._chunk_size_x, whole_image._full_image_width});
+
+          const auto& source = sources[k];
+          auto image_width = x_max - x_min;
+          auto image_height = y_max - y_min;
+          auto array = tensorstore::AllocateArray({image_height, image_width},tensorstore::c_order,
+                                                            tensorstore::value_init, source.dtype());
+
+          // initiate a read
+          tensorstore::Read(source | 
+                tensorstore::Dims(3).SizedInterval(y_min-y_start, image_height) |
+                tensorstore::Dims(4).SizedInterval(x_min-x_start, image_width) ,
+                array).value();
+          // the output is created empty, so an all zero part is only written over an earlier
+          // image of the chunk that it overlaps
+          if (IsZeroFilled(array.data(), array.num_elements()*array.dtype().size()) &&
+              std::none_of(written_regions.begin(), written_regions.end(), [&](const auto& r){
+                return r[0] == i._c_grid && r[1] < y_max && y_min < r[2] && r[3] < x_max && x_min < r[4];
+              })) continue;
+          written_regions.push_back({i._c_grid, y_min, y_max, x_min, x_max});
+
+          tensorstore::IndexTransform<> transform = tensorstore::IdentityTransform(dest.domain());
+          if(v == VisType::PCNG){
+            transform = (std::move(transform) | tensorstore::Dims("z", "channel").IndexSlice({0, i._c_grid-grid_c_min}) 
+                                              | tensorstore::Dims(y_dim).SizedInterval(y_min, image_height) 
+                                              | tensorstore::Dims(x_dim).SizedInterval(x_min, image_width)
+                                              | tensorstore::Dims(x_dim, y_dim).Transpose({y_dim, x_dim})).value();
+
+          } else if (v == VisType::NG_Zarr){
+            transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(i._c_grid-grid_c_min, 1) 
+                                              | tensorstore::Dims(y_dim).SizedInterval(y_min, image_height) 
+                                              | tensorstore::Dims(x_dim).SizedInterval(x_min, image_width)).value();
+          } else if (v == VisType::Viv){
+            transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(i._c_grid-grid_c_min, 1) 
+                                              | tensorstore::Dims(y_dim).SizedInterval(y_min, image_height) 
+                                              | tensorstore::Dims(x_dim).SizedInterval(x_min, image_width)).value();
+          }
+          tensorstore::Write(array, dest_txn | transform).value();
         }
-        tensorstore::Write(array, dest | transform).value();
+        // the chunk is encoded and written once, when the whole channel block is in place
+        txn.CommitAsync().value();
       });
     }
 
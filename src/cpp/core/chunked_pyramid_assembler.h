@@ -30,6 +30,7 @@ public:
                   const std::string& output_file, 
                   const std::string& scale_key, 
                   VisType v, 
+                  std::int64_t channel_chunk_size,
                   BS::thread_pool<BS::tp::none>& th_pool);
 };
 } // ns argolid
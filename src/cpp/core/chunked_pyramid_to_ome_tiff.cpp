@@ -0,0 +1,165 @@
+#include "chunked_pyramid_to_ome_tiff.h"
+#include "../utilities/utilities.h"
+#include <tiffio.h>
+#include <zlib.h>
+#include <plog/Log.h>
+#include "plog/Initializers/RollingFileInitializer.h"
+
+#include <string>
+#include <stdint.h>
+#include <vector>
+#include <deque>
+#include <future>
+#include <cstring>
+#include <cmath>
+#include <stdexcept>
+
+#include "tensorstore/tensorstore.h"
+#include "tensorstore/context.h"
+#include "tensorstore/array.h"
+#include "tensorstore/index_space/dim_expression.h"
+#include "tensorstore/open.h"
+
+namespace argolid {
+namespace {
+uint16_t GetTiffSampleFormat(std::string_view type_name){
+  if (type_name.substr(0, 4) == "uint") {return SAMPLEFORMAT_UINT;}
+  else if (type_name.substr(0, 3) == "int") {return SAMPLEFORMAT_INT;}
+  else if (type_name.substr(0, 5) == "float") {return SAMPLEFORMAT_IEEEFP;}
+  else {return SAMPLEFORMAT_UINT;}
+}
+} // ns
+
+void ChunkedPyramidToOmeTiff::Write(const std::string& input_chunked_dir,
+                                    int min_level,
+                                    int max_level,
+                                    const std::string& output_file,
+                                    const std::string& image_name,
+                                    ImageInfo& whole_image,
+                                    BS::thread_pool<BS::tp::none>& th_pool)
+{
+  // "w8" creates a BigTIFF, since the base level alone can be larger than 4 GB
+  TIFF *tiff_ = TIFFOpen(output_file.c_str(), "w8");
+  if (tiff_ == nullptr) {
+    PLOG_ERROR << "Unable to open " << output_file << " for writing.";
+    throw std::runtime_error("Unable to open " + output_file + " for writing.");
+  }
+
+  auto ome_xml = GetOmeXMLString(image_name, whole_image);
+  auto num_sub_levels = static_cast<uint16_t>(max_level - min_level);
+  // the compressed tiles are appended in order by this thread, while the thread pool keeps
+  // up to max_in_flight tiles being read and compressed ahead of it
+  auto max_in_flight = 2*th_pool.get_thread_count();
+  std::deque<std::future<std::vector<unsigned char>>> pending_tiles;
+  std::int64_t next_tile = 0;
+  auto write_next_tile = [&](){
+    auto compressed_tile = pending_tiles.front().get();
+    pending_tiles.pop_front();
+    if (TIFFWriteRawTile(tiff_, static_cast<uint32_t>(next_tile), compressed_tile.data(), compressed_tile.size()) < 0){
+      PLOG_ERROR << "Unable to write tile " << next_tile << " to " << output_file << ".";
+      throw std::runtime_error("Unable to write tile " + std::to_string(next_tile) + " to " + output_file + ".");
+    }
+    ++next_tile;
+  };
+
+  try {
+    for(std::int64_t c=0; c<whole_image._num_channels; ++c){
+      for(int level=min_level; level<=max_level; ++level){
+        TENSORSTORE_CHECK_OK_AND_ASSIGN(auto store, tensorstore::Open(
+                                GetZarrSpecToRead(input_chunked_dir + "/" + std::to_string(level)),
+                                tensorstore::OpenMode::open,
+                                tensorstore::ReadWriteMode::read).result());
+        auto shape = store.domain().shape();
+        auto image_height = static_cast<std::int64_t>(shape[3]);
+        auto image_width = static_cast<std::int64_t>(shape[4]);
+        auto bytes_per_sample = static_cast<std::int64_t>(store.dtype().size());
+
+        TIFFSetField(tiff_, TIFFTAG_SUBFILETYPE, level == min_level ? 0 : FILETYPE_REDUCEDIMAGE);
+        TIFFSetField(tiff_, TIFFTAG_IMAGEWIDTH, static_cast<uint32_t>(image_width));
+        TIFFSetField(tiff_, TIFFTAG_IMAGELENGTH, static_cast<uint32_t>(image_height));
+        TIFFSetField(tiff_, TIFFTAG_TILEWIDTH, static_cast<uint32_t>(kTileSize));
+        TIFFSetField(tiff_, TIFFTAG_TILELENGTH, static_cast<uint32_t>(kTileSize));
+        TIFFSetField(tiff_, TIFFTAG_BITSPERSAMPLE, static_cast<uint16_t>(8*bytes_per_sample));
+        TIFFSetField(tiff_, TIFFTAG_SAMPLEFORMAT, GetTiffSampleFormat(store.dtype().name()));
+        TIFFSetField(tiff_, TIFFTAG_SAMPLESPERPIXEL, static_cast<uint16_t>(1));
+        TIFFSetField(tiff_, TIFFTAG_PHOTOMETRIC, PHOTOMETRIC_MINISBLACK);
+        TIFFSetField(tiff_, TIFFTAG_PLANARCONFIG, PLANARCONFIG_CONTIG);
+        TIFFSetField(tiff_, TIFFTAG_COMPRESSION, COMPRESSION_ADOBE_DEFLATE);
+        if (level == min_level){
+          if (c == 0){
+            TIFFSetField(tiff_, TIFFTAG_IMAGEDESCRIPTION, ome_xml.c_str());
+          }
+          if (num_sub_levels > 0){
+            // the next num_sub_levels directories are written as SubIFDs of this one
+            std::vector<toff_t> sub_ifd_offsets(num_sub_levels, 0);
+            TIFFSetField(tiff_, TIFFTAG_SUBIFD, num_sub_levels, sub_ifd_offsets.data());
+          }
+        }
+
+        auto num_rows = static_cast<std::int64_t>(ceil(1.0*image_height/kTileSize));
+        auto num_cols = static_cast<std::int64_t>(ceil(1.0*image_width/kTileSize));
+        next_tile = 0;
+        try {
+          for(std::int64_t i=0; i<num_rows; ++i){
+            auto y_start = i*kTileSize;
+            auto y_end = std::min({(i+1)*kTileSize, image_height});
+            for(std::int64_t j=0; j<num_cols; ++j){
+              auto x_start = j*kTileSize;
+              auto x_end = std::min({(j+1)*kTileSize, image_width});
+              pending_tiles.push_back(th_pool.submit_task([&store, c, x_start, x_end, y_start, y_end, bytes_per_sample](){
+                auto array = tensorstore::AllocateArray({y_end-y_start, x_end-x_start}, tensorstore::c_order,
+                                                        tensorstore::value_init, store.dtype());
+                tensorstore::Read(store | tensorstore::Dims(0, 1, 2).IndexSlice({0, c, 0})
+                                        | tensorstore::Dims(0).ClosedInterval(y_start, y_end-1)
+                                        | tensorstore::Dims(1).ClosedInterval(x_start, x_end-1),
+                                  array).value();
+
+                // TIFF tiles are always full size, the edge tiles are padded with zeros
+                std::vector<unsigned char> tile_buffer(kTileSize*kTileSize*bytes_per_sample, 0);
+                auto row_bytes = (x_end-x_start)*bytes_per_sample;
+                auto src = static_cast<const unsigned char*>(array.data());
+                for(std::int64_t row=0; row<y_end-y_start; ++row){
+                  std::memcpy(tile_buffer.data()+row*kTileSize*bytes_per_sample, src+row*row_bytes, row_bytes);
+                }
+
+                uLongf compressed_size = compressBound(static_cast<uLong>(tile_buffer.size()));
+                std::vector<unsigned char> compressed_tile(compressed_size);
+                if (compress2(compressed_tile.data(), &compressed_size, tile_buffer.data(),
+                              static_cast<uLong>(tile_buffer.size()), Z_DEFAULT_COMPRESSION) != Z_OK){
+                  PLOG_ERROR << "Unable to compress tile at (" << y_start << ", " << x_start << ").";
+                  throw std::runtime_error("Unable to compress tile at (" + std::to_string(y_start) + ", " + std::to_string(x_start) + ").");
+                }
+                compressed_tile.resize(compressed_size);
+                return compressed_tile;
+              }));
+
+              while (pending_tiles.size() >= max_in_flight){
+                write_next_tile();
+              }
+            }
+          }
+          while (!pending_tiles.empty()){
+            write_next_tile();
+          }
+        } catch (...) {
+          // the pending tiles read from the store of this level, so they are finished first
+          for(auto& pending_tile: pending_tiles){
+            if (pending_tile.valid()) pending_tile.wait();
+          }
+          pending_tiles.clear();
+          throw;
+        }
+
+        if (!TIFFWriteDirectory(tiff_)){
+          PLOG_ERROR << "Unable to write level " << level << " of channel " << c << " to " << output_file << ".";
+          throw std::runtime_error("Unable to write level " + std::to_string(level) + " of channel " + std::to_string(c) + " to " + output_file + ".");
+        }
+      }
+    }
+  } catch (...) {
+    TIFFClose(tiff_);
+    throw;
+  }
+  TIFFClose(tiff_);
+}
+} // ns argolid
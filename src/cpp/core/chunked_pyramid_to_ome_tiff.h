@@ -0,0 +1,25 @@
+#pragma once
+
+#include <string>
+#include "BS_thread_pool.hpp"
+#include "../utilities/utilities.h"
+
+namespace argolid {
+class ChunkedPyramidToOmeTiff{
+public:
+    ChunkedPyramidToOmeTiff() = default;
+    // Writes the Viv layout levels [min_level, max_level] found in input_chunked_dir as a single
+    // tiled BigTIFF. The base level goes to the main IFDs (one per channel) and the lower levels
+    // go to the SubIFDs of the corresponding main IFD.
+    void Write( const std::string& input_chunked_dir,
+                int min_level,
+                int max_level,
+                const std::string& output_file,
+                const std::string& image_name,
+                ImageInfo& whole_image,
+                BS::thread_pool<BS::tp::none>& th_pool);
+
+private:
+    static constexpr std::int64_t kTileSize = 1024;
+};
+} // ns argolid
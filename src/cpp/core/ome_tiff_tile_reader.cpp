@@ -0,0 +1,36 @@
+#include "ome_tiff_tile_reader.h"
+
+#include <stdexcept>
+
+#include "tensorstore/array.h"
+#include "tensorstore/index_space/dim_expression.h"
+#include "tensorstore/open.h"
+
+namespace argolid {
+OmeTiffTileReader::OmeTiffTileReader(const std::string& filename){
+  // a file that cannot be opened is reported to the caller rather than aborting the process
+  auto opened = tensorstore::Open(GetOmeTiffSpecToRead(filename),
+                            tensorstore::OpenMode::open,
+                            tensorstore::ReadWriteMode::read).result();
+  if (!opened.ok()) {
+    throw std::runtime_error("Unable to open " + filename + ": " + std::string(opened.status().message()));
+  }
+  store = *std::move(opened);
+  auto shape = store.domain().shape();
+  height = shape[3]; // as per tiled_tiff spec
+  width = shape[4];
+}
+
+void OmeTiffTileReader::ReadTile(std::int64_t y_start, std::int64_t y_end, std::int64_t x_start, std::int64_t x_end, void* buffer) const{
+  // the buffer is owned by the caller, it outlives the read since the read is awaited
+  auto array = tensorstore::Array(tensorstore::ElementPointer<void>(buffer, store.dtype()),
+                                  {y_end-y_start, x_end-x_start}, tensorstore::c_order);
+  auto status = tensorstore::Read(store |
+                    tensorstore::Dims(3).ClosedInterval(y_start,y_end-1) |
+                    tensorstore::Dims(4).ClosedInterval(x_start,x_end-1),
+                    tensorstore::UnownedToShared(array)).status();
+  if (!status.ok()) {
+    throw std::runtime_error("Unable to read tile at (" + std::to_string(y_start) + ", " + std::to_string(x_start) + "): " + std::string(status.message()));
+  }
+}
+} // ns argolid
@@ -0,0 +1,25 @@
+#pragma once
+#include <string>
+#include <cstdint>
+#include "tensorstore/tensorstore.h"
+#include "../utilities/utilities.h"
+
+namespace argolid{
+// Reads tiles of the first plane of an OME-TIFF file. A reader can be shared by many
+// threads, the reads do not need the Python GIL.
+class OmeTiffTileReader{
+public:
+    explicit OmeTiffTileReader(const std::string& filename);
+
+    std::int64_t Height() const {return height;}
+    std::int64_t Width() const {return width;}
+    // Returns the name of the data type, such as "uint16".
+    std::string DataType() const {return std::string(store.dtype().name());}
+    // Reads the [y_start, y_end) x [x_start, x_end) region into a C ordered buffer of the data type.
+    void ReadTile(std::int64_t y_start, std::int64_t y_end, std::int64_t x_start, std::int64_t x_end, void* buffer) const;
+
+private:
+    tensorstore::TensorStore<void, tensorstore::dynamic_rank, tensorstore::ReadWriteMode::read> store;
+    std::int64_t height, width;
+};
+} // ns argolid
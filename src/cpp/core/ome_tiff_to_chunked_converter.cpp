@@ -37,10 +37,14 @@ void OmeTiffToChunkedConverter::Convert( const std::string& input_file, const st
 
   std::int64_t image_length = shape[3]; // as per tiled_tiff spec
   std::int64_t image_width = shape[4];
+  std::int64_t num_channels = shape[1];
   std::vector<std::int64_t> new_image_shape(num_dims,1);
   std::vector<std::int64_t> chunk_shape(num_dims,1);
   new_image_shape[y_dim] = image_length;
   new_image_shape[x_dim] = image_width;
+  if (v == VisType::NG_Zarr || v == VisType::Viv){
+    new_image_shape[c_dim] = num_channels;
+  }
   chunk_shape[y_dim] = static_cast<std::int64_t>(read_chunk_shape[3]);
   chunk_shape[x_dim] = static_cast<std::int64_t>(read_chunk_shape[4]);
 
@@ -51,7 +55,7 @@ void OmeTiffToChunkedConverter::Convert( const std::string& input_file, const st
     if (v == VisType::NG_Zarr | v == VisType::Viv){
       return GetZarrSpecToWrite(output_file + "/" + scale_key, new_image_shape, chunk_shape, ChooseBaseDType(store1.dtype()).value().encoded_dtype);
     } else if (v == VisType::PCNG){
-      return GetNPCSpecToWrite(output_file, scale_key, new_image_shape, chunk_shape, 1, 1, store1.dtype().name(), true);
+      return GetNPCSpecToWrite(output_file, scale_key, new_image_shape, chunk_shape, 1, num_channels, store1.dtype().name(), true);
     } else {
       return tensorstore::Spec();
     }
@@ -69,27 +73,33 @@ void OmeTiffToChunkedConverter::Convert( const std::string& input_file, const st
     for(std::int64_t j=0; j<num_cols; ++j){
       std::int64_t x_start = j*chunk_shape[x_dim];
       std::int64_t x_end = std::min({(j+1)*chunk_shape[x_dim], image_width});
-      th_pool.detach_task([&store1, &store2, x_start, x_end, y_start, y_end, x_dim=x_dim, y_dim=y_dim, v](){  
-
-        auto array = tensorstore::AllocateArray({y_end-y_start, x_end-x_start},tensorstore::c_order,
-                                tensorstore::value_init, store1.dtype());
-        // initiate a read
-        tensorstore::Read(store1 | 
-                          tensorstore::Dims(3).ClosedInterval(y_start,y_end-1) |
-                          tensorstore::Dims(4).ClosedInterval(x_start,x_end-1) ,
-                          array).value();
-        
-        tensorstore::IndexTransform<> transform = tensorstore::IdentityTransform(store2.domain());
-        if(v == VisType::PCNG){
-          transform = (std::move(transform) | tensorstore::Dims(2, 3).IndexSlice({0,0}) 
-                                            | tensorstore::Dims(y_dim).ClosedInterval(y_start,y_end-1) 
-                                            | tensorstore::Dims(x_dim).ClosedInterval(x_start,x_end-1)
-                                            | tensorstore::Dims(x_dim, y_dim).Transpose({y_dim, x_dim})).value();
-        }else if (v == VisType::NG_Zarr || v == VisType::Viv){
-          transform = (std::move(transform) | tensorstore::Dims(y_dim).ClosedInterval(y_start,y_end-1) 
-                                            | tensorstore::Dims(x_dim).ClosedInterval(x_start,x_end-1)).value();
+      th_pool.detach_task([&store1, &store2, num_channels, x_start, x_end, y_start, y_end, x_dim=x_dim, y_dim=y_dim, c_dim=c_dim, v](){  
+        for(std::int64_t c=0; c<num_channels; ++c){
+          auto array = tensorstore::AllocateArray({y_end-y_start, x_end-x_start},tensorstore::c_order,
+                                  tensorstore::value_init, store1.dtype());
+          // initiate a read
+          tensorstore::Read(store1 | 
+                            tensorstore::Dims(0, 1, 2).IndexSlice({0, c, 0}) |
+                            tensorstore::Dims(0).ClosedInterval(y_start,y_end-1) |
+                            tensorstore::Dims(1).ClosedInterval(x_start,x_end-1) ,
+                            array).value();
+          // the output is created empty and the tiles do not overlap, so an all zero tile
+          // leaves nothing stale behind
+          if (IsZeroFilled(array.data(), array.num_elements()*array.dtype().size())) continue;
+          
+          tensorstore::IndexTransform<> transform = tensorstore::IdentityTransform(store2.domain());
+          if(v == VisType::PCNG){
+            transform = (std::move(transform) | tensorstore::Dims(2, 3).IndexSlice({0, c}) 
+                                              | tensorstore::Dims(y_dim).ClosedInterval(y_start,y_end-1) 
+                                              | tensorstore::Dims(x_dim).ClosedInterval(x_start,x_end-1)
+                                              | tensorstore::Dims(x_dim, y_dim).Transpose({y_dim, x_dim})).value();
+          }else if (v == VisType::NG_Zarr || v == VisType::Viv){
+            transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(c, 1) 
+                                              | tensorstore::Dims(y_dim).ClosedInterval(y_start,y_end-1) 
+                                              | tensorstore::Dims(x_dim).ClosedInterval(x_start,x_end-1)).value();
+          }
+          tensorstore::Write(array, store2 | transform).value();
         }
-        tensorstore::Write(array, store2 | transform).value();
       });       
 
     }
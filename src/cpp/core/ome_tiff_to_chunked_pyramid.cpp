@@ -1,6 +1,9 @@
 #include "ome_tiff_to_chunked_pyramid.h"
 #include <filesystem>
 
+#include "tensorstore/tensorstore.h"
+#include "tensorstore/open.h"
+
 namespace fs = std::filesystem;
 
 namespace argolid {
@@ -13,13 +16,35 @@ void OmeTiffToChunkedPyramid::GenerateFromSingleFile(  const std::string& input_
         int max_level = static_cast<int>(ceil(log2(std::max({image_width, image_height}))));
         int min_level = static_cast<int>(ceil(log2(min_dim)));   
         std::string tiff_file_name = fs::path(input_file).stem().string();
+        int base_level_key = 0;
+        auto max_level_key = max_level-min_level+1+base_level_key;
+        if (v == VisType::OmeTiff){
+            // the pyramid is staged as a Viv zarr and then packed into a single tiled OME-TIFF
+            std::string staging_dir = output_dir + "/" + tiff_file_name + "_staging.zarr";
+            PLOG_INFO << "Converting base image...";
+            _tiff_to_chunk.Convert(input_file, staging_dir, std::to_string(base_level_key), VisType::Viv, _th_pool);
+            PLOG_INFO << "Generating image pyramids...";
+            _base_to_pyramid.CreatePyramidImages(staging_dir, staging_dir, base_level_key, min_dim, VisType::Viv, channel_ds_config, _th_pool);
+            TENSORSTORE_CHECK_OK_AND_ASSIGN(auto base_store, tensorstore::Open(
+                                    GetZarrSpecToRead(staging_dir + "/" + std::to_string(base_level_key)),
+                                    tensorstore::OpenMode::open,
+                                    tensorstore::ReadWriteMode::read).result());
+            ImageInfo whole_image;
+            whole_image._full_image_height = image_height;
+            whole_image._full_image_width = image_width;
+            whole_image._num_channels = base_store.domain().shape()[1];
+            whole_image._data_type = base_store.dtype().name();
+            PLOG_INFO << "Writing OME-TIFF...";
+            _pyramid_to_tiff.Write(staging_dir, base_level_key, max_level_key, output_dir + "/" + tiff_file_name + ".ome.tiff",
+                                   tiff_file_name, whole_image, _th_pool);
+            fs::remove_all(staging_dir);
+            return;
+        }
         std::string chunked_file_dir = output_dir + "/" + tiff_file_name + ".zarr";
         if (v == VisType::Viv){
             chunked_file_dir = chunked_file_dir + "/data.zarr/0";
         }
 
-        int base_level_key = 0;
-        auto max_level_key = max_level-min_level+1+base_level_key;
         PLOG_INFO << "Converting base image...";
         _tiff_to_chunk.Convert(input_file, chunked_file_dir, std::to_string(base_level_key), v, _th_pool);
         PLOG_INFO << "Generating image pyramids...";
@@ -38,15 +63,32 @@ void OmeTiffToChunkedPyramid::GenerateFromCollection(
                 const std::string& output_dir, 
                 int min_dim, 
                 VisType v,
-                std::unordered_map<std::int64_t, DSType>& channel_ds_config){
+                std::unordered_map<std::int64_t, DSType>& channel_ds_config,
+                std::int64_t channel_chunk_size){
     std::string chunked_file_dir = output_dir + "/" + image_name + ".zarr";
     if (v == VisType::Viv){
         chunked_file_dir = chunked_file_dir + "/data.zarr/0";
     }
 
     int base_level_key = 0;
+    if (v == VisType::OmeTiff){
+        // the pyramid is staged as a Viv zarr and then packed into a single tiled OME-TIFF
+        std::string staging_dir = output_dir + "/" + image_name + "_staging.zarr";
+        PLOG_INFO << "Assembling base image...";
+        auto whole_image =_tiff_coll_to_chunk.Assemble(collection_path, stitch_vector_file, staging_dir, std::to_string(base_level_key), VisType::Viv, channel_chunk_size, _th_pool);
+        int max_level = static_cast<int>(ceil(log2(std::max({whole_image._full_image_width, whole_image._full_image_height}))));
+        int min_level = static_cast<int>(ceil(log2(min_dim)));
+        auto max_level_key = max_level-min_level+1+base_level_key;
+        PLOG_INFO << "Generating image pyramids...";
+        _base_to_pyramid.CreatePyramidImages(staging_dir, staging_dir, base_level_key, min_dim, VisType::Viv, channel_ds_config, _th_pool);
+        PLOG_INFO << "Writing OME-TIFF...";
+        _pyramid_to_tiff.Write(staging_dir, base_level_key, max_level_key, output_dir + "/" + image_name + ".ome.tiff",
+                               image_name, whole_image, _th_pool);
+        fs::remove_all(staging_dir);
+        return;
+    }
     PLOG_INFO << "Assembling base image...";
-    auto whole_image =_tiff_coll_to_chunk.Assemble(collection_path, stitch_vector_file, chunked_file_dir, std::to_string(base_level_key), v, _th_pool);
+    auto whole_image =_tiff_coll_to_chunk.Assemble(collection_path, stitch_vector_file, chunked_file_dir, std::to_string(base_level_key), v, channel_chunk_size, _th_pool);
     int max_level = static_cast<int>(ceil(log2(std::max({whole_image._full_image_width, whole_image._full_image_width}))));
     int min_level = static_cast<int>(ceil(log2(min_dim)));
     auto max_level_key = max_level-min_level+1+base_level_key;
@@ -6,6 +6,7 @@
 #include "ome_tiff_to_chunked_converter.h"
 #include "chunked_pyramid_assembler.h"
 #include "chunked_base_to_pyr_gen.h"
+#include "chunked_pyramid_to_ome_tiff.h"
 #include "../utilities/utilities.h"
 #include "BS_thread_pool.hpp"
 #include <plog/Log.h>
@@ -22,7 +23,8 @@ public:
                                 int min_dim, VisType v, std::unordered_map<std::int64_t, DSType>& channel_ds_config);
     void GenerateFromCollection(const std::string& collection_path, const std::string& stitch_vector_file,
                                 const std::string& image_name, const std::string& output_dir, 
-                                int min_dim, VisType v, std::unordered_map<std::int64_t, DSType>& channel_ds_config);
+                                int min_dim, VisType v, std::unordered_map<std::int64_t, DSType>& channel_ds_config,
+                                std::int64_t channel_chunk_size);
     void SetLogLevel(int level){
         if (level>=0 && level<=6) {
             plog::get()->setMaxSeverity(plog::Severity(level));
@@ -33,6 +35,7 @@ private:
     OmeTiffToChunkedConverter _tiff_to_chunk;
     ChunkedBaseToPyramid _base_to_pyramid;
     OmeTiffCollToChunked _tiff_coll_to_chunk;
+    ChunkedPyramidToOmeTiff _pyramid_to_tiff;
     BS::thread_pool<BS::tp::none> _th_pool;
 };
 } // ns argolid
\ No newline at end of file
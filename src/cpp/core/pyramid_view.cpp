@@ -2,7 +2,10 @@
 #include <iostream>
 #include <regex>
 #include <vector>
+#include <array>
 #include <list>
+#include <map>
+#include <algorithm>
 #include <cstring>
 #include <unordered_set>
 #include <string>
@@ -24,6 +27,7 @@
 #include "tensorstore/index_space/dim_expression.h"
 #include "tensorstore/kvstore/kvstore.h"
 #include "tensorstore/open.h"
+#include "tensorstore/transaction.h"
 #include "filepattern/filepattern.h"
 
 #include "pyramid_view.h"
@@ -39,7 +43,7 @@ using::tensorstore::internal_zarr::ChooseBaseDType;
 
 namespace argolid {
 
-  void PyramidView::AssembleBaseLevel(VisType v, const image_map& coordinate_map, const std::string& zarr_array_path) {
+  void PyramidView::AssembleBaseLevel(VisType v, const image_map& coordinate_map, const std::string& zarr_array_path, std::int64_t channel_chunk_size) {
      if (v!=VisType::NG_Zarr && v!=VisType::Viv) {
       PLOG_INFO << "Unsupported Pyramid type requested";
       return;
@@ -84,6 +88,8 @@ namespace argolid {
       chunk_shape[x_dim] = whole_image._chunk_size_x;
       whole_image._data_type = test_source.dtype().name();
       new_image_shape[c_dim] = whole_image._num_channels;
+      channel_chunk_size = std::clamp(channel_chunk_size, std::int64_t{1}, whole_image._num_channels);
+      chunk_shape[c_dim] = channel_chunk_size;
 
       auto output_spec = [&test_source, &new_image_shape, &chunk_shape, &zarr_array_path, this]() {
           return GetZarrSpecToWrite(zarr_array_path, new_image_shape, chunk_shape, ChooseBaseDType(test_source.dtype()).value().encoded_dtype);
@@ -96,42 +102,92 @@ namespace argolid {
         tensorstore::ReadWriteMode::write).result());
 
       auto t4 = std::chrono::high_resolution_clock::now();
-      for (const auto & [file_name, location]: coordinate_map) {
-        th_pool.detach_task([ &dest, file_name=file_name, location=location, x_dim=x_dim, y_dim=y_dim, c_dim=c_dim, v, &whole_image, this]() {
-
-          TENSORSTORE_CHECK_OK_AND_ASSIGN(auto source, tensorstore::Open(
-            GetOmeTiffSpecToRead(image_coll_path + "/" + file_name),
-            tensorstore::OpenMode::open,
-            tensorstore::ReadWriteMode::read).result());
-          PLOG_DEBUG << "Opening " << file_name;
-          auto image_shape = source.domain().shape();
-          auto image_width = image_shape[4];
-          auto image_height = image_shape[3];
-          auto array = tensorstore::AllocateArray({
-              image_height,
-              image_width
-            }, tensorstore::c_order,
-            tensorstore::value_init, source.dtype());
-
-          // initiate a read
-          tensorstore::Read(source |
-            tensorstore::Dims(3).ClosedInterval(0, image_height - 1) |
-            tensorstore::Dims(4).ClosedInterval(0, image_width - 1),
-            array).value();
-
-          const auto & [x_grid, y_grid, c_grid] = location;
-
-          tensorstore::IndexTransform < > transform = tensorstore::IdentityTransform(dest.domain());
-          if (v == VisType::NG_Zarr) {
-            transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(c_grid, 1) |
-              tensorstore::Dims(y_dim).SizedInterval(y_grid * whole_image._chunk_size_y + y_spacing, image_height) |
-              tensorstore::Dims(x_dim).SizedInterval(x_grid * whole_image._chunk_size_x + x_spacing, image_width)).value();
-          } else if (v == VisType::Viv) {
-            transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(c_grid, 1) |
-              tensorstore::Dims(y_dim).SizedInterval(y_grid * whole_image._chunk_size_y + y_spacing, image_height) |
-              tensorstore::Dims(x_dim).SizedInterval(x_grid * whole_image._chunk_size_x + x_spacing, image_width)).value();
+      // open every image and read its shape, since an image that is not the size of the first
+      // one does not fit in a single output chunk. The stores are kept for the chunk tasks.
+      std::vector<std::pair<std::string, std::tuple<std::uint32_t, std::uint32_t, std::uint32_t>>> images(coordinate_map.begin(), coordinate_map.end());
+      std::vector<tensorstore::TensorStore<>> sources(images.size());
+      std::vector<std::pair<std::int64_t, std::int64_t>> image_shapes(images.size());
+      th_pool.detach_loop(std::size_t{0}, images.size(), [&images, &sources, &image_shapes, this](std::size_t k) {
+        TENSORSTORE_CHECK_OK_AND_ASSIGN(auto source, tensorstore::Open(
+          GetOmeTiffSpecToRead(image_coll_path + "/" + images[k].first),
+          tensorstore::OpenMode::open,
+          tensorstore::ReadWriteMode::read).result());
+        PLOG_DEBUG << "Opening " << images[k].first;
+        auto image_shape = source.domain().shape();
+        image_shapes[k] = {image_shape[3], image_shape[4]};
+        sources[k] = std::move(source);
+      });
+      th_pool.wait();
+
+      // group the parts of the images by output chunk, so that each chunk is written once
+      std::map<std::tuple<std::int64_t, std::int64_t, std::int64_t>, std::vector<std::size_t>> chunk_groups;
+      for (std::size_t k = 0; k < images.size(); ++k) {
+        const auto & [x_grid, y_grid, c_grid] = images[k].second;
+        std::int64_t y_start = y_grid * whole_image._chunk_size_y + y_spacing;
+        std::int64_t x_start = x_grid * whole_image._chunk_size_x + x_spacing;
+        auto y_end = std::min(y_start + image_shapes[k].first, whole_image._full_image_height);
+        auto x_end = std::min(x_start + image_shapes[k].second, whole_image._full_image_width);
+        for (auto chunk_y = y_start / whole_image._chunk_size_y; chunk_y * whole_image._chunk_size_y < y_end; ++chunk_y) {
+          for (auto chunk_x = x_start / whole_image._chunk_size_x; chunk_x * whole_image._chunk_size_x < x_end; ++chunk_x) {
+            chunk_groups[{chunk_y, chunk_x, c_grid/channel_chunk_size}].push_back(k);
+          }
+        }
+      }
+
+      for (const auto & [chunk_key, segments]: chunk_groups) {
+        th_pool.detach_task([ &dest, &images, &sources, &image_shapes, chunk_key=chunk_key, segments=segments, x_dim=x_dim, y_dim=y_dim, c_dim=c_dim, v, &whole_image, this]() {
+          const auto chunk_y_start = std::get<0>(chunk_key) * whole_image._chunk_size_y;
+          const auto chunk_x_start = std::get<1>(chunk_key) * whole_image._chunk_size_x;
+          tensorstore::Transaction txn(tensorstore::isolated);
+          TENSORSTORE_CHECK_OK_AND_ASSIGN(auto dest_txn, dest | txn);
+          std::vector<std::array<std::int64_t, 5>> written_regions;
+          for (auto k: segments) {
+            const auto & [x_grid, y_grid, c_grid] = images[k].second;
+            // the part of the image that is inside the chunk
+            std::int64_t y_start = y_grid * whole_image._chunk_size_y + y_spacing;
+            std::int64_t x_start = x_grid * whole_image._chunk_size_x + x_spacing;
+            auto y_min = std::max(y_start, chunk_y_start);
+            auto x_min = std::max(x_start, chunk_x_start);
+            auto y_max = std::min({y_start + image_shapes[k].first, chunk_y_start + whole_image._chunk_size_y, whole_image._full_image_height});
+            auto x_max = std::min({x_start + image_shapes[k].second, chunk_x_start + whole_image._chunk_size_x, whole_image._full_image_width});
+
+            const auto & source = sources[k];
+            auto image_width = x_max - x_min;
+            auto image_height = y_max - y_min;
+            auto array = tensorstore::AllocateArray({
+                image_height,
+                image_width
+              }, tensorstore::c_order,
+              tensorstore::value_init, source.dtype());
+
+            // initiate a read
+            tensorstore::Read(source |
+              tensorstore::Dims(3).SizedInterval(y_min - y_start, image_height) |
+              tensorstore::Dims(4).SizedInterval(x_min - x_start, image_width),
+              array).value();
+            const std::int64_t c_index = c_grid;
+            // the output is created empty, so an all zero part is only written over an earlier
+            // image of the chunk that it overlaps
+            if (IsZeroFilled(array.data(), array.num_elements()*array.dtype().size()) &&
+                std::none_of(written_regions.begin(), written_regions.end(), [&](const auto& r){
+                  return r[0] == c_index && r[1] < y_max && y_min < r[2] && r[3] < x_max && x_min < r[4];
+                })) continue;
+            written_regions.push_back({c_index, y_min, y_max, x_min, x_max});
+
+            tensorstore::IndexTransform < > transform = tensorstore::IdentityTransform(dest.domain());
+            if (v == VisType::NG_Zarr) {
+              transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(c_grid, 1) |
+                tensorstore::Dims(y_dim).SizedInterval(y_min, image_height) |
+                tensorstore::Dims(x_dim).SizedInterval(x_min, image_width)).value();
+            } else if (v == VisType::Viv) {
+              transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(c_grid, 1) |
+                tensorstore::Dims(y_dim).SizedInterval(y_min, image_height) |
+                tensorstore::Dims(x_dim).SizedInterval(x_min, image_width)).value();
+            }
+            tensorstore::Write(array, dest_txn | transform).value();
           }
-          tensorstore::Write(array, dest | transform).value();
+          // the chunk is encoded and written once, when the whole channel block is in place
+          txn.CommitAsync().value();
         });
       }
 
@@ -143,7 +199,8 @@ namespace argolid {
   void PyramidView::GeneratePyramid(const image_map& map, 
                                     VisType v, 
                                     int min_dim,  
-                                    const std::unordered_map<std::int64_t, DSType>& channel_ds_config)
+                                    const std::unordered_map<std::int64_t, DSType>& channel_ds_config,
+                                    std::int64_t channel_chunk_size)
   {
     const auto image_dir = pyramid_zarr_path + "/" + image_name +".zarr";
     if (fs::exists(image_dir)) fs::remove_all(image_dir);
@@ -162,7 +219,7 @@ namespace argolid {
       }
     }();
     PLOG_INFO << "Starting to generate base layer ";
-    AssembleBaseLevel(v, map, output_zarr_path+"/0") ;
+    AssembleBaseLevel(v, map, output_zarr_path+"/0", channel_chunk_size) ;
     PLOG_INFO << "Finished generating base layer ";
 
     // generate pyramid
@@ -23,11 +23,12 @@ public:
         y_spacing(y_spacing)
         {}
     
-    void AssembleBaseLevel(VisType v, const image_map& map, const std::string& zarr_array_path);
+    void AssembleBaseLevel(VisType v, const image_map& map, const std::string& zarr_array_path, std::int64_t channel_chunk_size);
     void GeneratePyramid(const image_map& map, 
                                     VisType v, 
                                     int min_dim,  
-                                    const std::unordered_map<std::int64_t, DSType>& channel_ds_config);
+                                    const std::unordered_map<std::int64_t, DSType>& channel_ds_config,
+                                    std::int64_t channel_chunk_size);
 
 
 private:
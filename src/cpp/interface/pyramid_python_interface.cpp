@@ -1,8 +1,10 @@
 #include "../core/ome_tiff_to_chunked_pyramid.h"
 #include "../core/pyramid_view.h"
+#include "../core/ome_tiff_tile_reader.h"
 #include "../utilities/utilities.h"
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
+#include <pybind11/numpy.h>
 namespace py = pybind11;
 
 PYBIND11_MODULE(libargolid, m) {
@@ -17,10 +19,27 @@ PYBIND11_MODULE(libargolid, m) {
     .def("GeneratePyramid", &argolid::PyramidView::GeneratePyramid) \
     .def("AssembleBaseLevel", &argolid::PyramidView::AssembleBaseLevel) ;
 
+    py::class_<argolid::OmeTiffTileReader, std::shared_ptr<argolid::OmeTiffTileReader>>(m, "OmeTiffTileReaderCPP") \
+    .def(py::init<const std::string&>()) \
+    .def("Height", &argolid::OmeTiffTileReader::Height) \
+    .def("Width", &argolid::OmeTiffTileReader::Width) \
+    .def("DataType", &argolid::OmeTiffTileReader::DataType) \
+    .def("ReadTile", [](const argolid::OmeTiffTileReader& reader, std::int64_t y_start, std::int64_t y_end, std::int64_t x_start, std::int64_t x_end){
+        py::array tile(py::dtype(reader.DataType()), std::vector<py::ssize_t>{y_end-y_start, x_end-x_start});
+        void* buffer = tile.mutable_data();
+        {
+            // tiles of many files are read concurrently by Python threads
+            py::gil_scoped_release release;
+            reader.ReadTile(y_start, y_end, x_start, x_end, buffer);
+        }
+        return tile;
+    });
+
     py::enum_<argolid::VisType>(m, "VisType")
         .value("NG_Zarr", argolid::VisType::NG_Zarr)
         .value("PCNG", argolid::VisType::PCNG)
         .value("Viv", argolid::VisType::Viv)
+        .value("OmeTiff", argolid::VisType::OmeTiff)
         .export_values();
 
     py::enum_<argolid::DSType>(m, "DSType")
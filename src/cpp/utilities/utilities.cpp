@@ -2,6 +2,7 @@
 #include <ctime>
 #include <chrono>
 #include <fstream>
+#include <sstream>
 #include <filesystem>
 #include <plog/Log.h>
 #include <tiffio.h>
@@ -10,10 +11,21 @@
 #include "utilities.h"
 #include <thread>
 
+#include "tensorstore/index_space/dim_expression.h"
+
 using json = nlohmann::json;
 namespace fs = std::filesystem;
 
 namespace argolid {
+json GetKvstoreSpec(const std::string& location){
+    // kvstore URLs such as "memory://", "file:///data" or "gs://bucket/path" are passed
+    // through to tensorstore, anything else is a path on the local filesystem
+    if (location.find("://") != std::string::npos){
+      return location;
+    }
+    return {{"driver", "file"}, {"path", location}};
+}
+
 tensorstore::Spec GetOmeTiffSpecToRead(const std::string& filename){
     return tensorstore::Spec::FromJson({{"driver", "ometiff"},
 
@@ -33,9 +45,7 @@ tensorstore::Spec GetZarrSpecToWrite(   const std::string& filename,
                                         const std::vector<std::int64_t>& chunk_shape,
                                         const std::string& dtype){
     return tensorstore::Spec::FromJson({{"driver", "zarr"},
-                            {"kvstore", {{"driver", "file"},
-                                         {"path", filename}}
-                            },
+                            {"kvstore", GetKvstoreSpec(filename)},
                             {"context", {
                               {"cache_pool", {{"total_bytes_limit", 1000000000}}},
                               {"data_copy_concurrency", {{"limit", std::thread::hardware_concurrency()}}},
@@ -52,17 +62,13 @@ tensorstore::Spec GetZarrSpecToWrite(   const std::string& filename,
 
 tensorstore::Spec GetZarrSpecToRead(const std::string& filename){
     return tensorstore::Spec::FromJson({{"driver", "zarr"},
-                            {"kvstore", {{"driver", "file"},
-                                         {"path", filename}}
-                            }
+                            {"kvstore", GetKvstoreSpec(filename)}
                             }).value();
 }
 
 tensorstore::Spec GetNPCSpecToRead(const std::string& filename, const std::string& scale_key){
     return tensorstore::Spec::FromJson({{"driver", "neuroglancer_precomputed"},
-                            {"kvstore", {{"driver", "file"},
-                                         {"path", filename}}
-                            },
+                            {"kvstore", GetKvstoreSpec(filename)},
                             {"scale_metadata", {
                                             {"key", scale_key},
                                             },
@@ -79,9 +85,7 @@ tensorstore::Spec GetNPCSpecToWrite(const std::string& filename,
                                     std::string_view dtype, bool base_level){
     if (base_level){
       return tensorstore::Spec::FromJson({{"driver", "neuroglancer_precomputed"},
-                              {"kvstore", {{"driver", "file"},
-                                          {"path", filename}}
-                              },
+                              {"kvstore", GetKvstoreSpec(filename)},
                               {"context", {
                                 {"cache_pool", {{"total_bytes_limit", 1000000000}}},
                                 {"data_copy_concurrency", {{"limit", std::thread::hardware_concurrency()}}},
@@ -102,9 +106,7 @@ tensorstore::Spec GetNPCSpecToWrite(const std::string& filename,
                               }}).value();
     } else {
       return tensorstore::Spec::FromJson({{"driver", "neuroglancer_precomputed"},
-                        {"kvstore", {{"driver", "file"},
-                                      {"path", filename}}
-                        },
+                        {"kvstore", GetKvstoreSpec(filename)},
                         {"context", {
                           {"cache_pool", {{"total_bytes_limit", 1000000000}}},
                           {"data_copy_concurrency", {{"limit", std::thread::hardware_concurrency()}}},
@@ -274,6 +276,15 @@ void WriteMultiscaleMetadataForImageCollection(const std::string& image_file_nam
 }
 
 void GenerateOmeXML(const std::string& image_name, const std::string& output_file, ImageInfo& whole_image){
+    std::ofstream metadata_file(output_file, std::ios_base::trunc | std::ios_base::out);
+    if (metadata_file.is_open()){
+        metadata_file << GetOmeXMLString(image_name, whole_image);
+    } else {
+        PLOG_INFO << "Unable to write metadata file " << output_file << ".";
+    }
+}
+
+std::string GetOmeXMLString(const std::string& image_name, ImageInfo& whole_image){
 
     pugi::xml_document doc;
 
@@ -315,7 +326,9 @@ void GenerateOmeXML(const std::string& image_name, const std::string& output_fil
       channelNode.append_child("LightPath");
     }
   
-    doc.save_file(output_file.c_str());
+    std::ostringstream xml_stream;
+    doc.save(xml_stream);
+    return xml_stream.str();
 }
 
 void WriteMultiscaleMetadataForSingleFile( const std::string& input_file , const std::string& output_dir, 
@@ -333,6 +346,30 @@ void WriteMultiscaleMetadataForSingleFile( const std::string& input_file , const
     }
 }
 
+tensorstore::IndexTransform<> GetChannelBlockTransform( tensorstore::IndexTransform<> transform, VisType v,
+                                                        std::int64_t c_start, std::int64_t c_size,
+                                                        std::int64_t y_start, std::int64_t y_size,
+                                                        std::int64_t x_start, std::int64_t x_size){
+    if (v == VisType::PCNG){
+      // neuroglancer_precomputed dims are labelled x, y, z, channel
+      return (std::move(transform) | tensorstore::Dims("z").IndexSlice(0)
+                                   | tensorstore::Dims("channel").SizedInterval(c_start, c_size)
+                                   | tensorstore::Dims("y").SizedInterval(y_start, y_size)
+                                   | tensorstore::Dims("x").SizedInterval(x_start, x_size)
+                                   | tensorstore::Dims("channel", "y", "x").Transpose()).value();
+    }
+
+    auto [x_dim, y_dim, c_dim, num_dims] = GetZarrParams(v);
+    transform = (std::move(transform) | tensorstore::Dims(c_dim).SizedInterval(c_start, c_size)
+                                      | tensorstore::Dims(y_dim).SizedInterval(y_start, y_size)
+                                      | tensorstore::Dims(x_dim).SizedInterval(x_start, x_size)).value();
+    if (v == VisType::Viv){ // drop t and z
+      return (std::move(transform) | tensorstore::Dims(0, 2).IndexSlice({0, 0})).value();
+    } else { // NG_Zarr, drop z
+      return (std::move(transform) | tensorstore::Dims(1).IndexSlice(0)).value();
+    }
+}
+
 std::optional<std::tuple<std::uint32_t, std::uint32_t>> GetTiffDims (const std::string filename){
     TIFF *tiff_ = TIFFOpen(filename.c_str(), "r");
     if (tiff_ != nullptr) {
@@ -4,12 +4,15 @@
 #include <vector>
 #include <cmath>
 #include <tuple>
+#include <algorithm>
 
 #include "tensorstore/tensorstore.h"
 #include "tensorstore/spec.h"
+#include "tensorstore/index_space/index_transform.h"
+#include <nlohmann/json.hpp>
 
 namespace argolid {
-enum VisType {Viv, NG_Zarr, PCNG};
+enum VisType {Viv, NG_Zarr, PCNG, OmeTiff};
 
 enum class DSType {Mean, Mode_Max, Mode_Min};
 
@@ -19,6 +22,8 @@ struct ImageInfo
   std::string _data_type;
 };
 
+// Returns the kvstore spec of an output location, either a local path or a kvstore URL.
+nlohmann::json GetKvstoreSpec(const std::string& location);
 tensorstore::Spec GetOmeTiffSpecToRead(const std::string& filename);
 //tensorstore::Spec GetZarrSpecToRead(const std::string& filename, const std::string& scale_key);
 tensorstore::Spec GetZarrSpecToRead(const std::string& filename);
@@ -46,6 +51,7 @@ void ExtractAndWriteXML(const std::string& input_file, const std::string& xml_lo
 void WriteMultiscaleMetadataForImageCollection(const std::string& image_file_name , const std::string& output_dir, 
                                                 int min_level, int max_level, VisType v, ImageInfo& whole_image);
 void GenerateOmeXML(const std::string& image_name, const std::string& output_file, ImageInfo& whole_image);
+std::string GetOmeXMLString(const std::string& image_name, ImageInfo& whole_image);
 void WriteMultiscaleMetadataForSingleFile( const std::string& input_file , const std::string& output_dir, 
                                                                     int min_level, int max_level, VisType v);
 inline std::tuple<int,int,int,int> GetZarrParams(VisType v){
@@ -56,8 +62,24 @@ inline std::tuple<int,int,int,int> GetZarrParams(VisType v){
     return {3,2,0,4};
   } else if (v == VisType::PCNG ){ // 3D file
     return {0,1,3,3};
+  } else { // OmeTiff is staged as a Viv pyramid
+    return {4,3,1,5};
   }
 }
 
+// Restricts `transform` to a block of channels and a y/x region, and returns it
+// as a 3D (c, y, x) view so that a whole channel block is read or written at once.
+tensorstore::IndexTransform<> GetChannelBlockTransform( tensorstore::IndexTransform<> transform, VisType v,
+                                                        std::int64_t c_start, std::int64_t c_size,
+                                                        std::int64_t y_start, std::int64_t y_size,
+                                                        std::int64_t x_start, std::int64_t x_size);
+
+// Returns true when all the bytes are zero, i.e. the data is equal to the fill value of the
+// chunked outputs. Such chunks are not written and readers get the fill value for them.
+inline bool IsZeroFilled(const void* data, std::size_t num_bytes){
+  auto bytes = static_cast<const unsigned char*>(data);
+  return std::all_of(bytes, bytes+num_bytes, [](unsigned char b){return b == 0;});
+}
+
 std::optional<std::tuple<std::uint32_t, std::uint32_t>> GetTiffDims (const std::string filename);
 } // ns argolid
\ No newline at end of file
@@ -1,6 +1,9 @@
 from .pyramid_generator import PyramidGenerartor, PyramidView, PlateVisualizationMetadata, Downsample
 from .pyramid_compositor import PyramidCompositor
 from .volume_generator import VolumeGenerator, PyramidGenerator3D
+from .dedup import deduplicate_chunks
+from .kvstore import commit_kvstore
+from .tile_server import TileServer, generate_viewer_trace, replay_trace
 
 from . import _version
 
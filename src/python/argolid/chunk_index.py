@@ -0,0 +1,182 @@
+from pathlib import Path
+import contextlib
+import os
+from typing import Dict, Iterable, Iterator, Tuple
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+LOCK_FILE_NAME: str = ".lock"
+FINGERPRINT_FILE_NAME: str = "composition"
+
+
+@contextlib.contextmanager
+def _file_lock(lock_path: Path, exclusive: bool = True) -> Iterator[None]:
+    """
+    Holds a lock on a file, shared by all the processes on the machine.
+
+    Args:
+        lock_path (Path): The path to the lock file.
+        exclusive (bool, optional): Take an exclusive lock for writing instead of a shared
+            lock for reading. Windows only has exclusive locks. Defaults to True.
+    """
+    with open(lock_path, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class ChunkIndex:
+    """
+    An on-disk index of the chunks of a composed pyramid that have been written.
+
+    The index keeps one bitmap file per level and channel, with one bit per chunk. Updates
+    are done under an exclusive file lock and reads under a shared one, so that several
+    processes serving the same pyramid can share it. The index is tied to a composition
+    fingerprint and is cleared when the pyramid is composed differently.
+    """
+
+    def __init__(
+        self,
+        index_dir: str,
+        fingerprint: str,
+        chunk_grid: Dict[int, Tuple[int, int]],
+        num_channels: int,
+    ) -> None:
+        """
+        Opens the index, creating it or clearing it if it does not match the composition.
+
+        Args:
+            index_dir (str): The directory of the index.
+            fingerprint (str): The fingerprint of the composition.
+            chunk_grid (dict): The number of chunk rows and columns of every level.
+            num_channels (int): The number of channels.
+        """
+        self._index_dir: Path = Path(index_dir)
+        self._chunk_grid: Dict[int, Tuple[int, int]] = chunk_grid
+        self._num_channels: int = num_channels
+
+        self._index_dir.mkdir(parents=True, exist_ok=True)
+        fingerprint_file = self._index_dir / FINGERPRINT_FILE_NAME
+        with _file_lock(self._index_dir / LOCK_FILE_NAME):
+            is_current = (
+                fingerprint_file.exists() and fingerprint_file.read_text() == fingerprint
+            )
+            for level, (num_rows, num_cols) in chunk_grid.items():
+                num_bytes = (num_rows * num_cols + 7) // 8
+                for channel in range(num_channels):
+                    bitmap_file = self._bitmap_file(level, channel)
+                    if not is_current or not bitmap_file.exists():
+                        bitmap_file.write_bytes(bytes(num_bytes))
+            fingerprint_file.write_text(fingerprint)
+
+    def _bitmap_file(self, level: int, channel: int) -> Path:
+        """
+        Returns the path to the bitmap of a level and channel.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+        """
+        return self._index_dir / f"{level}.{channel}"
+
+    def _bit_position(self, level: int, y_index: int, x_index: int) -> Tuple[int, int]:
+        """
+        Returns the byte offset and the bit mask of a chunk in its bitmap.
+
+        Args:
+            level (int): The level of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        bit = y_index * self._chunk_grid[level][1] + x_index
+        return bit // 8, 1 << (bit % 8)
+
+    def contains(self, level: int, channel: int, y_index: int, x_index: int) -> bool:
+        """
+        Returns True if the chunk has been written.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        offset, mask = self._bit_position(level, y_index, x_index)
+        # the shared lock keeps the read from seeing a bitmap that is being reset for a new
+        # composition
+        with _file_lock(self._index_dir / LOCK_FILE_NAME, exclusive=False):
+            with open(self._bitmap_file(level, channel), "rb") as f:
+                f.seek(offset)
+                value = f.read(1)
+        return len(value) == 1 and bool(value[0] & mask)
+
+    def set_fingerprint(self, fingerprint: str) -> None:
+        """
+        Ties the index to a new composition without clearing it.
+
+        This is used after the chunks that differ between the compositions are removed.
+
+        Args:
+            fingerprint (str): The fingerprint of the new composition.
+        """
+        with _file_lock(self._index_dir / LOCK_FILE_NAME):
+            (self._index_dir / FINGERPRINT_FILE_NAME).write_text(fingerprint)
+
+    def remove(self, level: int, channels: Iterable[int], y_index: int, x_index: int) -> None:
+        """
+        Records that a chunk has to be written again.
+
+        Args:
+            level (int): The level of the pyramid.
+            channels (Iterable[int]): The channels stored in the chunk.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        self._update_bit(level, channels, y_index, x_index, False)
+
+    def add(self, level: int, channels: Iterable[int], y_index: int, x_index: int) -> None:
+        """
+        Records a written chunk.
+
+        Args:
+            level (int): The level of the pyramid.
+            channels (Iterable[int]): The channels stored in the chunk.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        self._update_bit(level, channels, y_index, x_index, True)
+
+    def _update_bit(
+        self, level: int, channels: Iterable[int], y_index: int, x_index: int, is_set: bool
+    ) -> None:
+        """
+        Sets or clears the bit of a chunk in the bitmaps of its channels.
+
+        Args:
+            level (int): The level of the pyramid.
+            channels (Iterable[int]): The channels stored in the chunk.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+            is_set (bool): Set the bit instead of clearing it.
+        """
+        offset, mask = self._bit_position(level, y_index, x_index)
+        with _file_lock(self._index_dir / LOCK_FILE_NAME):
+            for channel in channels:
+                with open(self._bitmap_file(level, channel), "r+b") as f:
+                    f.seek(offset)
+                    value = f.read(1)[0]
+                    f.seek(offset)
+                    f.write(bytes([value | mask if is_set else value & ~mask]))
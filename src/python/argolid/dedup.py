@@ -0,0 +1,152 @@
+from pathlib import Path
+import argparse
+import concurrent.futures
+import json
+import hashlib
+import os
+import shutil
+from typing import Dict, List, Optional
+
+# files that describe the arrays rather than hold chunk data
+METADATA_FILES = {".zarray", ".zattrs", ".zgroup", ".zmetadata", "info", "METADATA.ome.xml"}
+
+BLOB_DIR_NAME: str = ".blobs"
+
+
+def _hash_file(file_path: Path) -> str:
+    """
+    Returns the content hash of a file.
+
+    Args:
+        file_path (Path): The path to the file.
+
+    Returns:
+        str: The hex digest of the file contents.
+    """
+    with open(file_path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=20).hexdigest()
+
+
+def _link(target: Path, link_path: Path, use_symlinks: bool) -> None:
+    """
+    Atomically replaces link_path with a link to target.
+
+    Args:
+        target (Path): The blob to link to.
+        link_path (Path): The chunk file to replace.
+        use_symlinks (bool): Use a symlink instead of a hardlink.
+    """
+    tmp_path = link_path.with_name(link_path.name + ".dedup_tmp")
+    if use_symlinks:
+        os.symlink(os.path.relpath(target, link_path.parent), tmp_path)
+    else:
+        os.link(target, tmp_path)
+    os.replace(tmp_path, link_path)
+
+
+def deduplicate_chunks(
+    pyramid_dir: str,
+    blob_dir: Optional[str] = None,
+    use_symlinks: bool = False,
+    max_workers: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    Compacts a finished pyramid by storing each unique encoded chunk once.
+
+    This is an offline pass over a pyramid that has already been written; it does not
+    change how the generators write chunks, and it should not run while a pyramid is
+    still being written. Every chunk file is hashed, and each unique content is kept once
+    as a blob in a content addressed store. The chunk files are replaced with hardlinks
+    (or symlinks) to their blob, so readers using the file kvstore keep working unchanged.
+    Blank wells, saturated regions and repeated control images then cost one blob each.
+
+    Args:
+        pyramid_dir (str): The root directory of the pyramid.
+        blob_dir (str, optional): The directory of the content addressed store. Defaults to
+            a `.blobs` directory inside pyramid_dir. Hardlinks require it to be on the same
+            filesystem as the pyramid.
+        use_symlinks (bool, optional): Link chunks to blobs with symlinks instead of hardlinks.
+            Defaults to False.
+        max_workers (int, optional): The number of threads used for hashing. Defaults to
+            half of the available CPUs.
+
+    Returns:
+        dict: The number of chunk files, the number of unique blobs and the bytes saved.
+    """
+    root = Path(pyramid_dir)
+    blob_root = Path(blob_dir) if blob_dir is not None else root / BLOB_DIR_NAME
+    blob_root.mkdir(parents=True, exist_ok=True)
+
+    chunk_files: List[Path] = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        if Path(dir_path) == blob_root:
+            dir_names.clear()
+            continue
+        # hidden directories, such as the compositor chunk index, hold mutable bookkeeping
+        dir_names[:] = [
+            d for d in dir_names if Path(dir_path) / d != blob_root and not d.startswith(".")
+        ]
+        for file_name in file_names:
+            file_path = Path(dir_path) / file_name
+            if file_name in METADATA_FILES or file_path.is_symlink():
+                continue
+            chunk_files.append(file_path)
+
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 2) // 2)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        digests = list(executor.map(_hash_file, chunk_files))
+
+    stats = {"chunks": len(chunk_files), "unique_chunks": 0, "bytes_saved": 0}
+    seen = set()
+    for file_path, digest in zip(chunk_files, digests):
+        blob_path = blob_root / digest[:2] / digest
+        if digest not in seen:
+            seen.add(digest)
+            stats["unique_chunks"] += 1
+        if blob_path.exists():
+            already_linked = os.path.samefile(blob_path, file_path)
+            if already_linked and not use_symlinks:
+                continue
+            if not already_linked:
+                stats["bytes_saved"] += file_path.stat().st_size
+            _link(blob_path, file_path, use_symlinks)
+        else:
+            blob_path.parent.mkdir(exist_ok=True)
+            if use_symlinks:
+                shutil.move(str(file_path), str(blob_path))
+                _link(blob_path, file_path, use_symlinks)
+            else:
+                os.link(file_path, blob_path)
+
+    return stats
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    """
+    Command line entry point of the offline chunk deduplication pass.
+
+    Args:
+        args (list, optional): The command line arguments. Defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(
+        prog="argolid-dedup",
+        description="Store each unique chunk of a finished pyramid once.",
+    )
+    parser.add_argument("pyramid_dir", help="The root directory of the pyramid.")
+    parser.add_argument("--blob-dir", default=None, help="The directory of the blob store.")
+    parser.add_argument(
+        "--symlinks", action="store_true", help="Link chunks to blobs with symlinks."
+    )
+    parser.add_argument(
+        "--max-workers", type=int, default=None, help="The number of hashing threads."
+    )
+    parsed = parser.parse_args(args)
+    stats = deduplicate_chunks(
+        parsed.pyramid_dir, parsed.blob_dir, parsed.symlinks, parsed.max_workers
+    )
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+from typing import Any, Dict, Optional, Union
+import shutil
+
+import tensorstore as ts
+
+# A storage location is either a local path, a kvstore URL such as "memory://plate/",
+# "file:///data/plate" or "s3://bucket/plate", or a tensorstore kvstore spec.
+Location = Union[str, Dict[str, Any]]
+
+
+def get_kvstore_spec(location: Location) -> Union[str, Dict[str, Any]]:
+    """
+    Returns the tensorstore kvstore spec for a storage location.
+
+    Args:
+        location (str | dict): A local path, a kvstore URL or a kvstore spec.
+
+    Returns:
+        str | dict: A kvstore spec that can be used as the "kvstore" member of a TensorStore spec.
+    """
+    if isinstance(location, dict):
+        return location
+    if "://" in location:
+        return location
+    return {"driver": "file", "path": location}
+
+
+def join_location(location: Location, *parts: str) -> Location:
+    """
+    Appends path components to a storage location.
+
+    Args:
+        location (str | dict): A local path, a kvstore URL or a kvstore spec.
+        *parts (str): The path components to append.
+
+    Returns:
+        str | dict: The location of the joined path, of the same kind as location.
+    """
+    suffix = "/".join(str(p).strip("/") for p in parts)
+    if isinstance(location, dict):
+        joined = dict(location)
+        base = joined.get("path", "")
+        joined["path"] = f"{base.rstrip('/')}/{suffix}" if base else suffix
+        return joined
+    if location.endswith("://"):
+        # the root of a kvstore URL, such as "memory://"
+        return f"{location}{suffix}"
+    return f"{location.rstrip('/')}/{suffix}"
+
+
+def is_local(location: Location) -> bool:
+    """
+    Returns True if the location is on the local filesystem.
+
+    Args:
+        location (str | dict): A local path, a kvstore URL or a kvstore spec.
+    """
+    if isinstance(location, dict):
+        return location.get("driver") == "file"
+    return "://" not in location or location.startswith("file://")
+
+
+def local_path(location: Location) -> str:
+    """
+    Returns the filesystem path of a local location.
+
+    Args:
+        location (str | dict): A local path, a file:// URL or a file kvstore spec.
+    """
+    if isinstance(location, dict):
+        return location["path"]
+    if location.startswith("file://"):
+        return location[len("file://"):]
+    return location
+
+
+def open_kvstore(location: Location, context: Optional[ts.Context] = None) -> ts.KvStore:
+    """
+    Opens the kvstore of a storage location, with keys relative to the location.
+
+    Args:
+        location (str | dict): A local path, a kvstore URL or a kvstore spec.
+        context (ts.Context, optional): The context to open the kvstore with. A shared context
+            is required to see the contents of a "memory://" location across opens.
+
+    Returns:
+        ts.KvStore: The opened kvstore.
+    """
+    spec = get_kvstore_spec(join_location(location, ""))
+    if context is None:
+        return ts.KvStore.open(spec).result()
+    return ts.KvStore.open(spec, context=context).result()
+
+
+def write_kvstore_file(
+    location: Location, key: str, data: Union[str, bytes], context: Optional[ts.Context] = None
+) -> None:
+    """
+    Writes a small file, such as a metadata file, to a storage location.
+
+    Args:
+        location (str | dict): A local path, a kvstore URL or a kvstore spec.
+        key (str): The key of the file, relative to location.
+        data (str | bytes): The file contents.
+        context (ts.Context, optional): The context to open the kvstore with.
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    open_kvstore(location, context).write(key, data).result()
+
+
+def read_kvstore_file(
+    location: Location, key: str, context: Optional[ts.Context] = None
+) -> Optional[bytes]:
+    """
+    Reads a small file, such as a metadata file, from a storage location.
+
+    Args:
+        location (str | dict): A local path, a kvstore URL or a kvstore spec.
+        key (str): The key of the file, relative to location.
+        context (ts.Context, optional): The context to open the kvstore with.
+
+    Returns:
+        bytes | None: The file contents, or None if the file does not exist.
+    """
+    result = open_kvstore(location, context).read(key).result()
+    if result.state != "value":
+        return None
+    return bytes(result.value)
+
+
+def delete_location(location: Location, context: Optional[ts.Context] = None) -> None:
+    """
+    Deletes everything under a storage location.
+
+    Args:
+        location (str | dict): A local path, a kvstore URL or a kvstore spec.
+        context (ts.Context, optional): The context to open the kvstore with.
+    """
+    if is_local(location):
+        shutil.rmtree(local_path(location), ignore_errors=True)
+    else:
+        open_kvstore(location, context).delete_range(ts.KvStore.KeyRange()).result()
+
+
+def commit_kvstore(
+    source: Location,
+    destination: Location,
+    source_context: Optional[ts.Context] = None,
+    destination_context: Optional[ts.Context] = None,
+    max_in_flight: int = 64,
+) -> int:
+    """
+    Copies every key of a storage location to another storage location.
+
+    This is used to bulk-commit a pyramid that was staged in memory or on fast local
+    storage to its final, possibly slow or remote, destination.
+
+    Args:
+        source (str | dict): The staging location.
+        destination (str | dict): The final location.
+        source_context (ts.Context, optional): The context of the source kvstore.
+        destination_context (ts.Context, optional): The context of the destination kvstore.
+        max_in_flight (int, optional): The maximum number of pending copies. Defaults to 64.
+
+    Returns:
+        int: The number of copied keys.
+
+    Raises:
+        KeyError: If a listed key is removed from the source before it is copied.
+    """
+    source_store = open_kvstore(source, source_context)
+    destination_store = open_kvstore(destination, destination_context)
+    keys = source_store.list().result()
+    for start in range(0, len(keys), max_in_flight):
+        batch = keys[start : start + max_in_flight]
+        reads = [source_store.read(key) for key in batch]
+        writes = []
+        for key, read in zip(batch, reads):
+            result = read.result()
+            if result.state != "value":
+                raise KeyError(
+                    f"{key.decode()} was removed from the staging location before it was committed"
+                )
+            writes.append(destination_store.write(key, result.value))
+        for write in writes:
+            write.result()
+    return len(keys)
@@ -0,0 +1,148 @@
+from collections import OrderedDict
+import logging
+import threading
+from typing import Callable, List, Tuple
+
+ChunkKey = Tuple[int, int, int, int]
+
+logger = logging.getLogger(__name__)
+
+
+def predict_chunks(level: int, channel: int, y_index: int, x_index: int) -> List[ChunkKey]:
+    """
+    Returns the chunks a viewer is likely to request after the given chunk.
+
+    These are the eight neighbours at the same level, the parent chunk at the next lower
+    resolution and the four child chunks at the next higher resolution, in decreasing
+    order of likelihood. Some of them may be outside of the pyramid.
+
+    Args:
+        level (int): The level of the pyramid.
+        channel (int): The channel of the pyramid.
+        y_index (int): The y-index of the tile.
+        x_index (int): The x-index of the tile.
+
+    Returns:
+        list: The (level, channel, y_index, x_index) of the predicted chunks.
+    """
+    predicted = [
+        (level, channel, y_index + dy, x_index + dx)
+        for dy, dx in [(0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+    ]
+    predicted.append((level + 1, channel, y_index // 2, x_index // 2))
+    if level > 0:
+        predicted.extend(
+            (level - 1, channel, 2 * y_index + dy, 2 * x_index + dx)
+            for dy in range(2)
+            for dx in range(2)
+        )
+    return [(l, c, y, x) for l, c, y, x in predicted if y >= 0 and x >= 0]
+
+
+class ChunkPrefetcher:
+    """
+    Generates the chunks predicted from viewer requests in background threads.
+
+    Predicted chunks are only generated while no request is being served. At most `budget`
+    predictions are pending, the most recent ones are generated first, and the pending
+    predictions are dropped when a request is neither at the previous position nor at one of
+    the predicted positions, which happens when the viewer jumps elsewhere.
+    """
+
+    def __init__(self, budget: int, num_workers: int = 2) -> None:
+        """
+        Starts the prefetching threads.
+
+        Args:
+            budget (int): The maximum number of pending predicted chunks.
+            num_workers (int, optional): The number of prefetching threads. Defaults to 2.
+        """
+        if budget < 1:
+            raise ValueError("budget must be positive")
+        if num_workers < 1:
+            raise ValueError("num_workers must be positive")
+        self._budget: int = budget
+        self._condition: threading.Condition = threading.Condition()
+        self._pending: OrderedDict = OrderedDict()
+        self._predicted: set = set()
+        self._active_requests: int = 0
+        self._closed: bool = False
+        self._workers: List[threading.Thread] = [
+            threading.Thread(target=self._run, daemon=True) for _ in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def begin_request(self) -> None:
+        """
+        Pauses prefetching while a request is served.
+        """
+        with self._condition:
+            self._active_requests += 1
+
+    def end_request(
+        self, chunk: ChunkKey, fetch: Callable[[int, int, int, int], None]
+    ) -> None:
+        """
+        Resumes prefetching and queues the chunks predicted from a served request.
+
+        Args:
+            chunk (tuple): The (level, channel, y_index, x_index) of the served chunk.
+            fetch (Callable): The function that generates a predicted chunk. It is called with
+                the level, channel, y_index and x_index of the chunk and must ignore chunks
+                outside of the pyramid.
+        """
+        with self._condition:
+            self._active_requests -= 1
+            # positions are compared without the channel, since viewers request all the
+            # channels of a tile
+            level, _, y_index, x_index = chunk
+            if self._predicted and (level, y_index, x_index) not in self._predicted:
+                self._pending.clear()
+            predicted = predict_chunks(*chunk)
+            self._predicted = {(l, y, x) for l, _, y, x in predicted}
+            self._predicted.add((level, y_index, x_index))
+            self._pending.pop(chunk, None)
+            # the last queued chunk is generated first
+            for key in reversed(predicted):
+                self._pending.pop(key, None)
+                self._pending[key] = fetch
+            while len(self._pending) > self._budget:
+                self._pending.popitem(last=False)
+            self._condition.notify_all()
+
+    def cancel(self) -> None:
+        """
+        Drops all the pending predicted chunks.
+        """
+        with self._condition:
+            self._pending.clear()
+            self._predicted = set()
+
+    def close(self) -> None:
+        """
+        Drops the pending predicted chunks and stops the prefetching threads.
+        """
+        with self._condition:
+            self._closed = True
+            self._pending.clear()
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self) -> None:
+        """
+        Generates predicted chunks until the prefetcher is closed.
+        """
+        while True:
+            with self._condition:
+                while not self._closed and (not self._pending or self._active_requests > 0):
+                    self._condition.wait()
+                if self._closed:
+                    return
+                chunk, fetch = self._pending.popitem(last=True)
+            try:
+                fetch(*chunk)
+            except Exception:
+                # prefetching is best effort, a failed chunk is generated again when requested
+                logger.warning("Prefetching chunk %s failed", chunk, exc_info=True)
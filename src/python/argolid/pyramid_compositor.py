@@ -1,15 +1,41 @@
+from collections import OrderedDict
+import asyncio
+import concurrent.futures
 from pathlib import Path
+import hashlib
 import json
 import os
 import math
-import shutil
+import threading
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 import ome_types
 import tensorstore as ts
 
+from .chunk_index import ChunkIndex
+from .prefetcher import ChunkPrefetcher
+from .kvstore import (
+    Location,
+    commit_kvstore,
+    delete_location,
+    get_kvstore_spec,
+    is_local,
+    join_location,
+    local_path,
+    open_kvstore,
+    read_kvstore_file,
+    write_kvstore_file,
+)
+
 CHUNK_SIZE: int = 1024
 
+CHUNK_INDEX_DIR_NAME: str = ".chunk_index"
+
+MAX_OPEN_SOURCES: int = 256
+
+HOT_CHUNK_CACHE_BYTES: int = 256 * 1024 * 1024
+
 OME_DTYPE = {
     "uint8": ome_types.model.PixelType.UINT8,
     "int8": ome_types.model.PixelType.INT8,
@@ -22,59 +48,74 @@ OME_DTYPE = {
 }
 
 
-def get_zarr_read_spec(file_path: str) -> dict:
+def get_zarr_context_spec() -> dict:
+    """
+    Returns a dictionary containing the context resources used to read and write Zarr files.
+
+    Returns:
+        dict: A dictionary containing the context specification.
+    """
+    # half of the CPUs, and at least one on a single CPU machine
+    concurrency_limit = max(1, (os.cpu_count() or 1) // 2)
+    return {
+        "cache_pool": {},
+        "data_copy_concurrency": {"limit": concurrency_limit},
+        "file_io_concurrency": {"limit": concurrency_limit},
+        "file_io_sync": False,
+    }
+
+
+def get_zarr_read_spec(file_path: Location, include_context: bool = True) -> dict:
     """
     Returns a dictionary containing the specification for reading a Zarr file.
 
     Args:
-        file_path (str): The path to the Zarr file.
+        file_path (str | dict): The path, kvstore URL or kvstore spec of the Zarr file.
+        include_context (bool, optional): Include a private context in the specification.
+            Leave it out to open the file with a shared context. Defaults to True.
 
     Returns:
         dict: A dictionary containing the specification for reading the Zarr file.
     """
-    return {
+    spec = {
         "driver": "zarr",
-        "kvstore": {
-            "driver": "file",
-            "path": file_path,
-        },
+        "kvstore": get_kvstore_spec(file_path),
         "open": True,
-        "context": {
-            "cache_pool": {},
-            "data_copy_concurrency": {"limit": os.cpu_count() // 2},
-            "file_io_concurrency": {"limit": os.cpu_count() // 2},
-            "file_io_sync": False,
-        },
     }
+    if include_context:
+        spec["context"] = get_zarr_context_spec()
+    return spec
 
 
 def get_zarr_write_spec(
-    file_path: str, chunk_size: int, base_shape: tuple, dtype: str
+    file_path: Location,
+    chunk_size: int,
+    base_shape: tuple,
+    dtype: str,
+    channel_chunk_size: int = 1,
 ) -> dict:
     """
     Returns a dictionary containing the specification for writing a Zarr file.
 
     Args:
-        file_path (str): The path to the Zarr file.
+        file_path (str | dict): The path, kvstore URL or kvstore spec of the Zarr file.
         chunk_size (int): The size of the chunks in the Zarr file.
         base_shape (tuple): The base shape of the Zarr file.
         dtype (str): The data type of the Zarr file.
+        channel_chunk_size (int, optional): The number of channels stored in a chunk. Defaults to 1.
 
     Returns:
         dict: A dictionary containing the specification for writing the Zarr file.
     """
     return {
         "driver": "zarr",
-        "kvstore": {
-            "driver": "file",
-            "path": file_path,
-        },
+        "kvstore": get_kvstore_spec(file_path),
         "create": True,
         "delete_existing": False,
         "open": True,
         "metadata": {
             "shape": base_shape,
-            "chunks": [1, 1, 1, chunk_size, chunk_size],
+            "chunks": [1, channel_chunk_size, 1, chunk_size, chunk_size],
             "dtype": np.dtype(dtype).str,
             "compressor": {
                 "id": "blosc",
@@ -84,39 +125,198 @@ def get_zarr_write_spec(
                 "blocksize": 0,
             },
         },
-        "context": {
-            "cache_pool": {},
-            "data_copy_concurrency": {"limit": os.cpu_count() // 2},
-            "file_io_concurrency": {"limit": os.cpu_count() // 2},
-            "file_io_sync": False,
-        },
+        "context": get_zarr_context_spec(),
     }
 
 
+def get_axis_slice_plan(
+    extent: int, unit_size: int, chunk_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits an axis of the assembled image at the unit image and chunk boundaries.
+
+    Every segment lies within one unit image and one chunk. The segments of chunk i are
+    segments[offsets[i] : offsets[i + 1]].
+
+    Args:
+        extent (int): The size of the assembled image along the axis.
+        unit_size (int): The size of a unit image along the axis.
+        chunk_size (int): The size of a chunk along the axis.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The segments, as rows of (unit index, source start,
+            destination start, length), and the offsets of the segments of each chunk.
+    """
+    boundaries = np.union1d(
+        np.union1d(np.arange(0, extent, chunk_size), np.arange(0, extent, unit_size)),
+        [extent],
+    ).astype(np.int64)
+    starts = boundaries[:-1]
+    unit_index = starts // unit_size
+    chunk_index = starts // chunk_size
+    segments = np.stack(
+        [
+            unit_index,
+            starts - unit_index * unit_size,
+            starts - chunk_index * chunk_size,
+            np.diff(boundaries),
+        ],
+        axis=1,
+    )
+    num_chunks = math.ceil(extent / chunk_size)
+    offsets = np.searchsorted(chunk_index, np.arange(num_chunks + 1))
+    return segments, offsets
+
+
+def get_read_groups(regions: List[Tuple[slice, slice]]) -> List[List[int]]:
+    """
+    Groups the regions of an image that can be read together.
+
+    Two groups are merged when the bounding box of the merged group is no larger than the
+    bounding boxes of the two groups together, such as adjacent chunks of a row or a block.
+    Reading the groups over their bounding boxes then reads no more pixels than reading the
+    regions one by one, however sparse the regions are.
+
+    Args:
+        regions (list): The (y slice, x slice) of the regions.
+
+    Returns:
+        list: The indices of the regions of every group.
+    """
+    groups = [
+        ([i], (y.start, y.stop, x.start, x.stop)) for i, (y, x) in enumerate(regions)
+    ]
+
+    def area(box):
+        return (box[1] - box[0]) * (box[3] - box[2])
+
+    is_merged = True
+    while is_merged:
+        is_merged = False
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                box_i, box_j = groups[i][1], groups[j][1]
+                box = (
+                    min(box_i[0], box_j[0]),
+                    max(box_i[1], box_j[1]),
+                    min(box_i[2], box_j[2]),
+                    max(box_i[3], box_j[3]),
+                )
+                if area(box) <= area(box_i) + area(box_j):
+                    groups[i] = (groups[i][0] + groups[j][0], box)
+                    del groups[j]
+                    is_merged = True
+                    break
+            if is_merged:
+                break
+    return [indices for indices, _ in groups]
+
+
 class PyramidCompositor:
     """
     A class for composing a group of pyramid images into an assembled pyramid structure.
+
+    Chunks can be requested from many threads at once. Concurrent requests for the same
+    chunk wait for a single assembly and write. The composition must not be changed while
+    chunks are being requested.
     """
 
     def __init__(
-        self, input_pyramids_loc: str, out_dir: str, output_pyramid_name: str
+        self,
+        input_pyramids_loc: str,
+        out_dir: Location,
+        output_pyramid_name: str,
+        channel_chunk_size: int = 1,
+        context: Optional[ts.Context] = None,
+        max_open_sources: int = MAX_OPEN_SOURCES,
+        hot_chunk_cache_bytes: int = HOT_CHUNK_CACHE_BYTES,
+        persistent_index: bool = True,
+        prefetch_budget: int = 0,
+        prefetch_workers: int = 2,
+        disk_budget_bytes: Optional[int] = None,
     ) -> None:
         """
         Initializes the PyramidCompositor object.
 
         Args:
             input_pyramids_loc (str): The location of the input pyramid images.
-            out_dir (str): The output directory for the composed zarr pyramid file.
+            out_dir (str | dict): The output location for the composed zarr pyramid file. It can
+                be a local directory, a kvstore URL such as "memory://" or "gs://bucket/path",
+                or a tensorstore kvstore spec.
             output_pyramid_name (str): The name of the zarr pyramid file.
+            channel_chunk_size (int, optional): The number of channels stored in an output
+                chunk. All the channels of a chunk are assembled and written together.
+                Defaults to 1.
+            context (ts.Context, optional): The context used to open the output. The pyramid of a
+                "memory://" location lives in this context. Defaults to a new context.
+            max_open_sources (int, optional): The maximum number of input zarr arrays kept
+                open. Defaults to 256.
+            hot_chunk_cache_bytes (int, optional): The memory budget of the chunks kept by
+                `read_zarr_chunk`. Defaults to 256 MiB.
+            persistent_index (bool, optional): Keep an index of the written chunks next to a
+                local output pyramid, so that other processes, and later runs with the same
+                composition, reuse them. Defaults to True.
+            prefetch_budget (int, optional): The maximum number of chunks predicted from the
+                served requests (neighbours, parent and children) that are generated in the
+                background while no request is served. Defaults to 0, no prefetching.
+            prefetch_workers (int, optional): The number of prefetching threads. Defaults to 2.
+            disk_budget_bytes (int, optional): The disk space the chunks written by this
+                compositor may use in a local output pyramid. Over the budget, the least
+                recently used chunks are removed, from the highest resolution level first.
+                Defaults to None, no limit.
         """
+        if channel_chunk_size < 1:
+            raise ValueError("channel_chunk_size must be positive")
+        if max_open_sources < 1:
+            raise ValueError("max_open_sources must be positive")
+        if disk_budget_bytes is not None and not is_local(join_location(out_dir, output_pyramid_name)):
+            raise ValueError("disk_budget_bytes requires a local output directory")
         self._input_pyramids_loc: str = input_pyramids_loc
+        self._channel_chunk_size: int = channel_chunk_size
         self._chunk_cache: set = set()
-        self._output_pyramid_name: str = f"{out_dir}/{output_pyramid_name}"
-        self._ome_metadata_file: str = f"{out_dir}/{output_pyramid_name}/METADATA.ome.xml"
+        self._persistent_index: bool = persistent_index
+        self._chunk_index: Optional[ChunkIndex] = None
+        self._pyramid_name: str = output_pyramid_name
+        self._output_pyramid_name: Location = join_location(out_dir, output_pyramid_name)
+        self._context: ts.Context = context if context is not None else ts.Context()
+        # the input arrays are opened once and share a single context, so that a chunk
+        # request does not reread the array metadata of its sources
+        self._source_context: ts.Context = ts.Context(
+            ts.Context.Spec(get_zarr_context_spec()), self._context
+        )
+        self._max_open_sources: int = max_open_sources
+        self._open_sources: OrderedDict = OrderedDict()
+        self._hot_chunk_cache_bytes: int = hot_chunk_cache_bytes
+        self._hot_chunks: OrderedDict = OrderedDict()
+        self._hot_chunks_size: int = 0
+        # chunks served from memory are encoded by in-memory zarr arrays that mirror the
+        # output arrays, so the bytes are the same as those of the chunk files
+        self._encoder_context: ts.Context = ts.Context()
+        self._chunk_encoders: dict = {}
+        # guards the chunk index, the chunks in flight and the LRU caches
+        self._lock: threading.Lock = threading.Lock()
+        self._in_flight: dict = {}
+        self._prefetcher: Optional[ChunkPrefetcher] = None
+        # the size of the written chunk files of every level, in least recently used order
+        self._disk_budget_bytes: Optional[int] = disk_budget_bytes
+        self._chunk_usage: dict = {}
+        self._disk_usage: int = 0
+        if prefetch_budget > 0:
+            self._prefetcher = ChunkPrefetcher(prefetch_budget, prefetch_workers)
         self._composition_map: dict = None
         self._plate_image_shapes: dict = {}
         self._zarr_arrays: dict = {}
         self._unit_image_shapes: dict = {}
+        self._slice_plans: dict = {}
+        # levels whose output chunks are each a copy of one input chunk, with the kvstore the
+        # encoded chunks are copied to, and the kvstores of the matching inputs
+        self._aligned_levels: dict = {}
+        self._aligned_sources: dict = {}
+        self._virtual_levels: dict = {}
+        # the kvstores of the output levels, and the levels created by this composition, which
+        # hold no chunk of an earlier composition
+        self._output_kvstores: dict = {}
+        self._fresh_levels: set = set()
         self._pyramid_levels: int = None
         self._image_dtype: np.dtype = None
         self._num_channels: int = None
@@ -150,8 +350,12 @@ class PyramidCompositor:
             )
         )
 
-        with open(self._ome_metadata_file, "w") as fw:
-            fw.write(str(ome_metadata.to_xml()))
+        write_kvstore_file(
+            self._output_pyramid_name,
+            "METADATA.ome.xml",
+            str(ome_metadata.to_xml()),
+            self._context,
+        )
 
     def _create_zattr_file(self) -> None:
         """
@@ -163,13 +367,17 @@ class PyramidCompositor:
             multiscale_metadata.append({"path": str(key)})
         attr_dict["datasets"] = multiscale_metadata
         attr_dict["version"] = "0.1"
-        attr_dict["name"] = self._output_pyramid_name
+        attr_dict["name"] = self._pyramid_name
         attr_dict["metadata"] = {"method": "mean"}
 
         final_attr_dict = {"multiscales": [attr_dict]}
 
-        with open(f"{self._output_pyramid_name}/data.zarr/0/.zattrs", "w") as json_file:
-            json.dump(final_attr_dict, json_file)
+        write_kvstore_file(
+            self._output_pyramid_name,
+            "data.zarr/0/.zattrs",
+            json.dumps(final_attr_dict),
+            self._context,
+        )
 
     def _create_zgroup_file(self) -> None:
         """
@@ -177,11 +385,10 @@ class PyramidCompositor:
         """
         zgroup_dict = {"zarr_format": 2}
 
-        with open(f"{self._output_pyramid_name}/data.zarr/0/.zgroup", "w") as json_file:
-            json.dump(zgroup_dict, json_file)
-
-        with open(f"{self._output_pyramid_name}/data.zarr/.zgroup", "w") as json_file:
-            json.dump(zgroup_dict, json_file)
+        for key in ["data.zarr/0/.zgroup", "data.zarr/.zgroup"]:
+            write_kvstore_file(
+                self._output_pyramid_name, key, json.dumps(zgroup_dict), self._context
+            )
 
     def _create_auxilary_files(self) -> None:
         """
@@ -191,80 +398,478 @@ class PyramidCompositor:
         self._create_zattr_file()
         self._create_zgroup_file()
 
-    def _write_zarr_chunk(
-        self, level: int, channel: int, y_index: int, x_index: int
-    ) -> None:
+    def _open_source(self, file_name: str, level: int) -> ts.TensorStore:
         """
-        Writes the chunk file at the specified level, channel, y_index, and x_index.
+        Returns the opened zarr array of an input image at a level.
+
+        The most recently used arrays are kept open.
+
+        Args:
+            file_name (str): The path to the input image.
+            level (int): The level of the pyramid.
+
+        Returns:
+            ts.TensorStore: The opened zarr array.
+        """
+        key = (file_name, level)
+        zarr_file = self._get_open_source(key)
+        if zarr_file is not None:
+            return zarr_file
+
+        zarr_file = self._open_source_future(file_name, level).result()
+        self._add_open_source(key, zarr_file)
+        return zarr_file
+
+    async def _open_source_async(self, file_name: str, level: int) -> ts.TensorStore:
+        """
+        Returns the opened zarr array of an input image at a level, without blocking the
+        event loop.
+
+        Args:
+            file_name (str): The path to the input image.
+            level (int): The level of the pyramid.
+
+        Returns:
+            ts.TensorStore: The opened zarr array.
+        """
+        key = (file_name, level)
+        zarr_file = self._get_open_source(key)
+        if zarr_file is not None:
+            return zarr_file
+
+        zarr_file = await self._open_source_future(file_name, level)
+        self._add_open_source(key, zarr_file)
+        return zarr_file
+
+    def _open_source_future(self, file_name: str, level: int) -> ts.Future:
+        """
+        Starts opening the zarr array of an input image at a level.
 
         Args:
+            file_name (str): The path to the input image.
             level (int): The level of the pyramid.
+
+        Returns:
+            ts.Future: The future of the opened zarr array.
+        """
+        zarr_array_loc = Path(file_name) / "data.zarr/0" / str(level)
+        return ts.open(
+            get_zarr_read_spec(str(zarr_array_loc), include_context=False),
+            context=self._source_context,
+        )
+
+    def _get_open_source(self, key: tuple) -> Optional[ts.TensorStore]:
+        """
+        Returns an already opened input zarr array.
+
+        Args:
+            key (tuple): The (file name, level) of the zarr array.
+
+        Returns:
+            ts.TensorStore | None: The opened zarr array, or None if it is not open.
+        """
+        with self._lock:
+            zarr_file = self._open_sources.get(key)
+            if zarr_file is not None:
+                self._open_sources.move_to_end(key)
+            return zarr_file
+
+    def _add_open_source(self, key: tuple, zarr_file: ts.TensorStore) -> None:
+        """
+        Keeps an opened input zarr array, closing the least recently used one over the limit.
+
+        Args:
+            key (tuple): The (file name, level) of the zarr array.
+            zarr_file (ts.TensorStore): The opened zarr array.
+        """
+        with self._lock:
+            self._open_sources[key] = zarr_file
+            if len(self._open_sources) > self._max_open_sources:
+                self._open_sources.popitem(last=False)
+
+    def _channel_block(self, channel: int) -> range:
+        """
+        Returns the channels that share an output chunk with the given channel.
+
+        Args:
             channel (int): The channel of the pyramid.
+
+        Returns:
+            range: The channels stored in the same chunk.
+        """
+        c_start = (channel // self._channel_chunk_size) * self._channel_chunk_size
+        return range(c_start, min(c_start + self._channel_chunk_size, self._num_channels))
+
+    def _get_chunk_plan(
+        self, level: int, y_index: int, x_index: int
+    ) -> List[Tuple[int, int, slice, slice, slice, slice]]:
+        """
+        Returns the input image regions that make up a chunk.
+
+        Args:
+            level (int): The level of the pyramid.
             y_index (int): The y-index of the tile.
             x_index (int): The x-index of the tile.
+
+        Returns:
+            list: The (col, row, source y slice, source x slice, chunk y slice, chunk x slice)
+                of every unit image that intersects the chunk.
+        """
+        y_segments, y_offsets, x_segments, x_offsets = self._slice_plans[level]
+        plan = []
+        for row, src_y, dst_y, len_y in y_segments[y_offsets[y_index] : y_offsets[y_index + 1]].tolist():
+            for col, src_x, dst_x, len_x in x_segments[x_offsets[x_index] : x_offsets[x_index + 1]].tolist():
+                plan.append(
+                    (
+                        col,
+                        row,
+                        slice(src_y, src_y + len_y),
+                        slice(src_x, src_x + len_x),
+                        slice(dst_y, dst_y + len_y),
+                        slice(dst_x, dst_x + len_x),
+                    )
+                )
+        return plan
+
+    def _get_chunk_ranges(
+        self, level: int, y_index: int, x_index: int
+    ) -> Tuple[List[int], List[int]]:
         """
+        Returns the y and x ranges of a chunk in global coordinates at its level.
 
-        # x_range and y_range are in global coordinates at the corresponding level
+        Args:
+            level (int): The level of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Returns:
+            Tuple[List[int], List[int]]: The [start, end) y and x ranges of the chunk.
+        """
         y_range = [
             y_index * CHUNK_SIZE,
-            min((y_index + 1) * CHUNK_SIZE, self._zarr_arrays[level].shape[3]),
+            min((y_index + 1) * CHUNK_SIZE, self._plate_image_shapes[level][3]),
         ]
         x_range = [
             x_index * CHUNK_SIZE,
-            min((x_index + 1) * CHUNK_SIZE, self._zarr_arrays[level].shape[4]),
+            min((x_index + 1) * CHUNK_SIZE, self._plate_image_shapes[level][4]),
+        ]
+        return y_range, x_range
+
+    def _assemble_zarr_chunk(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> np.ndarray:
+        """
+        Assembles the chunk at the specified level, channel, y_index, and x_index.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Returns:
+            np.ndarray: The (channel, y, x) image of all the channels that share the chunk
+                with `channel`.
+        """
+
+        assembled_image = self._allocate_zarr_chunk(level, channel, y_index, x_index)
+        sources = self._get_chunk_sources(level, channel, y_index, x_index)
+
+        # all the source reads of the chunk are issued before waiting for any of them
+        reads = [
+            self._open_source(input_file_name, level)[0, 0, 0, src_y, src_x].read()
+            for _, input_file_name, src_y, src_x, _, _ in sources
         ]
+        for (c_index, _, _, _, dst_y, dst_x), read in zip(sources, reads):
+            assembled_image[c_index, dst_y, dst_x] = read.result()
+
+        return assembled_image
+
+    async def _assemble_zarr_chunk_async(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> np.ndarray:
+        """
+        Assembles the chunk at the specified level, channel, y_index, and x_index, without
+        blocking the event loop.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Returns:
+            np.ndarray: The (channel, y, x) image of all the channels that share the chunk
+                with `channel`.
+        """
+        assembled_image = self._allocate_zarr_chunk(level, channel, y_index, x_index)
+        sources = self._get_chunk_sources(level, channel, y_index, x_index)
+
+        zarr_files = await asyncio.gather(
+            *[self._open_source_async(input_file_name, level) for _, input_file_name, *_ in sources]
+        )
+        tiles = await asyncio.gather(
+            *[
+                zarr_file[0, 0, 0, src_y, src_x].read()
+                for zarr_file, (_, _, src_y, src_x, _, _) in zip(zarr_files, sources)
+            ]
+        )
+        for (c_index, _, _, _, dst_y, dst_x), tile in zip(sources, tiles):
+            assembled_image[c_index, dst_y, dst_x] = tile
+
+        return assembled_image
+
+    def _allocate_zarr_chunk(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> np.ndarray:
+        """
+        Returns a zero filled image for the chunk at the specified level, channel, y_index,
+        and x_index.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
 
-        assembled_width = x_range[1] - x_range[0]
-        assembled_height = y_range[1] - y_range[0]
-        assembled_image = np.zeros(
-            (assembled_height, assembled_width), dtype=self._image_dtype
+        Returns:
+            np.ndarray: The (channel, y, x) image of the chunk.
+        """
+        # x_range and y_range are in global coordinates at the corresponding level
+        y_range, x_range = self._get_chunk_ranges(level, y_index, x_index)
+        return np.zeros(
+            (len(self._channel_block(channel)), y_range[1] - y_range[0], x_range[1] - x_range[0]),
+            dtype=self._image_dtype,
         )
 
-        # find what input images are needed
-
-        # are we at the begining of the input image?
-        unit_image_height = self._unit_image_shapes[level][0]
-        unit_image_width = self._unit_image_shapes[level][1]
-
-        row_start_pos = y_range[0]
-        while row_start_pos < y_range[1]:
-            # row and col are unit map coordinates
-            row = row_start_pos // unit_image_height
-            # local_y* and local_x* are coordintes in the chunk
-            local_y_start = row_start_pos - y_range[0]
-            tile_y_start = row_start_pos - row * unit_image_height
-            tile_y_dim = min((row + 1) * unit_image_height - row_start_pos, y_range[1] - row_start_pos)
-            tile_y_end = tile_y_start + tile_y_dim
-            col_start_pos = x_range[0]
-            while col_start_pos < x_range[1]:
-                col = col_start_pos // unit_image_width
-                local_x_start = col_start_pos - x_range[0]
-                tile_x_start = col_start_pos - col * unit_image_width
-                tile_x_dim = min((col + 1) * unit_image_width - col_start_pos, x_range[1] - col_start_pos)
-                tile_x_end = tile_x_start + tile_x_dim
-                # read input zarr file
-                input_file_name = self._composition_map.get((col, row, channel))
-                zarr_file_loc = Path(input_file_name) / "data.zarr/0/"
-                zarr_array_loc = zarr_file_loc / str(level)
-                zarr_file = ts.open(get_zarr_read_spec(str(zarr_array_loc))).result()
-
-                # copy data
-                assembled_image[
-                    local_y_start : local_y_start + tile_y_end - tile_y_start,
-                    local_x_start : local_x_start + tile_x_end - tile_x_start,
-                ] = (
-                    zarr_file[0, 0, 0, tile_y_start:tile_y_end, tile_x_start:tile_x_end]
-                    .read()
-                    .result()
+    def _get_chunk_sources(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> List[Tuple[int, str, slice, slice, slice, slice]]:
+        """
+        Returns the input image regions to read for a chunk.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Returns:
+            list: The (channel index in the chunk, input file, source y slice, source x slice,
+                chunk y slice, chunk x slice) of every region. Positions missing from the
+                composition map are the fill value and have no region.
+        """
+        # row and col are unit map coordinates, the source slices are in the unit image
+        # and the chunk slices are in the assembled chunk
+        sources = []
+        for col, row, src_y, src_x, dst_y, dst_x in self._get_chunk_plan(level, y_index, x_index):
+            for c_index, c in enumerate(self._channel_block(channel)):
+                input_file_name = self._composition_map.get((col, row, c))
+                if input_file_name is None:
+                    continue
+                sources.append((c_index, input_file_name, src_y, src_x, dst_y, dst_x))
+        return sources
+
+    def _is_fill_chunk(self, level: int, channel: int, y_index: int, x_index: int) -> bool:
+        """
+        Returns True if the chunk only covers positions missing from the composition map.
+
+        Such a chunk is the fill value, so nothing is read for it, and it is only removed
+        from levels that may hold a chunk of an earlier composition.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        return all(
+            self._composition_map.get((col, row, c)) is None
+            for col, row, *_ in self._get_chunk_plan(level, y_index, x_index)
+            for c in self._channel_block(channel)
+        )
+
+    def _write_zarr_chunk(
+        self,
+        level: int,
+        channel: int,
+        y_index: int,
+        x_index: int,
+        assembled_image: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Writes the chunk file at the specified level, channel, y_index, and x_index.
+
+        All the channels that share the chunk with `channel` are assembled and
+        written together.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+            assembled_image (np.ndarray, optional): The already assembled chunk.
+        """
+        if assembled_image is None:
+            if self._is_fill_chunk(level, channel, y_index, x_index):
+                delete_future = self._start_zarr_chunk_delete(level, channel, y_index, x_index)
+                if delete_future is not None:
+                    delete_future.result()
+                return
+            copy_source = self._get_copy_source(level, channel, y_index, x_index)
+            if copy_source is not None:
+                source_kvstore, source_key, output_key = copy_source
+                encoded_chunk = source_kvstore.read(source_key).result()
+                # a missing input chunk is the fill value, which is not written either
+                if encoded_chunk.state == "value":
+                    self._aligned_levels[level].write(output_key, encoded_chunk.value).result()
+                else:
+                    delete_future = self._start_zarr_chunk_delete(level, channel, y_index, x_index)
+                    if delete_future is not None:
+                        delete_future.result()
+                return
+            assembled_image = self._assemble_zarr_chunk(level, channel, y_index, x_index)
+        write_future = self._start_zarr_chunk_write(level, channel, y_index, x_index, assembled_image)
+        if write_future is not None:
+            write_future.result()
+
+    def _get_copy_source(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> Optional[Tuple[ts.KvStore, str, str]]:
+        """
+        Returns the input chunk whose encoded bytes are the chunk at the specified level,
+        channel, y_index, and x_index.
+
+        This is the case when the unit images are made of whole chunks, every output chunk holds
+        a single channel, and the input array has the same chunk shape and encoding as the
+        output array.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Returns:
+            Tuple[ts.KvStore, str, str] | None: The kvstore of the input array, the key of the
+                input chunk and the key of the output chunk, or None if the chunk has to be
+                assembled.
+        """
+        if level not in self._aligned_levels:
+            return None
+        plan = self._get_chunk_plan(level, y_index, x_index)
+        if len(plan) != 1:
+            return None
+        col, row, src_y, src_x, _, _ = plan[0]
+        file_name = self._composition_map.get((col, row, channel))
+        if file_name is None:
+            return None
+
+        key = (file_name, level)
+        with self._lock:
+            is_known = key in self._aligned_sources
+            source = self._aligned_sources.get(key)
+        if not is_known:
+            source = None
+            source_spec = self._open_source(file_name, level).spec().to_json()
+            source_metadata = source_spec["metadata"]
+            output_metadata = self._zarr_arrays[level].spec().to_json()["metadata"]
+            if all(
+                source_metadata.get(field) == output_metadata.get(field)
+                for field in ["chunks", "compressor", "dtype", "fill_value", "filters", "order"]
+            ):
+                source = (
+                    ts.KvStore.open(
+                        source_spec["kvstore"], context=self._source_context
+                    ).result(),
+                    source_metadata.get("dimension_separator", "."),
                 )
-                col_start_pos += tile_x_end - tile_x_start  # update col index
+            with self._lock:
+                self._aligned_sources[key] = source
+        if source is None:
+            return None
+
+        source_kvstore, separator = source
+        source_key = separator.join(
+            ["0", "0", "0", str(src_y.start // CHUNK_SIZE), str(src_x.start // CHUNK_SIZE)]
+        )
+        return source_kvstore, source_key, f"0.{channel}.0.{y_index}.{x_index}"
+
+    def _start_zarr_chunk_write(
+        self,
+        level: int,
+        channel: int,
+        y_index: int,
+        x_index: int,
+        assembled_image: np.ndarray,
+    ) -> Optional[Union[ts.WriteFutures, ts.Future]]:
+        """
+        Starts writing an assembled chunk to the output pyramid.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+            assembled_image (np.ndarray): The assembled chunk.
+
+        Returns:
+            ts.WriteFutures | ts.Future | None: The futures of the write, or of the removal of
+                a chunk equal to the fill value, or None if nothing is written.
+        """
+        y_range, x_range = self._get_chunk_ranges(level, y_index, x_index)
+        channels = self._channel_block(channel)
 
-            row_start_pos += tile_y_end - tile_y_start
+        # chunks equal to the fill value are not written, readers get the fill value for them
+        if not assembled_image.any():
+            return self._start_zarr_chunk_delete(level, channel, y_index, x_index)
 
         zarr_array = self._zarr_arrays[level]
-        zarr_array[
-            0, channel, 0, y_range[0] : y_range[1], x_range[0] : x_range[1]
-        ].write(assembled_image).result()
+        return zarr_array[
+            0,
+            channels.start : channels.stop,
+            0,
+            y_range[0] : y_range[1],
+            x_range[0] : x_range[1],
+        ].write(assembled_image)
+
+    def _get_output_chunk_key(self, channel: int, y_index: int, x_index: int) -> str:
+        """
+        Returns the key of an output chunk in the kvstore of its level.
+
+        Args:
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        channel_chunk_size = min(self._channel_chunk_size, self._num_channels)
+        return f"0.{channel // channel_chunk_size}.0.{y_index}.{x_index}"
+
+    def _start_zarr_chunk_delete(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> Optional[ts.Future]:
+        """
+        Starts removing a chunk equal to the fill value from the output pyramid.
+
+        Such chunks are not written, but the output may hold the chunk of an earlier
+        composition, which would be served instead of the fill value. Levels created by this
+        composition hold no such chunk, so nothing is removed from them.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Returns:
+            ts.Future | None: The future of the removal, or None if nothing is removed.
+        """
+        if level in self._fresh_levels:
+            return None
+        chunk_key = self._get_output_chunk_key(channel, y_index, x_index)
+        return self._output_kvstores[level].delete_range(
+            ts.KvStore.KeyRange(chunk_key, chunk_key + "\0")
+        )
 
     def set_composition(self, composition_map: dict) -> None:
         """
@@ -277,7 +882,8 @@ class PyramidCompositor:
         self._unit_image_shapes = {}
         for coord in composition_map:
             file = composition_map[coord]
-            zarr_file_loc = Path(file) / "data.zarr/0/"
+            if file is None:
+                continue
             attr_file_loc = Path(file) / "data.zarr/0/.zattrs"
             if attr_file_loc.exists():
                 with open(str(attr_file_loc), "r") as f:
@@ -286,10 +892,7 @@ class PyramidCompositor:
                     self._pyramid_levels = len(mutliscale_metadata)
                     for dic in mutliscale_metadata:
                         res_key = dic["path"]
-                        zarr_array_loc = zarr_file_loc / res_key
-                        zarr_file = ts.open(
-                            get_zarr_read_spec(str(zarr_array_loc))
-                        ).result()
+                        zarr_file = self._open_source(file, int(res_key))
                         self._unit_image_shapes[int(res_key)] = (
                             zarr_file.shape[-2],
                             zarr_file.shape[-1],
@@ -316,7 +919,17 @@ class PyramidCompositor:
 
         self._plate_image_shapes = {}
         self._zarr_arrays = {}
+        self._slice_plans = {}
+        self._aligned_levels = {}
+        self._aligned_sources = {}
+        self._virtual_levels = {}
+        self._output_kvstores = {}
+        self._fresh_levels = set()
         self._chunk_cache = set()
+        self._chunk_usage = {}
+        self._disk_usage = 0
+        self._clear_hot_chunks()
+        chunk_grid = {}
         for l in self._unit_image_shapes:
             level = int(l)
             self._plate_image_shapes[level] = (
@@ -336,48 +949,814 @@ class PyramidCompositor:
                 num_row_tiles = 1
             if num_col_tiles == 0:
                 num_col_tiles == 1
+            chunk_grid[level] = (num_row_tiles, num_col_tiles)
+            self._slice_plans[level] = get_axis_slice_plan(
+                self._plate_image_shapes[level][3], self._unit_image_shapes[level][0], CHUNK_SIZE
+            ) + get_axis_slice_plan(
+                self._plate_image_shapes[level][4], self._unit_image_shapes[level][1], CHUNK_SIZE
+            )
+            level_loc = join_location(self._output_pyramid_name, "data.zarr/0", str(level))
+            if read_kvstore_file(level_loc, ".zarray", self._context) is None:
+                self._fresh_levels.add(level)
             self._zarr_arrays[level] = ts.open(
                 get_zarr_write_spec(
-                    f"{self._output_pyramid_name}/data.zarr/0/{level}",
+                    level_loc,
                     CHUNK_SIZE,
                     self._plate_image_shapes[level],
                     np.dtype(self._image_dtype).str,
-                )
+                    min(self._channel_chunk_size, num_channels),
+                ),
+                context=self._context,
             ).result()
+            self._output_kvstores[level] = open_kvstore(level_loc, self._context)
+            if (
+                self._unit_image_shapes[level][0] % CHUNK_SIZE == 0
+                and self._unit_image_shapes[level][1] % CHUNK_SIZE == 0
+                and min(self._channel_chunk_size, num_channels) == 1
+            ):
+                self._aligned_levels[level] = self._output_kvstores[level]
+
+        self._chunk_index = None
+        if self._persistent_index and is_local(self._output_pyramid_name):
+            self._chunk_index = ChunkIndex(
+                os.path.join(local_path(self._output_pyramid_name), CHUNK_INDEX_DIR_NAME),
+                self._get_composition_fingerprint(),
+                chunk_grid,
+                num_channels,
+            )
 
         self._create_auxilary_files()
 
-    def reset_composition(self) -> None:
+    def _get_composition_fingerprint(self) -> str:
         """
-        Resets the pyramid composition by removing the pyramid file and clearing internal data structures.
+        Returns a fingerprint of the composition, which identifies the content of the chunks.
+
+        Returns:
+            str: The hex digest of the composition map and the output layout.
         """
-        shutil.rmtree(self._output_pyramid_name)
-        self._composition_map = None
-        self._plate_image_shapes = None
-        self._chunk_cache = None
-        self._plate_image_shapes = {}
-        self._zarr_arrays = {}
+        composition = sorted(
+            [list(coord), str(file)] for coord, file in self._composition_map.items()
+        )
+        description = json.dumps(
+            {
+                "composition": composition,
+                "shapes": sorted(self._plate_image_shapes.items()),
+                "chunk_size": CHUNK_SIZE,
+                "channel_chunk_size": self._channel_chunk_size,
+                "dtype": str(np.dtype(self._image_dtype)),
+            }
+        )
+        return hashlib.sha256(description.encode()).hexdigest()
 
-    def get_zarr_chunk(
-        self, level: int, channel: int, y_index: int, x_index: int
-    ) -> None:
+    def update_composition(self, composition_map: dict) -> None:
         """
-        Retrieves zarr chunk data from the pyramid at the specified level, channel, y_index, and x_index.
+        Changes the composition of the pyramid, keeping the chunks that are not affected.
 
-        This method checks if the requested zarr chunk is already in the cache. If not, it calls
-        the `_write_zarr_chunk` method to generate the chunk and add it to the cache.
+        The old and new composition maps are compared, and only the output chunks that
+        overlap a changed position, at every level, are removed and written again when they
+        are requested. If the layout of the plate, or the shape or data type of the images,
+        changes, the pyramid is composed from scratch.
 
         Args:
-            level (int): The level of the pyramid.
-            channel (int): The channel of the pyramid.
-            y_index (int): The y-index of the tile.
-            x_index (int): The x-index of the tile.
+            composition_map (dict): A dictionary mapping composition images to file paths.
+        """
+        if self._composition_map is None:
+            self.set_composition(composition_map)
+            return
 
-        Raises:
+        old_composition_map = self._composition_map
+        grid_shape = [max(coord[i] for coord in composition_map) + 1 for i in range(3)]
+        old_grid_shape = [max(coord[i] for coord in old_composition_map) + 1 for i in range(3)]
+        changed_positions = {
+            coord
+            for coord in set(old_composition_map) | set(composition_map)
+            if old_composition_map.get(coord) != composition_map.get(coord)
+        }
+        if grid_shape != old_grid_shape or not all(
+            self._matches_unit_image(composition_map[coord])
+            for coord in changed_positions
+            if composition_map.get(coord) is not None
+        ):
+            self.reset_composition()
+            self.set_composition(composition_map)
+            return
+
+        self.cancel_prefetch()
+        self._composition_map = composition_map
+        with self._lock:
+            self._virtual_levels = {}
+
+        stale_chunks = set()
+        for level, (unit_height, unit_width) in self._unit_image_shapes.items():
+            for col, row, c in changed_positions:
+                channel_start = self._channel_block(c).start
+                for y_index in range(
+                    row * unit_height // CHUNK_SIZE, math.ceil((row + 1) * unit_height / CHUNK_SIZE)
+                ):
+                    for x_index in range(
+                        col * unit_width // CHUNK_SIZE, math.ceil((col + 1) * unit_width / CHUNK_SIZE)
+                    ):
+                        stale_chunks.add((level, channel_start, y_index, x_index))
+        self._invalidate_zarr_chunks(stale_chunks)
+
+        if self._chunk_index is not None:
+            self._chunk_index.set_fingerprint(self._get_composition_fingerprint())
+
+    def _matches_unit_image(self, file: str) -> bool:
+        """
+        Checks that an image has the levels, shapes and data type of the composed images.
+
+        Args:
+            file (str): The path of the image.
+
+        Returns:
+            bool: Whether the image can replace a composed image.
+        """
+        attr_file_loc = Path(file) / "data.zarr/0/.zattrs"
+        if attr_file_loc.exists():
+            with open(str(attr_file_loc), "r") as f:
+                attrs = json.load(f)
+            levels = {int(dic["path"]) for dic in attrs["multiscales"][0]["datasets"]}
+            if levels != set(self._unit_image_shapes):
+                return False
+        for level, unit_image_shape in self._unit_image_shapes.items():
+            zarr_file = self._open_source(file, level)
+            if (zarr_file.shape[-2], zarr_file.shape[-1]) != unit_image_shape:
+                return False
+            if level == 0 and zarr_file.dtype.numpy_dtype != self._image_dtype:
+                return False
+        return True
+
+    def _invalidate_zarr_chunks(self, chunks: Iterable[Tuple[int, int, int, int]]) -> None:
+        """
+        Removes chunks from the output pyramid, so that they are written again when requested.
+
+        Args:
+            chunks (Iterable[tuple]): The (level, channel, y_index, x_index) of the chunks.
+        """
+        delete_futures = []
+        for level, channel, y_index, x_index in chunks:
+            channels = self._channel_block(channel)
+            with self._lock:
+                level_usage = self._chunk_usage.get(level)
+                if level_usage is not None:
+                    self._disk_usage -= level_usage.pop(
+                        (level, channels.start, y_index, x_index), 0
+                    )
+                for c in channels:
+                    self._chunk_cache.discard((level, c, y_index, x_index))
+                for encoded in [False, True]:
+                    hot_chunk = self._hot_chunks.pop(
+                        (level, channels.start, y_index, x_index, encoded), None
+                    )
+                    if hot_chunk is not None:
+                        self._hot_chunks_size -= (
+                            hot_chunk.nbytes if isinstance(hot_chunk, np.ndarray) else len(hot_chunk)
+                        )
+            if self._chunk_index is not None:
+                self._chunk_index.remove(level, channels, y_index, x_index)
+
+            chunk_key = self._get_output_chunk_key(channels.start, y_index, x_index)
+            delete_futures.append(
+                self._output_kvstores[level].delete_range(
+                    ts.KvStore.KeyRange(chunk_key, chunk_key + "\0")
+                )
+            )
+        for future in delete_futures:
+            future.result()
+
+    def reset_composition(self) -> None:
+        """
+        Resets the pyramid composition by removing the pyramid file and clearing internal data structures.
+        """
+        self.cancel_prefetch()
+        delete_location(self._output_pyramid_name, self._context)
+        self._composition_map = None
+        self._plate_image_shapes = None
+        self._chunk_cache = None
+        self._chunk_index = None
+        self._chunk_usage = {}
+        self._disk_usage = 0
+        self._plate_image_shapes = {}
+        self._zarr_arrays = {}
+        self._slice_plans = {}
+        self._aligned_levels = {}
+        self._aligned_sources = {}
+        self._virtual_levels = {}
+        self._output_kvstores = {}
+        self._fresh_levels = set()
+        self._open_sources = OrderedDict()
+        self._clear_hot_chunks()
+
+    def get_zarr_chunk(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> None:
+        """
+        Retrieves zarr chunk data from the pyramid at the specified level, channel, y_index, and x_index.
+
+        This method checks if the requested zarr chunk is already in the cache. If not, it calls
+        the `_write_zarr_chunk` method to generate the chunk and add it to the cache.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Raises:
             ValueError: If the composition map is not set, the requested level does not exist,
                 the requested channel does not exist, or the requested y_index or x_index
                 is out of bounds.
         """
+        self._check_chunk_request(level, channel, y_index, x_index)
+        if self._prefetcher is None:
+            self._generate_zarr_chunk(level, channel, y_index, x_index)
+            return
+        self._prefetcher.begin_request()
+        try:
+            self._generate_zarr_chunk(level, channel, y_index, x_index)
+        finally:
+            self._prefetcher.end_request((level, channel, y_index, x_index), self._prefetch_zarr_chunk)
+
+    def get_zarr_chunks(self, chunks: List[Tuple[int, int, int, int]]) -> None:
+        """
+        Retrieves a batch of zarr chunks, such as all the channels of a tile or a row of
+        neighbouring tiles.
+
+        The requests are grouped by input image, so that the regions of an input image that
+        tile a larger region, such as a row of neighbouring chunks, are read with one read, and
+        the adjacent chunks of a row are written together.
+
+        Args:
+            chunks (list): The (level, channel, y_index, x_index) of the chunks. Channels that
+                share a chunk are only generated once.
+
+        Raises:
+            ValueError: If the composition map is not set or a chunk does not exist.
+        """
+        for chunk in chunks:
+            self._check_chunk_request(*chunk)
+        if len(chunks) == 0:
+            return
+        if self._prefetcher is None:
+            self._generate_zarr_chunks(chunks)
+            return
+        self._prefetcher.begin_request()
+        try:
+            self._generate_zarr_chunks(chunks)
+        finally:
+            self._prefetcher.end_request(tuple(chunks[-1]), self._prefetch_zarr_chunk)
+
+    def _generate_zarr_chunks(self, chunks: List[Tuple[int, int, int, int]]) -> None:
+        """
+        Writes the chunks of a batch that are not written yet, and waits for the ones that
+        other requests are writing.
+
+        Args:
+            chunks (list): The (level, channel, y_index, x_index) of the chunks.
+        """
+        unique_chunks = {}
+        for level, channel, y_index, x_index in chunks:
+            key = (level, self._channel_block(channel).start, y_index, x_index)
+            unique_chunks.setdefault(key, key)
+        owned_chunks = {}
+        waited_futures = []
+        for key in unique_chunks:
+            future, is_owner = self._claim_zarr_chunk(*key)
+            if is_owner:
+                owned_chunks[key] = future
+            elif future is not None:
+                waited_futures.append(future)
+
+        try:
+            self._write_zarr_chunks(list(owned_chunks))
+        except BaseException as e:
+            for key, future in owned_chunks.items():
+                self._release_zarr_chunk(*key, future, e)
+            raise
+        for key, future in owned_chunks.items():
+            self._release_zarr_chunk(*key, future)
+        for future in waited_futures:
+            future.result()
+
+    def _write_zarr_chunks(self, chunks: List[Tuple[int, int, int, int]]) -> None:
+        """
+        Writes a batch of chunks, reading every input image once.
+
+        Args:
+            chunks (list): The (level, first channel, y_index, x_index) of the chunks.
+        """
+        assembled_images = {}
+        copy_reads = []
+        write_futures = []
+        for key in chunks:
+            if self._is_fill_chunk(*key):
+                delete_future = self._start_zarr_chunk_delete(*key)
+                if delete_future is not None:
+                    write_futures.append(delete_future)
+                continue
+            copy_source = self._get_copy_source(*key)
+            if copy_source is not None:
+                source_kvstore, source_key, output_key = copy_source
+                copy_reads.append((key, output_key, source_kvstore.read(source_key)))
+            else:
+                assembled_images[key] = self._allocate_zarr_chunk(*key)
+
+        # the regions of an input image in all the chunks are read together, over the bounding
+        # box of each group of regions that tile it, so sparse chunks are read separately
+        regions = {}
+        for key in assembled_images:
+            for c_index, file_name, src_y, src_x, dst_y, dst_x in self._get_chunk_sources(*key):
+                regions.setdefault((file_name, key[0]), []).append(
+                    (key, c_index, src_y, src_x, dst_y, dst_x)
+                )
+        reads = []
+        for (file_name, level), file_parts in regions.items():
+            read_groups = get_read_groups(
+                [(src_y, src_x) for _, _, src_y, src_x, _, _ in file_parts]
+            )
+            for read_group in read_groups:
+                parts = [file_parts[i] for i in read_group]
+                y_start = min(src_y.start for _, _, src_y, _, _, _ in parts)
+                y_stop = max(src_y.stop for _, _, src_y, _, _, _ in parts)
+                x_start = min(src_x.start for _, _, _, src_x, _, _ in parts)
+                x_stop = max(src_x.stop for _, _, _, src_x, _, _ in parts)
+                read = self._open_source(file_name, level)[
+                    0, 0, 0, y_start:y_stop, x_start:x_stop
+                ].read()
+                reads.append((y_start, x_start, parts, read))
+
+        for key, output_key, read in copy_reads:
+            encoded_chunk = read.result()
+            # a missing input chunk is the fill value, which is not written either
+            if encoded_chunk.state == "value":
+                write_futures.append(self._aligned_levels[key[0]].write(output_key, encoded_chunk.value))
+            else:
+                delete_future = self._start_zarr_chunk_delete(*key)
+                if delete_future is not None:
+                    write_futures.append(delete_future)
+
+        for y_start, x_start, parts, read in reads:
+            region = read.result()
+            for key, c_index, src_y, src_x, dst_y, dst_x in parts:
+                assembled_images[key][c_index, dst_y, dst_x] = region[
+                    src_y.start - y_start : src_y.stop - y_start,
+                    src_x.start - x_start : src_x.stop - x_start,
+                ]
+
+        # the adjacent chunks of a row are written with a single write, chunks equal to the
+        # fill value are not written
+        rows = {}
+        for key in sorted(assembled_images):
+            if assembled_images[key].any():
+                rows.setdefault(key[:3], []).append(key[3])
+            else:
+                delete_future = self._start_zarr_chunk_delete(*key)
+                if delete_future is not None:
+                    write_futures.append(delete_future)
+        for (level, channel, y_index), x_indices in rows.items():
+            channels = self._channel_block(channel)
+            y_range, _ = self._get_chunk_ranges(level, y_index, x_indices[0])
+            run_start = 0
+            for i in range(1, len(x_indices) + 1):
+                if i < len(x_indices) and x_indices[i] == x_indices[i - 1] + 1:
+                    continue
+                run = x_indices[run_start:i]
+                image = np.concatenate(
+                    [assembled_images[(level, channel, y_index, x)] for x in run], axis=2
+                )
+                x_range = [run[0] * CHUNK_SIZE, run[0] * CHUNK_SIZE + image.shape[2]]
+                write_futures.append(
+                    self._zarr_arrays[level][
+                        0,
+                        channels.start : channels.stop,
+                        0,
+                        y_range[0] : y_range[1],
+                        x_range[0] : x_range[1],
+                    ].write(image)
+                )
+                run_start = i
+
+        for write_future in write_futures:
+            write_future.result()
+
+    def _prefetch_zarr_chunk(self, level: int, channel: int, y_index: int, x_index: int) -> None:
+        """
+        Writes a predicted chunk, if it exists in the pyramid.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        if self._chunk_exists(level, channel, y_index, x_index):
+            self._generate_zarr_chunk(level, channel, y_index, x_index)
+
+    def cancel_prefetch(self) -> None:
+        """
+        Drops the chunks that are waiting to be prefetched.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.cancel()
+
+    def close(self) -> None:
+        """
+        Stops the prefetching threads. Chunks can still be requested afterwards, without
+        prefetching.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    def __enter__(self) -> "PyramidCompositor":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _chunk_exists(self, level: int, channel: int, y_index: int, x_index: int) -> bool:
+        """
+        Returns True if the chunk is inside the composed pyramid.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        if self._composition_map is None or level not in self._plate_image_shapes:
+            return False
+        return (
+            0 <= channel < self._num_channels
+            and 0 <= y_index < math.ceil(self._plate_image_shapes[level][3] / CHUNK_SIZE)
+            and 0 <= x_index < math.ceil(self._plate_image_shapes[level][4] / CHUNK_SIZE)
+        )
+
+    def _generate_zarr_chunk(
+        self,
+        level: int,
+        channel: int,
+        y_index: int,
+        x_index: int,
+        assembled_image: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Writes a chunk unless it is already written, or waits for the request that is writing it.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+            assembled_image (np.ndarray, optional): The already assembled chunk.
+        """
+        future, is_owner = self._claim_zarr_chunk(level, channel, y_index, x_index)
+        if future is None:
+            return
+        if not is_owner:
+            future.result()
+            return
+        try:
+            self._write_zarr_chunk(level, channel, y_index, x_index, assembled_image)
+        except BaseException as e:
+            self._release_zarr_chunk(level, channel, y_index, x_index, future, e)
+            raise
+        self._release_zarr_chunk(level, channel, y_index, x_index, future)
+
+    def _claim_zarr_chunk(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> Tuple[Optional[concurrent.futures.Future], bool]:
+        """
+        Claims the writing of a chunk.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Returns:
+            Tuple[concurrent.futures.Future | None, bool]: The future that is completed when the
+                chunk is written, or None if it is already written, and whether the caller
+                has to write the chunk.
+        """
+        key = (level, self._channel_block(channel).start, y_index, x_index)
+        if self._is_chunk_written(level, channel, y_index, x_index):
+            return None, False
+        with self._lock:
+            if (level, channel, y_index, x_index) in self._chunk_cache:
+                return None, False
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future, False
+            future = concurrent.futures.Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _release_zarr_chunk(
+        self,
+        level: int,
+        channel: int,
+        y_index: int,
+        x_index: int,
+        future: concurrent.futures.Future,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        """
+        Records the outcome of a claimed chunk and wakes up the requests waiting for it.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+            future (concurrent.futures.Future): The future returned by `_claim_zarr_chunk`.
+            error (BaseException, optional): The error raised while writing the chunk.
+        """
+        channels = self._channel_block(channel)
+        if error is None and self._chunk_index is not None:
+            try:
+                self._chunk_index.add(level, channels, y_index, x_index)
+            except OSError as e:
+                error = e
+        with self._lock:
+            del self._in_flight[(level, channels.start, y_index, x_index)]
+            if error is None:
+                for c in channels:
+                    self._chunk_cache.add((level, c, y_index, x_index))
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+            return
+        if self._disk_budget_bytes is not None:
+            self._track_chunk_file((level, channels.start, y_index, x_index))
+
+    def _track_chunk_file(self, key: Tuple[int, int, int, int]) -> None:
+        """
+        Records the size of a written chunk file and enforces the disk budget.
+
+        Args:
+            key (tuple): The (level, first channel, y_index, x_index) of the chunk.
+        """
+        level, channel, y_index, x_index = key
+        chunk_file = os.path.join(
+            local_path(self._output_pyramid_name),
+            "data.zarr",
+            "0",
+            str(level),
+            self._get_output_chunk_key(channel, y_index, x_index),
+        )
+        try:
+            chunk_file_size = os.path.getsize(chunk_file)
+        except OSError:
+            # chunks equal to the fill value have no file
+            return
+
+        evicted_chunks = []
+        with self._lock:
+            level_usage = self._chunk_usage.setdefault(level, OrderedDict())
+            self._disk_usage += chunk_file_size - level_usage.pop(key, 0)
+            level_usage[key] = chunk_file_size
+            # the chunk that was just written is never evicted, its requester is about to read it
+            for evicted_level in sorted(self._chunk_usage):
+                evicted_usage = self._chunk_usage[evicted_level]
+                for evicted_key in list(evicted_usage):
+                    if self._disk_usage <= self._disk_budget_bytes:
+                        break
+                    if evicted_key != key:
+                        self._disk_usage -= evicted_usage.pop(evicted_key)
+                        evicted_chunks.append(evicted_key)
+        if evicted_chunks:
+            self._invalidate_zarr_chunks(evicted_chunks)
+
+    def _touch_chunk_file(self, level: int, channel: int, y_index: int, x_index: int) -> None:
+        """
+        Marks a written chunk as recently used.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        key = (level, self._channel_block(channel).start, y_index, x_index)
+        with self._lock:
+            level_usage = self._chunk_usage.get(level)
+            if level_usage is not None and key in level_usage:
+                level_usage.move_to_end(key)
+
+    def _is_chunk_written(self, level: int, channel: int, y_index: int, x_index: int) -> bool:
+        """
+        Returns True if the chunk has been written, by this or any other process.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        with self._lock:
+            is_written = (level, channel, y_index, x_index) in self._chunk_cache
+        if is_written:
+            if self._disk_budget_bytes is not None:
+                self._touch_chunk_file(level, channel, y_index, x_index)
+            return True
+        if self._chunk_index is None or not self._chunk_index.contains(
+            level, channel, y_index, x_index
+        ):
+            return False
+        with self._lock:
+            self._chunk_cache.add((level, channel, y_index, x_index))
+        if self._disk_budget_bytes is not None:
+            self._track_chunk_file((level, self._channel_block(channel).start, y_index, x_index))
+        return True
+
+    async def get_zarr_chunk_async(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> None:
+        """
+        Coroutine version of `get_zarr_chunk`.
+
+        All the source reads of the chunk are issued concurrently and awaited, together with
+        the write, without blocking the event loop.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Raises:
+            ValueError: If the composition map is not set or the chunk does not exist.
+        """
+        self._check_chunk_request(level, channel, y_index, x_index)
+        if self._prefetcher is None:
+            await self._generate_zarr_chunk_async(level, channel, y_index, x_index)
+            return
+        self._prefetcher.begin_request()
+        try:
+            await self._generate_zarr_chunk_async(level, channel, y_index, x_index)
+        finally:
+            self._prefetcher.end_request((level, channel, y_index, x_index), self._prefetch_zarr_chunk)
+
+    async def _generate_zarr_chunk_async(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> None:
+        """
+        Coroutine version of `_generate_zarr_chunk`.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+        """
+        future, is_owner = self._claim_zarr_chunk(level, channel, y_index, x_index)
+        if future is None:
+            return
+        if not is_owner:
+            await asyncio.wrap_future(future)
+            return
+        try:
+            copy_source = None
+            is_fill_chunk = self._is_fill_chunk(level, channel, y_index, x_index)
+            if not is_fill_chunk:
+                copy_source = self._get_copy_source(level, channel, y_index, x_index)
+            if is_fill_chunk:
+                # missing positions are the fill value, which is not written
+                delete_future = self._start_zarr_chunk_delete(level, channel, y_index, x_index)
+                if delete_future is not None:
+                    await delete_future
+            elif copy_source is not None:
+                source_kvstore, source_key, output_key = copy_source
+                encoded_chunk = await source_kvstore.read(source_key)
+                if encoded_chunk.state == "value":
+                    await self._aligned_levels[level].write(output_key, encoded_chunk.value)
+                else:
+                    delete_future = self._start_zarr_chunk_delete(level, channel, y_index, x_index)
+                    if delete_future is not None:
+                        await delete_future
+            else:
+                assembled_image = await self._assemble_zarr_chunk_async(
+                    level, channel, y_index, x_index
+                )
+                write_future = self._start_zarr_chunk_write(
+                    level, channel, y_index, x_index, assembled_image
+                )
+                if write_future is not None:
+                    await write_future
+        except BaseException as e:
+            self._release_zarr_chunk(level, channel, y_index, x_index, future, e)
+            raise
+        self._release_zarr_chunk(level, channel, y_index, x_index, future)
+
+    async def get_zarr_chunks_async(self, chunks: List[Tuple[int, int, int, int]]) -> None:
+        """
+        Generates a batch of zarr chunks concurrently.
+
+        Args:
+            chunks (list): The (level, channel, y_index, x_index) of the chunks. Channels that
+                share a chunk are only generated once.
+
+        Raises:
+            ValueError: If the composition map is not set or a chunk does not exist.
+        """
+        for chunk in chunks:
+            self._check_chunk_request(*chunk)
+        unique_chunks = {}
+        for level, channel, y_index, x_index in chunks:
+            key = (level, self._channel_block(channel).start, y_index, x_index)
+            unique_chunks.setdefault(key, (level, channel, y_index, x_index))
+        await asyncio.gather(
+            *[self.get_zarr_chunk_async(*chunk) for chunk in unique_chunks.values()]
+        )
+
+    def materialize(
+        self,
+        levels: Optional[Iterable[int]] = None,
+        channels: Optional[Iterable[int]] = None,
+        region: Optional[Tuple[int, int, int, int]] = None,
+        workers: Optional[int] = None,
+        progress: Optional[Callable[[int, int], None]] = None,
+    ) -> int:
+        """
+        Writes all the chunks of a set of levels, channels and region in parallel.
+
+        Chunks are scheduled level by level, one channel block at a time, in row-major order,
+        so that chunks assembled at the same time read the same input images.
+
+        Args:
+            levels (Iterable[int], optional): The levels to write. Defaults to all the levels.
+            channels (Iterable[int], optional): The channels to write. Defaults to all the channels.
+            region (Tuple[int, int, int, int], optional): The (y_start, y_end, x_start, x_end)
+                region to write, in pixels of level 0. Defaults to the whole image.
+            workers (int, optional): The number of threads. Defaults to half of the available CPUs.
+            progress (Callable[[int, int], None], optional): Called with the number of finished
+                chunks and the total number of chunks every time a chunk is finished.
+
+        Returns:
+            int: The number of chunks that were requested.
+
+        Raises:
+            ValueError: If the composition map is not set, or a level or a channel does not exist.
+        """
+        if self._composition_map is None:
+            raise ValueError("No composition map is set. Unable to generate pyramid")
+        levels = sorted(self._plate_image_shapes) if levels is None else sorted(levels)
+        channels = range(self._num_channels) if channels is None else channels
+        for level in levels:
+            if level not in self._plate_image_shapes:
+                raise ValueError(f"Requested level ({level}) does not exist")
+        channel_blocks = sorted({self._channel_block(c).start for c in channels})
+        for channel in channel_blocks:
+            if not 0 <= channel < self._num_channels:
+                raise ValueError(f"Requested channel ({channel}) does not exist")
+
+        chunks = []
+        base_shape = self._plate_image_shapes[0] if 0 in self._plate_image_shapes else None
+        for level in levels:
+            level_shape = self._plate_image_shapes[level]
+            y_start, y_end, x_start, x_end = 0, level_shape[3], 0, level_shape[4]
+            if region is not None and base_shape is not None:
+                # the region is scaled by the size of the level relative to level 0
+                y_scale = level_shape[3] / base_shape[3]
+                x_scale = level_shape[4] / base_shape[4]
+                y_start = max(0, math.floor(region[0] * y_scale))
+                y_end = min(level_shape[3], math.ceil(region[1] * y_scale))
+                x_start = max(0, math.floor(region[2] * x_scale))
+                x_end = min(level_shape[4], math.ceil(region[3] * x_scale))
+            for channel in channel_blocks:
+                for y_index in range(y_start // CHUNK_SIZE, math.ceil(y_end / CHUNK_SIZE)):
+                    for x_index in range(x_start // CHUNK_SIZE, math.ceil(x_end / CHUNK_SIZE)):
+                        chunks.append((level, channel, y_index, x_index))
+
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 1) // 2)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self._generate_zarr_chunk, *chunk) for chunk in chunks]
+            for num_done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                future.result()
+                if progress is not None:
+                    progress(num_done, len(chunks))
+        return len(chunks)
+
+    def _check_chunk_request(
+        self, level: int, channel: int, y_index: int, x_index: int
+    ) -> None:
+        """
+        Checks that a chunk exists in the composed pyramid.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+
+        Raises:
+            ValueError: If the chunk does not exist.
+        """
         if self._composition_map is None:
             raise ValueError("No composition map is set. Unable to generate pyramid")
 
@@ -387,15 +1766,316 @@ class PyramidCompositor:
         if channel >= self._num_channels:
             raise ValueError(f"Requested channel ({channel}) does not exist")
 
-        if y_index > (self._plate_image_shapes[level][3] // CHUNK_SIZE):
+        if y_index < 0 or y_index >= math.ceil(self._plate_image_shapes[level][3] / CHUNK_SIZE):
             raise ValueError(f"Requested y index ({y_index}) does not exist")
 
-        if x_index > (self._plate_image_shapes[level][4] // CHUNK_SIZE):
-            raise ValueError(f"Requested y index ({x_index}) does not exist")
+        if x_index < 0 or x_index >= math.ceil(self._plate_image_shapes[level][4] / CHUNK_SIZE):
+            raise ValueError(f"Requested x index ({x_index}) does not exist")
 
-        if (level, channel, y_index, x_index) in self._chunk_cache:
-            return
-        else:
-            self._write_zarr_chunk(level, channel, y_index, x_index)
-            self._chunk_cache.add((level, channel, y_index, x_index))
+    def read_zarr_chunk(
+        self,
+        level: int,
+        channel: int,
+        y_index: int,
+        x_index: int,
+        encoded: bool = False,
+        write_through: bool = False,
+    ) -> Union[np.ndarray, bytes]:
+        """
+        Returns the zarr chunk at the specified level, channel, y_index, and x_index.
+
+        The chunk is assembled in memory, or read back if it has already been written, and the
+        most recently used chunks are kept in memory. Nothing is written to the output pyramid
+        unless `write_through` is set.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+            encoded (bool, optional): Return the encoded chunk, the same bytes as the chunk file
+                of the output pyramid, instead of the array. Defaults to False.
+            write_through (bool, optional): Also write the chunk to the output pyramid.
+                Defaults to False.
+
+        Returns:
+            np.ndarray | bytes: The (channel, y, x) image of all the channels stored in the chunk,
+                or its encoded bytes.
+
+        Raises:
+            ValueError: If the composition map is not set or the chunk does not exist.
+        """
+        self._check_chunk_request(level, channel, y_index, x_index)
+        if self._prefetcher is None:
+            return self._read_zarr_chunk(level, channel, y_index, x_index, encoded, write_through)
+
+        def prefetch(level: int, channel: int, y_index: int, x_index: int) -> None:
+            if self._chunk_exists(level, channel, y_index, x_index):
+                self._read_zarr_chunk(level, channel, y_index, x_index, encoded, write_through)
+
+        self._prefetcher.begin_request()
+        try:
+            return self._read_zarr_chunk(level, channel, y_index, x_index, encoded, write_through)
+        finally:
+            self._prefetcher.end_request((level, channel, y_index, x_index), prefetch)
+
+    def _read_zarr_chunk(
+        self,
+        level: int,
+        channel: int,
+        y_index: int,
+        x_index: int,
+        encoded: bool,
+        write_through: bool,
+    ) -> Union[np.ndarray, bytes]:
+        """
+        Returns the zarr chunk at the specified level, channel, y_index, and x_index.
+
+        Args:
+            level (int): The level of the pyramid.
+            channel (int): The channel of the pyramid.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+            encoded (bool): Return the encoded chunk instead of the array.
+            write_through (bool): Also write the chunk to the output pyramid.
+
+        Returns:
+            np.ndarray | bytes: The chunk or its encoded bytes.
+        """
+        channels = self._channel_block(channel)
+        key = (level, channels.start, y_index, x_index, encoded)
+        is_written = self._is_chunk_written(level, channel, y_index, x_index)
+        chunk = self._get_hot_chunk(key)
+        if chunk is not None and (is_written or not write_through):
+            return chunk
+
+        assembled_image = self._get_hot_chunk(key[:-1] + (False,))
+        if assembled_image is None:
+            if is_written:
+                y_range, x_range = self._get_chunk_ranges(level, y_index, x_index)
+                assembled_image = (
+                    self._zarr_arrays[level][
+                        0,
+                        channels.start : channels.stop,
+                        0,
+                        y_range[0] : y_range[1],
+                        x_range[0] : x_range[1],
+                    ]
+                    .read()
+                    .result()
+                )
+            else:
+                assembled_image = self._assemble_zarr_chunk(level, channel, y_index, x_index)
+        if write_through and not is_written:
+            self._generate_zarr_chunk(level, channel, y_index, x_index, assembled_image)
+        if chunk is not None:
+            return chunk
+
+        chunk = assembled_image
+        if encoded:
+            chunk = self._encode_zarr_chunk(level, channels, y_index, x_index, assembled_image)
+        self._add_hot_chunk(key, chunk)
+        return chunk
+
+    def _encode_zarr_chunk(
+        self,
+        level: int,
+        channels: range,
+        y_index: int,
+        x_index: int,
+        assembled_image: np.ndarray,
+    ) -> bytes:
+        """
+        Encodes an assembled chunk the way it is stored in the output pyramid.
+
+        Args:
+            level (int): The level of the pyramid.
+            channels (range): The channels stored in the chunk.
+            y_index (int): The y-index of the tile.
+            x_index (int): The x-index of the tile.
+            assembled_image (np.ndarray): The assembled chunk.
+
+        Returns:
+            bytes: The encoded chunk.
+        """
+        channel_chunk_size = min(self._channel_chunk_size, self._num_channels)
+        with self._lock:
+            encoder = self._chunk_encoders.get(level)
+        if encoder is None:
+            encoder_loc = f"memory://encoder/{level}"
+            write_spec = get_zarr_write_spec(
+                encoder_loc,
+                CHUNK_SIZE,
+                self._plate_image_shapes[level],
+                np.dtype(self._image_dtype).str,
+                channel_chunk_size,
+            )
+            # the encoded bytes of a chunk equal to the fill value are needed as well
+            write_spec["store_data_equal_to_fill_value"] = True
+            encoder = (
+                ts.open(write_spec, context=self._encoder_context).result(),
+                open_kvstore(encoder_loc, self._encoder_context),
+            )
+            with self._lock:
+                encoder = self._chunk_encoders.setdefault(level, encoder)
+        encoder, encoder_kvstore = encoder
+
+        y_range, x_range = self._get_chunk_ranges(level, y_index, x_index)
+        encoder[
+            0,
+            channels.start : channels.stop,
+            0,
+            y_range[0] : y_range[1],
+            x_range[0] : x_range[1],
+        ].write(assembled_image).result()
+        chunk_key = self._get_output_chunk_key(channels.start, y_index, x_index)
+        encoded_chunk = bytes(encoder_kvstore.read(chunk_key).result().value)
+        encoder_kvstore.delete_range(ts.KvStore.KeyRange(chunk_key, chunk_key + "\0")).result()
+        return encoded_chunk
+
+    def _get_hot_chunk(self, key: tuple) -> Optional[Union[np.ndarray, bytes]]:
+        """
+        Returns a chunk kept in memory.
+
+        Args:
+            key (tuple): The (level, first channel, y_index, x_index, encoded) of the chunk.
+
+        Returns:
+            np.ndarray | bytes | None: The chunk, or None if it is not in memory.
+        """
+        with self._lock:
+            chunk = self._hot_chunks.get(key)
+            if chunk is not None:
+                self._hot_chunks.move_to_end(key)
+            return chunk
+
+    def _add_hot_chunk(self, key: tuple, chunk: Union[np.ndarray, bytes]) -> None:
+        """
+        Keeps a chunk in memory, evicting the least recently used chunks over the budget.
+
+        Args:
+            key (tuple): The (level, first channel, y_index, x_index, encoded) of the chunk.
+            chunk (np.ndarray | bytes): The chunk.
+        """
+        if isinstance(chunk, np.ndarray):
+            # the same array is returned to every caller
+            chunk.setflags(write=False)
+        chunk_size = chunk.nbytes if isinstance(chunk, np.ndarray) else len(chunk)
+        if chunk_size > self._hot_chunk_cache_bytes:
             return
+        with self._lock:
+            if key in self._hot_chunks:
+                return
+            self._hot_chunks[key] = chunk
+            self._hot_chunks_size += chunk_size
+            while self._hot_chunks_size > self._hot_chunk_cache_bytes:
+                _, evicted = self._hot_chunks.popitem(last=False)
+                self._hot_chunks_size -= (
+                    evicted.nbytes if isinstance(evicted, np.ndarray) else len(evicted)
+                )
+
+    def _clear_hot_chunks(self) -> None:
+        """
+        Drops the chunks kept in memory and the chunk encoders.
+        """
+        self._hot_chunks = OrderedDict()
+        self._hot_chunks_size = 0
+        self._chunk_encoders = {}
+        self._encoder_context = ts.Context()
+
+    def get_virtual_level(self, level: int) -> ts.TensorStore:
+        """
+        Returns a read-only view of a level of the composed pyramid.
+
+        The view is a concatenation of the input zarr arrays, following the composition map,
+        so any region of the composed image can be read without writing it. Positions without
+        an input image read as zeros.
+
+        Args:
+            level (int): The level of the pyramid.
+
+        Returns:
+            ts.TensorStore: The (t, c, z, y, x) view of the level.
+
+        Raises:
+            ValueError: If the composition map is not set or the level does not exist.
+        """
+        if self._composition_map is None:
+            raise ValueError("No composition map is set. Unable to generate pyramid")
+        if level not in self._plate_image_shapes:
+            raise ValueError(f"Requested level ({level}) does not exist")
+        with self._lock:
+            virtual_level = self._virtual_levels.get(level)
+        if virtual_level is not None:
+            return virtual_level
+
+        unit_height, unit_width = self._unit_image_shapes[level]
+        num_rows = self._plate_image_shapes[level][3] // unit_height
+        num_cols = self._plate_image_shapes[level][4] // unit_width
+
+        # all the inputs are opened concurrently
+        open_futures = {}
+        for (col, row, c), file_name in self._composition_map.items():
+            if file_name is not None and (file_name, level) not in open_futures:
+                zarr_file = self._get_open_source((file_name, level))
+                open_futures[(file_name, level)] = (
+                    zarr_file
+                    if zarr_file is not None
+                    else self._open_source_future(file_name, level)
+                )
+        zarr_files = {
+            key: value if isinstance(value, ts.TensorStore) else value.result()
+            for key, value in open_futures.items()
+        }
+
+        # missing positions are backed by an empty in-memory array, which reads as zeros
+        fill_image = ts.open(
+            get_zarr_write_spec(
+                "memory://",
+                CHUNK_SIZE,
+                (1, 1, 1, unit_height, unit_width),
+                np.dtype(self._image_dtype).str,
+            ),
+            context=ts.Context(),
+        ).result()
+
+        channel_images = []
+        for c in range(self._num_channels):
+            row_images = []
+            for row in range(num_rows):
+                unit_images = []
+                for col in range(num_cols):
+                    file_name = self._composition_map.get((col, row, c))
+                    if file_name is None:
+                        unit_images.append(fill_image)
+                    else:
+                        unit_images.append(zarr_files[(file_name, level)])
+                row_images.append(ts.concat(unit_images, axis=4, read=True, write=False))
+            channel_images.append(ts.concat(row_images, axis=3, read=True, write=False))
+        virtual_level = ts.concat(channel_images, axis=1, read=True, write=False)
+
+        with self._lock:
+            self._virtual_levels[level] = virtual_level
+        return virtual_level
+
+    def commit(self, destination: Location, context: Optional[ts.Context] = None) -> int:
+        """
+        Copies the composed pyramid to another location.
+
+        This flushes a pyramid composed in memory or on fast local storage to its final,
+        possibly remote, location in one bulk copy.
+
+        Args:
+            destination (str | dict): The directory, kvstore URL or kvstore spec to copy the
+                pyramid into. The pyramid keeps its name in the destination.
+            context (ts.Context, optional): The context used to open the destination.
+
+        Returns:
+            int: The number of copied files.
+        """
+        return commit_kvstore(
+            self._output_pyramid_name,
+            join_location(destination, self._pyramid_name),
+            self._context,
+            context,
+        )
@@ -1,6 +1,10 @@
 from pydantic import BaseModel, Field, field_validator
 from typing import Dict, Optional, List
+import os
+import shutil
+import tempfile
 from .libargolid import OmeTiffToChunkedPyramidCPP, VisType, DSType, PyramidViewCPP
+from .kvstore import commit_kvstore
 
 class Downsample(BaseModel):
     channel_name: str
@@ -18,6 +22,7 @@ class PlateVisualizationMetadata(BaseModel):
     x_spacing: int
     y_spacing: int
     channel_downsample_config: Optional[List[Downsample]] = None
+    channel_chunk_size: Optional[int] = 1
 
     @field_validator('minimum_dimension', 'x_spacing', 'y_spacing', mode='before')
     def check_non_negative(cls, v):
@@ -25,6 +30,12 @@ class PlateVisualizationMetadata(BaseModel):
             raise ValueError('value must be non-negative')
         return v
 
+    @field_validator('channel_chunk_size', mode='before')
+    def check_positive(cls, v):
+        if v is not None and v < 1:
+            raise ValueError('value must be positive')
+        return v
+
     @field_validator('output_type')
     def check_output_type_config(cls, v):
         if v not in {"Viv", "NG_Zarr"}:
@@ -34,21 +45,45 @@ class PlateVisualizationMetadata(BaseModel):
 class PyramidGenerartor:
     def __init__(self, log_level = None) -> None:
         self._pyr_generator = OmeTiffToChunkedPyramidCPP()
-        self.vis_types_dict ={ "NG_Zarr" : VisType.NG_Zarr, "PCNG" : VisType.PCNG, "Viv" : VisType.Viv}
+        self.vis_types_dict ={ "NG_Zarr" : VisType.NG_Zarr, "PCNG" : VisType.PCNG, "Viv" : VisType.Viv, "OmeTiff" : VisType.OmeTiff}
         self.ds_types_dict = {"mean" : DSType.Mean, "mode_max" : DSType.Mode_Max, "mode_min" : DSType.Mode_Min}
 
-    def generate_from_single_image(self, input_file, output_dir, min_dim, vis_type, ds_dict = {}):
+    def generate_from_single_image(self, input_file, output_dir, min_dim, vis_type, ds_dict = {}, staging_dir = None):
         
         channel_ds_dict = {}
         for c, ds in ds_dict:
             channel_ds_dict[c] = self.ds_types_dict[ds]
-        self._pyr_generator.GenerateFromSingleFile(input_file, output_dir, min_dim, self.vis_types_dict[vis_type], channel_ds_dict)
+        if staging_dir is None:
+            self._pyr_generator.GenerateFromSingleFile(input_file, output_dir, min_dim, self.vis_types_dict[vis_type], channel_ds_dict)
+            return
+        write_dir = self._make_staging_subdir(staging_dir)
+        try:
+            self._pyr_generator.GenerateFromSingleFile(input_file, write_dir, min_dim, self.vis_types_dict[vis_type], channel_ds_dict)
+            commit_kvstore(write_dir, output_dir)
+        finally:
+            shutil.rmtree(write_dir)
 
-    def generate_from_image_collection(self, collection_path, pattern , image_name, output_dir, min_dim, vis_type, ds_dict = {}):  
+    def generate_from_image_collection(self, collection_path, pattern , image_name, output_dir, min_dim, vis_type, ds_dict = {}, channel_chunk_size = 1, staging_dir = None):  
         channel_ds_dict = {}
         for c in ds_dict:
             channel_ds_dict[c] = self.ds_types_dict[ds_dict[c]]
-        self._pyr_generator.GenerateFromCollection(collection_path, pattern , image_name, output_dir, min_dim, self.vis_types_dict[vis_type], channel_ds_dict)
+        if staging_dir is None:
+            self._pyr_generator.GenerateFromCollection(collection_path, pattern , image_name, output_dir, min_dim, self.vis_types_dict[vis_type], channel_ds_dict, channel_chunk_size)
+            return
+        write_dir = self._make_staging_subdir(staging_dir)
+        try:
+            self._pyr_generator.GenerateFromCollection(collection_path, pattern , image_name, write_dir, min_dim, self.vis_types_dict[vis_type], channel_ds_dict, channel_chunk_size)
+            commit_kvstore(write_dir, output_dir)
+        finally:
+            shutil.rmtree(write_dir)
+
+    def _make_staging_subdir(self, staging_dir):
+        # the pyramid is built on fast local storage and copied to output_dir, which can be
+        # any kvstore location, in one pass. Each call stages into its own subdirectory, so
+        # only that subdirectory is committed and removed, and the rest of staging_dir, such
+        # as concurrent generations sharing it, is left alone
+        os.makedirs(staging_dir, exist_ok=True)
+        return tempfile.mkdtemp(dir=staging_dir)
 
     def set_log_level(self, level):
         self._pyr_generator.SetLogLevel(level)
@@ -71,10 +106,15 @@ class PyramidView:
         else:
             self._vis_type = VisType.Viv
 
+        if hasattr(metadata_dict,'channel_chunk_size') and metadata_dict.channel_chunk_size is not None: 
+            self._channel_chunk_size = metadata_dict.channel_chunk_size
+        else:
+            self._channel_chunk_size = 1
+
         self._channel_downsample_config = {}
         if hasattr(metadata_dict,'channel_downsample_config') and metadata_dict.channel_downsample_config is not None: 
             for c in metadata_dict.channel_downsample_config:
                 self._channel_downsample_config[c.channel_name] = self.ds_types_dict[metadata_dict.channel_downsample_config[c.method]]
 
     def generate_pyramid(self, image_map):
-        self._pyr_view.GeneratePyramid(image_map, self._vis_type, self._min_dim, self._channel_downsample_config)
+        self._pyr_view.GeneratePyramid(image_map, self._vis_type, self._min_dim, self._channel_downsample_config, self._channel_chunk_size)
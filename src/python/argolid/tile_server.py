@@ -0,0 +1,471 @@
+from typing import Any, Dict, List, Optional, Tuple
+import concurrent.futures
+import http.client
+import http.server
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+import urllib.parse
+
+from .kvstore import Location, is_local, join_location, local_path
+
+# the path of the multiscale zarr group in a composed pyramid
+ZARR_GROUP_PATH: str = "data.zarr/0"
+
+
+def _run_worker(
+    listen_socket: socket.socket,
+    input_pyramids_loc: str,
+    out_dir: Location,
+    output_pyramid_name: str,
+    composition_map: dict,
+    compositor_options: Dict[str, Any],
+) -> None:
+    """
+    Serves tile requests in a worker process until it is terminated.
+
+    Args:
+        listen_socket (socket.socket): The listening socket shared by all the workers.
+        input_pyramids_loc (str): The location of the input pyramid images.
+        out_dir (str | dict): The output location of the composed pyramid.
+        output_pyramid_name (str): The name of the composed pyramid.
+        composition_map (dict): The composition of the pyramid.
+        compositor_options (dict): Additional arguments of the `PyramidCompositor`.
+    """
+    # the compositor is created in the worker, tensorstore does not support being forked
+    from .pyramid_compositor import PyramidCompositor
+
+    compositor = PyramidCompositor(
+        input_pyramids_loc, out_dir, output_pyramid_name, **compositor_options
+    )
+    compositor.set_composition(composition_map)
+
+    server = http.server.ThreadingHTTPServer(
+        listen_socket.getsockname()[:2], _TileRequestHandler, bind_and_activate=False
+    )
+    server.socket.close()
+    server.socket = listen_socket
+    server.compositor = compositor
+    server.pyramid_root = os.path.abspath(local_path(join_location(out_dir, output_pyramid_name)))
+    server.channel_chunk_sizes = {}
+    server.serve_forever()
+
+
+class _TileRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the files of a composed pyramid, generating the chunks that are not written yet.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        key = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip("/")
+        file_path = os.path.normpath(os.path.join(self.server.pyramid_root, key))
+        if os.path.commonpath([file_path, self.server.pyramid_root]) != self.server.pyramid_root:
+            self._send_empty(404)
+            return
+
+        chunk = self._parse_chunk_key(key)
+        # a chunk can be evicted from the disk by another worker between its generation and
+        # its read, it is then generated again
+        for _ in range(2):
+            if chunk is not None:
+                try:
+                    self.server.compositor.get_zarr_chunk(*chunk)
+                except ValueError:
+                    self._send_empty(404)
+                    return
+                except Exception:
+                    self._send_empty(500)
+                    return
+            try:
+                with open(file_path, "rb") as f:
+                    self._send_file(f)
+                return
+            except (FileNotFoundError, IsADirectoryError):
+                if chunk is None:
+                    break
+        # chunks equal to the fill value have no file, zarr readers treat a 404 as the fill value
+        self._send_empty(404)
+
+    def _parse_chunk_key(self, key: str) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Returns the (level, channel, y_index, x_index) of a chunk key, or None for other keys.
+
+        Args:
+            key (str): The requested key, relative to the pyramid root.
+        """
+        prefix, _, name = key.rpartition("/")
+        group, _, level = prefix.rpartition("/")
+        if group != ZARR_GROUP_PATH or not level.isdigit():
+            return None
+        indices = name.split(".")
+        if len(indices) != 5 or not all(index.isdigit() for index in indices):
+            return None
+        channel_chunk_size = self._get_channel_chunk_size(int(level))
+        if channel_chunk_size is None:
+            return None
+        return (
+            int(level),
+            int(indices[1]) * channel_chunk_size,
+            int(indices[3]),
+            int(indices[4]),
+        )
+
+    def _get_channel_chunk_size(self, level: int) -> Optional[int]:
+        """
+        Returns the number of channels in a chunk of a level, read from its .zarray file.
+
+        Args:
+            level (int): The level of the pyramid.
+        """
+        channel_chunk_sizes = self.server.channel_chunk_sizes
+        if level not in channel_chunk_sizes:
+            zarray_path = os.path.join(self.server.pyramid_root, ZARR_GROUP_PATH, str(level), ".zarray")
+            try:
+                with open(zarray_path, "r") as f:
+                    channel_chunk_sizes[level] = json.load(f)["chunks"][1]
+            except FileNotFoundError:
+                return None
+        return channel_chunk_sizes[level]
+
+    def _send_file(self, f) -> None:
+        """
+        Sends a file, with zero copy where the platform supports it.
+
+        Args:
+            f (file): The opened file.
+        """
+        size = os.fstat(f.fileno()).st_size
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.flush()
+        self.connection.sendfile(f, 0, size)
+
+    def _send_empty(self, status: int) -> None:
+        """
+        Sends a response without a body.
+
+        Args:
+            status (int): The HTTP status.
+        """
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # requests are not logged, logging would dominate the serving time in benchmarks
+        pass
+
+
+class TileServer:
+    """
+    A local HTTP server of the zarr keys of a composed pyramid.
+
+    Chunks are generated on demand by a pool of worker processes, each with its own
+    `PyramidCompositor`. The workers share the on-disk index of the written chunks, so a chunk
+    is generated once, and chunks already on disk are sent with sendfile.
+    """
+
+    def __init__(
+        self,
+        input_pyramids_loc: str,
+        out_dir: str,
+        output_pyramid_name: str,
+        composition_map: dict,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        num_workers: Optional[int] = None,
+        **compositor_options: Any,
+    ) -> None:
+        """
+        Initializes the TileServer object.
+
+        Args:
+            input_pyramids_loc (str): The location of the input pyramid images.
+            out_dir (str): The local output directory of the composed pyramid.
+            output_pyramid_name (str): The name of the composed pyramid.
+            composition_map (dict): A dictionary mapping composition images to file paths.
+            host (str, optional): The address to listen on. Defaults to "127.0.0.1".
+            port (int, optional): The port to listen on. Defaults to 0, a free port.
+            num_workers (int, optional): The number of worker processes. Defaults to the
+                number of CPUs.
+            **compositor_options: Additional arguments of the `PyramidCompositor` of every worker,
+                such as `channel_chunk_size` or `prefetch_budget`.
+        """
+        if not is_local(out_dir):
+            raise ValueError("The tile server requires a local output directory")
+        if compositor_options.get("persistent_index") is False:
+            raise ValueError("The workers of the tile server share the persistent chunk index")
+        self._input_pyramids_loc: str = input_pyramids_loc
+        self._out_dir: str = out_dir
+        self._output_pyramid_name: str = output_pyramid_name
+        self._composition_map: dict = composition_map
+        self._host: str = host
+        self._port: int = port
+        self._num_workers: int = num_workers if num_workers is not None else (os.cpu_count() or 1)
+        self._compositor_options: Dict[str, Any] = compositor_options
+        self._socket: Optional[socket.socket] = None
+        self._workers: List[multiprocessing.Process] = []
+
+    @property
+    def url(self) -> str:
+        """
+        The URL of the pyramid root.
+        """
+        if self._socket is None:
+            raise RuntimeError("The tile server is not started")
+        host, port = self._socket.getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        """
+        Starts the worker processes.
+        """
+        if self._socket is not None:
+            raise RuntimeError("The tile server is already started")
+        self._socket = socket.create_server((self._host, self._port), backlog=1024)
+        # workers are spawned rather than forked, tensorstore does not support being forked
+        mp_context = multiprocessing.get_context("spawn")
+        self._workers = [
+            mp_context.Process(
+                target=_run_worker,
+                args=(
+                    self._socket,
+                    self._input_pyramids_loc,
+                    self._out_dir,
+                    self._output_pyramid_name,
+                    self._composition_map,
+                    self._compositor_options,
+                ),
+                daemon=True,
+            )
+            for _ in range(self._num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self) -> None:
+        """
+        Stops the worker processes.
+        """
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def wait_ready(self, timeout: float = 60.0) -> None:
+        """
+        Waits until the workers serve the pyramid metadata.
+
+        Args:
+            timeout (float, optional): The maximum time to wait, in seconds. Defaults to 60.
+
+        Raises:
+            TimeoutError: If the pyramid is not served within the timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if any(not worker.is_alive() for worker in self._workers):
+                raise RuntimeError("A tile server worker exited")
+            status, _ = _get(self.url, f"{ZARR_GROUP_PATH}/.zattrs")
+            if status == 200:
+                return
+            time.sleep(0.1)
+        raise TimeoutError("The tile server is not ready")
+
+    def __enter__(self) -> "TileServer":
+        self.start()
+        self.wait_ready()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+
+def _get(
+    url: str, key: str, connection: Optional[http.client.HTTPConnection] = None
+) -> Tuple[int, bytes]:
+    """
+    Requests a key of a served pyramid.
+
+    Args:
+        url (str): The URL of the pyramid root.
+        key (str): The key, relative to the pyramid root.
+        connection (http.client.HTTPConnection, optional): A persistent connection to use.
+
+    Returns:
+        Tuple[int, bytes]: The HTTP status and the body, or 0 if the server is unreachable.
+    """
+    parsed_url = urllib.parse.urlsplit(url)
+    is_persistent = connection is not None
+    if not is_persistent:
+        connection = http.client.HTTPConnection(parsed_url.hostname, parsed_url.port, timeout=60)
+    try:
+        connection.request("GET", f"{parsed_url.path.rstrip('/')}/{key}")
+        response = connection.getresponse()
+        return response.status, response.read()
+    except (OSError, http.client.HTTPException):
+        # a persistent connection reconnects on its next request
+        connection.close()
+        return 0, b""
+    finally:
+        if not is_persistent:
+            connection.close()
+
+
+def generate_viewer_trace(
+    url: str,
+    num_steps: int = 100,
+    viewport: Tuple[int, int] = (3, 4),
+    zoom_probability: float = 0.2,
+    seed: int = 0,
+) -> List[List[str]]:
+    """
+    Generates the requests of a viewer that pans and zooms around a served pyramid.
+
+    The viewer starts at the lowest resolution level and, at every step, either pans by one
+    chunk or zooms in or out by one level around the center of the viewport. Every step
+    requests the chunks of all the channels in the viewport.
+
+    Args:
+        url (str): The URL of the pyramid root.
+        num_steps (int, optional): The number of steps. Defaults to 100.
+        viewport (Tuple[int, int], optional): The number of chunk rows and columns in the
+            viewport. Defaults to (3, 4).
+        zoom_probability (float, optional): The probability of a zoom at every step.
+            Defaults to 0.2.
+        seed (int, optional): The seed of the random walk. Defaults to 0.
+
+    Returns:
+        list: The chunk keys requested at every step, relative to the pyramid root.
+    """
+    _, body = _get(url, f"{ZARR_GROUP_PATH}/.zattrs")
+    levels = [int(dataset["path"]) for dataset in json.loads(body)["multiscales"][0]["datasets"]]
+    chunk_grid = {}
+    for level in levels:
+        _, body = _get(url, f"{ZARR_GROUP_PATH}/{level}/.zarray")
+        zarray = json.loads(body)
+        chunk_grid[level] = [
+            math.ceil(zarray["shape"][axis] / zarray["chunks"][axis]) for axis in range(5)
+        ]
+
+    rng = random.Random(seed)
+    level = max(levels)
+    y_index, x_index = 0, 0
+    trace = []
+    for _ in range(num_steps):
+        if rng.random() < zoom_probability:
+            zoom = rng.choice([-1, 1])
+            if zoom < 0 and level - 1 in chunk_grid:
+                level -= 1
+                y_index, x_index = 2 * y_index + viewport[0] // 2, 2 * x_index + viewport[1] // 2
+            elif zoom > 0 and level + 1 in chunk_grid:
+                level += 1
+                y_index, x_index = (y_index - viewport[0] // 2) // 2, (x_index - viewport[1] // 2) // 2
+        else:
+            dy, dx = rng.choice([(0, -1), (0, 1), (-1, 0), (1, 0)])
+            y_index, x_index = y_index + dy, x_index + dx
+        _, num_channel_chunks, _, num_rows, num_cols = chunk_grid[level]
+        y_index = min(max(y_index, 0), max(num_rows - viewport[0], 0))
+        x_index = min(max(x_index, 0), max(num_cols - viewport[1], 0))
+        trace.append(
+            [
+                f"{ZARR_GROUP_PATH}/{level}/0.{c}.0.{y}.{x}"
+                for c in range(num_channel_chunks)
+                for y in range(y_index, min(y_index + viewport[0], num_rows))
+                for x in range(x_index, min(x_index + viewport[1], num_cols))
+            ]
+        )
+    return trace
+
+
+def replay_trace(
+    url: str,
+    trace: List[List[str]],
+    num_viewers: int = 1,
+    connections_per_viewer: int = 6,
+) -> Dict[str, float]:
+    """
+    Replays a viewer trace against a tile server and measures the throughput and latency.
+
+    Every viewer replays the whole trace. The requests of a step are issued concurrently, over
+    a fixed number of persistent connections like a browser does, and the next step starts when
+    all of them are answered.
+
+    Args:
+        url (str): The URL of the pyramid root.
+        trace (list): The keys requested at every step, as returned by `generate_viewer_trace`.
+        num_viewers (int, optional): The number of concurrent viewers. Defaults to 1.
+        connections_per_viewer (int, optional): The number of connections of every viewer.
+            Defaults to 6.
+
+    Returns:
+        dict: The number of requests and errors (responses other than 200 and 404), the bytes
+            received, the requests per second and the p50, p90, p99 and maximum latencies
+            in milliseconds.
+    """
+    parsed_url = urllib.parse.urlsplit(url)
+    connections = threading.local()
+    latencies: List[float] = []
+    stats = {"requests": 0, "errors": 0, "bytes": 0}
+    stats_lock = threading.Lock()
+
+    def fetch(key: str) -> None:
+        if not hasattr(connections, "connection"):
+            connections.connection = http.client.HTTPConnection(
+                parsed_url.hostname, parsed_url.port, timeout=60
+            )
+        start = time.perf_counter()
+        status, body = _get(url, key, connections.connection)
+        latency = time.perf_counter() - start
+        with stats_lock:
+            latencies.append(latency)
+            stats["requests"] += 1
+            stats["bytes"] += len(body)
+            if status not in (200, 404):
+                stats["errors"] += 1
+
+    def replay() -> None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=connections_per_viewer) as executor:
+            for keys in trace:
+                for future in [executor.submit(fetch, key) for key in keys]:
+                    future.result()
+
+    start = time.perf_counter()
+    viewers = [threading.Thread(target=replay) for _ in range(num_viewers)]
+    for viewer in viewers:
+        viewer.start()
+    for viewer in viewers:
+        viewer.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        if not latencies:
+            return 0.0
+        return 1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    return {
+        "requests": stats["requests"],
+        "errors": stats["errors"],
+        "bytes": stats["bytes"],
+        "seconds": elapsed,
+        "requests_per_second": stats["requests"] / elapsed if elapsed > 0 else 0.0,
+        "latency_p50_ms": percentile(0.50),
+        "latency_p90_ms": percentile(0.90),
+        "latency_p99_ms": percentile(0.99),
+        "latency_max_ms": percentile(1.0),
+    }
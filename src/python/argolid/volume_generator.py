@@ -3,11 +3,51 @@ import filepattern as fp
 import os
 import tensorstore as ts
 import numpy as np
+import collections
 import concurrent.futures
 from multiprocessing import get_context
+import functools
 import json
-from typing import List, Tuple, Dict, Any
+import math
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
+from .libargolid import OmeTiffTileReaderCPP
+from .kvstore import Location, get_kvstore_spec, join_location, read_kvstore_file, write_kvstore_file
+
+# the chunk writes that may be pending at once, each one holds a chunk buffer until it completes
+MAX_IN_FLIGHT_WRITES: int = 16
+
+# the OME-NGFF name and the size in meters of the OME-XML length units
+LENGTH_UNITS: Dict[str, Tuple[str, float]] = {
+    "pm": ("picometer", 1e-12),
+    "nm": ("nanometer", 1e-9),
+    "µm": ("micrometer", 1e-6),
+    "um": ("micrometer", 1e-6),
+    "mm": ("millimeter", 1e-3),
+    "cm": ("centimeter", 1e-2),
+    "m": ("meter", 1.0),
+}
+
+
+def get_length_unit(unit: Any) -> Tuple[str, Optional[float]]:
+    """
+    Returns the OME-NGFF name and the size in meters of a length unit.
+
+    Args:
+        unit (str): An OME-XML unit symbol such as "µm", or an OME-NGFF unit name such as
+            "micrometer". Enum values, such as those of ome_types, are also accepted.
+
+    Returns:
+        Tuple[str, float]: The unit name, and its size in meters, or None if it is not known.
+    """
+    unit = str(getattr(unit, "value", unit))
+    for name, meters in LENGTH_UNITS.values():
+        if unit == name:
+            return name, meters
+    return LENGTH_UNITS.get(unit, (unit, None))
 
 
 class VolumeGenerator:
@@ -21,7 +61,7 @@ class VolumeGenerator:
         _source_dir (str): Directory containing the source image files.
         _group_by (str): Criterion for grouping images ('c', 't', or 'z').
         _file_pattern (str): Pattern to match the image files.
-        _out_dir (str): Output directory for the generated Zarr array.
+        _out_dir (str | dict): Output location for the generated Zarr array.
         _image_name (str): Name of the output Zarr array.
         _X (int): Width of the images.
         _Y (int): Height of the images.
@@ -31,14 +71,20 @@ class VolumeGenerator:
         _x_unit (str): Unit of measurement for X dimension.
         _y_unit (str): Unit of measurement for Y dimension.
         _z_unit (str): Unit of measurement for Z dimension.
+        _x_size (float): Physical size of a voxel in X.
+        _y_size (float): Physical size of a voxel in Y.
+        _z_size (float): Physical size of a voxel in Z.
         files (List[str]): List of image file paths.
         _zarr_spec (Dict[str, Any]): Specification for the Zarr array.
         _base_scale_key (int): Base scale key for the Zarr array.
+        _channel_chunk_size (int): Number of channels stored in a chunk.
+        _chunk_shape (Tuple[int, int, int]): The z, y and x size of a chunk.
+        _max_in_flight_writes (int): The maximum number of chunk writes in flight per task.
     """    
     _source_dir: str
     _group_by: str
     _file_pattern: str
-    _out_dir: str
+    _out_dir: Location
     _image_name: str
     _X: int
     _Y: int
@@ -48,9 +94,15 @@ class VolumeGenerator:
     _x_unit: str
     _y_unit: str
     _z_unit: str
+    _x_size: float
+    _y_size: float
+    _z_size: float
     files: List[str]
     _zarr_spec: Dict[str, Any]
     _base_scale_key: int
+    _channel_chunk_size: int
+    _chunk_shape: Tuple[int, int, int]
+    _max_in_flight_writes: int
 
     VALID_GROUP_BY = {'c', 't', 'z'}  # Define allowed values
     CHUNK_SIZE = 1024
@@ -60,9 +112,12 @@ class VolumeGenerator:
         source_dir: str,
         group_by: str,
         file_pattern: str,
-        out_dir: str,
+        out_dir: Location,
         image_name: str,
-        base_scale_key: int = 0
+        base_scale_key: int = 0,
+        channel_chunk_size: int = 1,
+        chunk_shape: Optional[Tuple[int, int, int]] = None,
+        max_in_flight_writes: int = MAX_IN_FLIGHT_WRITES,
     ) -> None:
         """
         Initialize the VolumeGenerator.
@@ -71,12 +126,27 @@ class VolumeGenerator:
             source_dir (str): Directory containing the source image files.
             group_by (str): Criterion for grouping images ('c', 't', or 'z').
             file_pattern (str): Pattern to match the image files.
-            out_dir (str): Output directory for the generated Zarr array.
+            out_dir (str | dict): Output directory for the generated Zarr array. It can also be a
+                kvstore URL such as "gs://bucket/path" or a tensorstore kvstore spec.
             image_name (str): Name of the output Zarr array.
             base_scale_key (int, optional): Base scale key for the Zarr array. Defaults to 0.
+            channel_chunk_size (int, optional): Number of channels stored in a chunk. Defaults to 1.
+            chunk_shape (Tuple[int, int, int], optional): The z, y and x size of a chunk, such as
+                (64, 256, 256) for 3D access. The slices of a chunk are read and written together.
+                Defaults to (1, 1024, 1024), one chunk per slice.
+            max_in_flight_writes (int, optional): The maximum number of chunk writes in flight
+                in every task, each holding a chunk buffer. Defaults to 16.
         """
         if group_by not in self.VALID_GROUP_BY:
             raise ValueError(f"group_by must be one of {self.VALID_GROUP_BY}")
+        if channel_chunk_size < 1:
+            raise ValueError("channel_chunk_size must be positive")
+        if chunk_shape is None:
+            chunk_shape = (1, self.CHUNK_SIZE, self.CHUNK_SIZE)
+        if len(chunk_shape) != 3 or min(chunk_shape) < 1:
+            raise ValueError("chunk_shape must be three positive sizes")
+        if max_in_flight_writes < 1:
+            raise ValueError("max_in_flight_writes must be positive")
         
         self._source_dir = source_dir
         self._group_by = group_by
@@ -84,6 +154,9 @@ class VolumeGenerator:
         self._out_dir = out_dir
         self._image_name = image_name
         self._base_scale_key = base_scale_key        
+        self._channel_chunk_size = channel_chunk_size
+        self._chunk_shape = tuple(chunk_shape)
+        self._max_in_flight_writes = max_in_flight_writes
 
     def init_base_zarr_file(self):
         """
@@ -106,18 +179,26 @@ class VolumeGenerator:
             self._X = br.X
             self._Y = br.Y
             dtype = br.dtype
-            if br.physical_size_x[1] is not None:
-                self._x_unit = br.physical_size_x[1]
-            else:
-                self._x_unit = "micrometer"
-            if br.physical_size_y[1] is not None:
-                self._y_unit = br.physical_size_y[1]
-            else:
-                self._y_unit = "micrometer"
-            if br.physical_size_z[1] is not None:
-                self._z_unit = br.physical_size_z[1]
-            else:
-                self._z_unit = "micrometer"
+            x_size, x_unit = br.physical_size_x
+            y_size, y_unit = br.physical_size_y
+            z_size, z_unit = br.physical_size_z
+
+        # the voxel sizes are written to the scale of the base level, from which
+        # PyramidGenerator3D chooses the downsampling factors of anisotropic volumes. A missing
+        # x or y size is taken from the other axis, and a missing z size, such as that of 2D
+        # images, from x, so the voxels are treated as isotropic rather than as 1 unit deep
+        if not x_size:
+            x_size, x_unit = y_size, y_unit
+        if not y_size:
+            y_size, y_unit = x_size, x_unit
+        if not z_size:
+            z_size, z_unit = x_size, x_unit
+        self._x_size = x_size or 1.0
+        self._y_size = y_size or 1.0
+        self._z_size = z_size or 1.0
+        self._x_unit = get_length_unit(x_unit)[0] if x_size and x_unit else "micrometer"
+        self._y_unit = get_length_unit(y_unit)[0] if y_size and y_unit else "micrometer"
+        self._z_unit = get_length_unit(z_unit)[0] if z_size and z_unit else "micrometer"
 
         self._Z = 1
         self._T = 1
@@ -134,16 +215,20 @@ class VolumeGenerator:
 
         self._zarr_spec = {
             "driver": "zarr",
-            "kvstore": {
-                "driver": "file",
-                "path": f"{self._out_dir}/{self._image_name}/{self._base_scale_key}",
-            },
+            "kvstore": get_kvstore_spec(
+                join_location(self._out_dir, self._image_name, str(self._base_scale_key))
+            ),
             "create": True,
             "delete_existing": False,
             "open": True,
             "metadata": {
                 "shape": [self._C, self._Z, self._Y, self._X],
-                "chunks": [1, 1, self.CHUNK_SIZE, self.CHUNK_SIZE],
+                "chunks": [
+                    min(self._channel_chunk_size, self._C),
+                    min(self._chunk_shape[0], self._Z),
+                    self._chunk_shape[1],
+                    self._chunk_shape[2],
+                ],
                 "dtype": np.dtype(dtype).str,
                 "dimension_separator": "/",
                 "compressor": {
@@ -161,51 +246,137 @@ class VolumeGenerator:
                 "file_io_sync": False,
             },
         }
-    def layer_writer(self, args: Tuple[str, Dict[str, Any], int, int]) -> None:
+    def _write_layers(
+        self,
+        zarr_array: ts.TensorStore,
+        tile_readers: List[Callable[[int, int, int, int], np.ndarray]],
+        Y: int,
+        X: int,
+        z: int,
+        c: int,
+    ) -> None:
         """
-        Write a single layer of the volume to the Zarr array.
+        Write a block of layers that share a chunk to the Zarr array, one chunk tile at a time.
 
         Args:
-            args (Tuple[str, dict, int, int]): Tuple containing input file path, Zarr specification, z-index, and c-index.
+            zarr_array (ts.TensorStore): The Zarr array.
+            tile_readers (List[Callable]): For every layer, a function that returns the
+                [y, y_max) x [x, x_max) tile of the layer, called with y, y_max, x and x_max.
+            Y (int): Height of the layers.
+            X (int): Width of the layers.
+            z (int): The z-index of the first layer.
+            c (int): The c-index of the first layer.
+        """
+        if self._group_by == "z":
+            layers = zarr_array[c, z : z + len(tile_readers)]
+        else:
+            layers = zarr_array[c : c + len(tile_readers), z]
+        chunk_y: int = self._chunk_shape[1]
+        chunk_x: int = self._chunk_shape[2]
+        # the oldest write is awaited before a new one is started, so the buffers of the
+        # completed writes are released
+        write_futures: collections.deque = collections.deque()
+        for y in range(0, Y, chunk_y):
+            y_max: int = min([Y, y + chunk_y])
+            for x in range(0, X, chunk_x):
+                x_max: int = min([X, x + chunk_x])
+                if len(write_futures) >= self._max_in_flight_writes:
+                    write_futures.popleft().result()
+                write_futures.append(
+                    layers[:, y:y_max, x:x_max].write(
+                        np.stack([read_tile(y, y_max, x, x_max) for read_tile in tile_readers])
+                    )
+                )
+
+        for future in write_futures:
+            future.result()
+
+    def layer_writer(self, args: Tuple[List[str], Dict[str, Any], int, int]) -> None:
         """
-        input_file: str = args[0]
+        Write a block of layers that share a chunk to the Zarr array.
+
+        The input files hold consecutive channels starting at the c-index, or a slab of
+        consecutive z-slices starting at the z-index, so that every chunk is written once
+        with all of its channels and slices.
+
+        Args:
+            args (Tuple[List[str], dict, int, int]): Tuple containing input file paths, Zarr specification, z-index, and c-index.
+        """
+        input_files: List[str] = args[0]
         zarr_spec: dict = args[1]
         z: int = args[2]
         c: int = args[3]
 
         zarr_array: ts.TensorStore = ts.open(zarr_spec).result()
-        write_futures: List[ts.Future[None]] = []
+        readers: List[BioReader] = []
         try:
-            br: BioReader = BioReader(input_file, backend="tensorstore")
-            for y in range(0, br.Y, self.CHUNK_SIZE):
-                y_max: int = min([br.Y, y + self.CHUNK_SIZE])
-                for x in range(0, br.X, self.CHUNK_SIZE):
-                    x_max: int = min([br.X, x + self.CHUNK_SIZE])
-                    write_futures.append(
-                        zarr_array[c, z, y:y_max, x:x_max].write(
-                            br[y:y_max, x:x_max, 0, 0, 0].squeeze()
-                        )
+            for input_file in input_files:
+                readers.append(BioReader(input_file, backend="tensorstore"))
+            self._write_layers(
+                zarr_array,
+                [
+                    lambda y, y_max, x, x_max, br=br: br[y:y_max, x:x_max, 0, 0, 0].reshape(
+                        y_max - y, x_max - x
                     )
+                    for br in readers
+                ],
+                readers[0].Y,
+                readers[0].X,
+                z,
+                c,
+            )
+        finally:
+            for br in readers:
+                br.close()
 
-            for future in write_futures:
-                future.result()
-        except Exception as e:
-            print(f"Caught an exception for item : {e}")
-
-    def generate_volume(self):
+    def generate_volume(self, ingest: str = "process", num_workers: Optional[int] = None):
         """
         Generate the complete volume by initializing the Zarr file and writing the image stack.
+
+        Args:
+            ingest (str, optional): "process" to write the image stack with `write_image_stack`,
+                or "thread" to write it with `ingest_image_stack`. Defaults to "process".
+            num_workers (int, optional): The number of threads of the "thread" ingest.
+
+        Raises:
+            RuntimeError: If files fail to be written.
         """
+        if ingest not in ("process", "thread"):
+            raise ValueError('ingest must be "process" or "thread"')
         self.init_base_zarr_file()
-        self.write_image_stack()
+        if ingest == "process":
+            self.write_image_stack()
+        else:
+            report = self.ingest_image_stack(num_workers)
+            self._raise_write_errors(report["errors"])
         self._create_zattr_file()
 
-    def write_image_stack(self):
+    def _raise_write_errors(self, errors: Dict[str, str]) -> None:
         """
-        Write the entire image stack to the Zarr array using parallel processing.
+        Raises an error listing the files that failed to be written, if there are any.
+
+        Args:
+            errors (dict): The error of every file that failed to be written.
+
+        Raises:
+            RuntimeError: If files failed to be written.
+        """
+        if errors:
+            raise RuntimeError(
+                f"Failed to write {len(errors)} files: "
+                + "; ".join(f"{file}: {error}" for file, error in errors.items())
+            )
+
+    def _get_layer_blocks(self) -> List[Tuple[List[str], int, int]]:
+        """
+        Returns the blocks of layers that share a chunk: the channels of a chunk, or the
+        z-slab of slices of a chunk.
+
+        Returns:
+            list: The input file paths, z-index and c-index of every block.
         """
         count = 0
-        arg_list = []
+        blocks = []
         for file_name in self.files:
             t = 0
             c = 0
@@ -219,12 +390,111 @@ class VolumeGenerator:
             else:
                 pass
 
-            arg_list.append((file_name, self._zarr_spec, z, c, t))
+            if (self._group_by == "c" and c % self._channel_chunk_size != 0) or (
+                self._group_by == "z" and z % self._chunk_shape[0] != 0
+            ):
+                blocks[-1][0].append(file_name)
+            else:
+                blocks.append(([file_name], z, c))
             count += 1
+        return blocks
+
+    def write_image_stack(self):
+        """
+        Write the entire image stack to the Zarr array using parallel processing.
+
+        Layers that share a chunk are handled by the same task: the channels of a chunk,
+        or the z-slab of slices of a chunk. A failed task does not stop the others, the
+        failures are raised once all the tasks are done.
+
+        Raises:
+            RuntimeError: If files fail to be written.
+        """
+        errors: Dict[str, str] = {}
         with concurrent.futures.ProcessPoolExecutor(
             max_workers=os.cpu_count() // 2, mp_context=get_context("spawn")
         ) as executor:
-            executor.map(self.layer_writer, arg_list)
+            futures = {
+                executor.submit(self.layer_writer, (files, self._zarr_spec, z, c)): files
+                for files, z, c in self._get_layer_blocks()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                error = future.exception()
+                if error is not None:
+                    for input_file in futures[future]:
+                        errors[input_file] = str(error)
+        self._raise_write_errors(errors)
+
+    def ingest_image_stack(self, num_workers: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Write the entire image stack to the Zarr array using threads.
+
+        All the threads write to a single TensorStore, and the tiles are read with the OME-TIFF
+        reader of argolid, which does not hold the GIL, so nothing is pickled and nothing is
+        reopened for every file. The input files must be tiled OME-TIFF files.
+
+        Args:
+            num_workers (int, optional): The number of threads. Defaults to half of the CPUs.
+
+        Returns:
+            dict: The "files" written, with the seconds spent reading each file, its bytes and
+                its throughput in MB/s, the "errors" of the files that failed, and the total
+                "seconds", "bytes" and "megabytes_per_second" of the ingest.
+        """
+        zarr_array: ts.TensorStore = ts.open(self._zarr_spec).result()
+        report: Dict[str, Any] = {"files": {}, "errors": {}}
+        report_lock = threading.Lock()
+
+        def write_block(block: Tuple[List[str], int, int]) -> None:
+            input_files, z, c = block
+            try:
+                readers = [OmeTiffTileReaderCPP(input_file) for input_file in input_files]
+                read_seconds = [0.0] * len(readers)
+
+                def timed_reader(i: int) -> Callable[[int, int, int, int], np.ndarray]:
+                    def read_tile(y: int, y_max: int, x: int, x_max: int) -> np.ndarray:
+                        start = time.perf_counter()
+                        tile = readers[i].ReadTile(y, y_max, x, x_max)
+                        read_seconds[i] += time.perf_counter() - start
+                        return tile
+
+                    return read_tile
+
+                self._write_layers(
+                    zarr_array,
+                    [timed_reader(i) for i in range(len(readers))],
+                    readers[0].Height(),
+                    readers[0].Width(),
+                    z,
+                    c,
+                )
+            except Exception as e:
+                with report_lock:
+                    for input_file in input_files:
+                        report["errors"][input_file] = str(e)
+                return
+            with report_lock:
+                for input_file, reader, seconds in zip(input_files, readers, read_seconds):
+                    num_bytes = (
+                        reader.Height() * reader.Width() * np.dtype(reader.DataType()).itemsize
+                    )
+                    report["files"][input_file] = {
+                        "seconds": seconds,
+                        "bytes": num_bytes,
+                        "megabytes_per_second": num_bytes / 1e6 / seconds if seconds > 0 else 0.0,
+                    }
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_workers or max(1, (os.cpu_count() or 2) // 2)
+        ) as executor:
+            list(executor.map(write_block, self._get_layer_blocks()))
+        report["seconds"] = time.perf_counter() - start
+        report["bytes"] = sum(stats["bytes"] for stats in report["files"].values())
+        report["megabytes_per_second"] = (
+            report["bytes"] / 1e6 / report["seconds"] if report["seconds"] > 0 else 0.0
+        )
+        return report
 
     def _get_default_axes_metadata(self) -> List[dict]:
         """
@@ -234,9 +504,9 @@ class VolumeGenerator:
         """
         axes_metadata: List[dict] = [
                         {"name": "c", "type": "channel"},
-                        {"name": "z", "type": "space", "unit": "micrometer"},
-                        {"name": "y", "type": "space", "unit": "micrometer"},
-                        {"name": "x", "type": "space", "unit": "micrometer"},
+                        {"name": "z", "type": "space", "unit": self._z_unit},
+                        {"name": "y", "type": "space", "unit": self._y_unit},
+                        {"name": "x", "type": "space", "unit": self._x_unit},
                     ]
         return axes_metadata
 
@@ -246,14 +516,15 @@ class VolumeGenerator:
         Creates a .zattrs file for the zarr pyramid.
         """
         attr_dict: dict = {}
+        image_loc = join_location(self._out_dir, self._image_name)
         
-        if os.path.exists(f"{self._out_dir}/{self._image_name}/.zattrs"):
-            with open(f"{self._out_dir}/{self._image_name}/.zattrs", "r") as json_file:
-                attr_dict_base = json.load(json_file)         
-                if "axes" in attr_dict_base:
-                    axes_metadata = attr_dict_base["axes"]
-                else:
-                    axes_metadata = self._get_default_axes_metadata()
+        attr_bytes = read_kvstore_file(image_loc, ".zattrs")
+        if attr_bytes is not None:
+            attr_dict_base = json.loads(attr_bytes)
+            if "axes" in attr_dict_base:
+                axes_metadata = attr_dict_base["axes"]
+            else:
+                axes_metadata = self._get_default_axes_metadata()
         else:
             axes_metadata = self._get_default_axes_metadata()
 
@@ -261,7 +532,7 @@ class VolumeGenerator:
         multiscale_metadata: list = [
             {
             "coordinateTransformations": [
-                {"scale": [1, 1, 1, 1], "type": "scale"}
+                {"scale": [1, self._z_size, self._y_size, self._x_size], "type": "scale"}
             ],
             "path": f"{self._base_scale_key}",
             }
@@ -274,8 +545,7 @@ class VolumeGenerator:
 
         final_attr_dict = {"multiscales": [attr_dict]}
 
-        with open(f"{self._out_dir}/{self._image_name}/.zattrs", "w") as json_file:
-            json.dump(final_attr_dict, json_file)
+        write_kvstore_file(image_loc, ".zattrs", json.dumps(final_attr_dict))
 
 class PyramidGenerator3D:
     """
@@ -285,78 +555,88 @@ class PyramidGenerator3D:
     forming a multi-resolution pyramid for efficient data access at different scales.
 
     Attributes:
-        _zarr_loc_dir (str): Directory containing the base Zarr array.
+        _zarr_loc_dir (str | dict): Location of the base Zarr array.
         _base_scale_key (int): Key of the base scale in the Zarr array.
         _image_name (str): Name of the image derived from the Zarr directory.
+        _chunk_shape (Tuple[int, int, int]): The z, y and x size of a chunk of the levels, or
+            None to use the chunk shape of the base.
+        _voxel_size (Tuple[float, float, float]): The z, y and x physical size of a voxel of the
+            base, or None to read it from the .zattrs file.
+        _max_in_flight_writes (int): The maximum number of chunk writes in flight.
     """
 
-    _zarr_loc_dir: str
+    _zarr_loc_dir: Location
     _base_scale_key: int
     _image_name: str
+    _chunk_shape: Optional[Tuple[int, int, int]]
+    _voxel_size: Optional[Tuple[float, float, float]]
+    _max_in_flight_writes: int
     
     CHUNK_SIZE = 1024
 
-    def __init__(self, zarr_loc_dir, base_scale_key):
+    def __init__(
+        self,
+        zarr_loc_dir,
+        base_scale_key,
+        chunk_shape=None,
+        voxel_size=None,
+        max_in_flight_writes=MAX_IN_FLIGHT_WRITES,
+    ):
         """
         Initialize the PyramidGenerator3D.
 
         Args:
-            zarr_loc_dir (str): Directory containing the base Zarr array.
+            zarr_loc_dir (str | dict): Directory containing the base Zarr array. It can also be a
+                kvstore URL or a tensorstore kvstore spec.
             base_scale_key (int): Key of the base scale in the Zarr array.
+            chunk_shape (Tuple[int, int, int], optional): The z, y and x size of a chunk of the
+                generated levels, capped at the size of the level. Defaults to the chunk shape of
+                the base, so the levels keep the layout of the base, such as the z-slabs written by
+                `VolumeGenerator`.
+            voxel_size (Tuple[float, float, float], optional): The z, y and x physical size of a
+                voxel of the base, in the units of the axes of the base, which sets the
+                downsampling factors of every axis. Defaults to the scale of the base in the
+                .zattrs file, such as the one written by `VolumeGenerator`, or isotropic voxels if
+                there is none.
+            max_in_flight_writes (int, optional): The maximum number of chunk writes in flight,
+                each holding a chunk buffer. Defaults to 16.
         """
+        if chunk_shape is not None and (len(chunk_shape) != 3 or min(chunk_shape) < 1):
+            raise ValueError("chunk_shape must be three positive sizes")
+        if max_in_flight_writes < 1:
+            raise ValueError("max_in_flight_writes must be positive")
         self._zarr_loc_dir = zarr_loc_dir
         self._base_scale_key = base_scale_key
+        self._chunk_shape = tuple(chunk_shape) if chunk_shape is not None else None
+        self._voxel_size = tuple(voxel_size) if voxel_size is not None else None
+        self._max_in_flight_writes = max_in_flight_writes
 
-        self._image_name = os.path.basename(self._zarr_loc_dir)
+        zarr_loc_path = zarr_loc_dir["path"] if isinstance(zarr_loc_dir, dict) else zarr_loc_dir
+        self._image_name = os.path.basename(zarr_loc_path.rstrip("/"))
 
-    def downsample_pyramid(self, level: int) -> None:
+    def _get_level_write_spec(
+        self, level: int, shape: List[int], dtype: np.dtype
+    ) -> Dict[str, Any]:
         """
-        Downsamples the pyramid at the specified level.
-
-        This method creates a downsampled version of the base image at the given pyramid level.
-        It uses the TensorStore library to read the base image, downsample it, and write the
-        result to a new Zarr array.
+        Returns the Zarr specification for writing a level of the pyramid.
 
         Args:
-            level (int): The pyramid level to generate. This determines the downsampling factor,
-                         which is 2^level in each dimension.
+            level (int): The pyramid level.
+            shape (List[int]): The shape of the level.
+            dtype (np.dtype): The data type of the level.
 
-        The method performs the following steps:
-        1. Sets up the downsampling specification using TensorStore.
-        2. Opens the downsampled array for reading.
-        3. Creates a new Zarr array specification for writing the downsampled data.
-        4. Opens the new Zarr array for writing.
-        5. Reads chunks from the downsampled array and writes them to the new Zarr array.
-
-        The downsampled array is written in chunks to optimize performance and memory usage.
+        Returns:
+            Dict[str, Any]: The TensorStore specification of the level.
         """
-        ds_spec: Dict[str, Any] = {
-            "driver": "downsample",
-            "downsample_factors": [1, 2**level, 2**level, 2**level],
-            "downsample_method": "mean",
-            "base": {
-                "driver": "zarr",
-                "kvstore": {
-                    "driver": "file",
-                    "path": f"{self._zarr_loc_dir}/{self._base_scale_key}",
-                },
-            },
-        }
-
-        ds_zarr_array: ts.TensorStore = ts.open(ds_spec).result()
-        [C, Z, Y, X] = ds_zarr_array.shape
-        ds_write_spec: Dict[str, Any] = {
+        return {
             "driver": "zarr",
-            "kvstore": {
-                "driver": "file",
-                "path": f"{self._zarr_loc_dir}/{level}",
-            },
+            "kvstore": get_kvstore_spec(join_location(self._zarr_loc_dir, str(level))),
             "create": True,
             "delete_existing": True,
             "metadata": {
-                "shape": ds_zarr_array.shape,
-                "chunks": [1, 1, self.CHUNK_SIZE, self.CHUNK_SIZE],
-                "dtype": np.dtype(ds_zarr_array.dtype.numpy_dtype).str,
+                "shape": list(shape),
+                "chunks": self._get_level_chunks(shape),
+                "dtype": np.dtype(dtype).str,
                 "dimension_separator": "/",
                 "compressor": {
                     "id": "blosc",
@@ -368,43 +648,366 @@ class PyramidGenerator3D:
             },
         }
 
-        ds_zarr_array_write: ts.TensorStore = ts.open(ds_write_spec).result()
-        write_futures: List[ts.Future[None]] = []        
-        for c in range(C):
-            for z in range(Z):
-                for y in range(0, Y, self.CHUNK_SIZE):
-                    y_max = min([Y, y + self.CHUNK_SIZE])
-                    for x in range(0, X, self.CHUNK_SIZE):
-                        x_max = min([X, x + self.CHUNK_SIZE])
-                        write_futures.append(
-                            ds_zarr_array_write[c, z, y:y_max, x:x_max].write(
-                                ds_zarr_array[c, z, y:y_max, x:x_max].read().result()
-                            )
-                        )
+    def _get_level_chunks(self, shape: List[int]) -> List[int]:
+        """
+        Returns the chunk shape of a level.
 
-        for future in write_futures:
-            future.result()
+        Args:
+            shape (List[int]): The shape of the level.
+        """
+        return [1] + [min(size, extent) for size, extent in zip(self._chunk_shape, shape[1:])]
+
+    def _get_chunk_grid(self, shape: List[int]) -> List[Tuple[int, int, int, int]]:
+        """
+        Returns the (c, z, y, x) chunk indices of a level.
+
+        Args:
+            shape (List[int]): The shape of the level.
+        """
+        [C, Z, Y, X] = shape
+        [_, chunk_z, chunk_y, chunk_x] = self._get_level_chunks(shape)
+        return [
+            (c, z, y, x)
+            for c in range(C)
+            for z in range(math.ceil(Z / chunk_z))
+            for y in range(math.ceil(Y / chunk_y))
+            for x in range(math.ceil(X / chunk_x))
+        ]
+
+    def _get_next_level_chunks(
+        self,
+        chunk: Tuple[int, int, int, int],
+        shape: List[int],
+        next_shape: List[int],
+        factors: List[int],
+    ) -> List[Tuple[int, int, int, int]]:
+        """
+        Returns the chunks of the next level that are downsampled from a chunk.
+
+        Args:
+            chunk (Tuple[int, int, int, int]): The (c, z, y, x) chunk index.
+            shape (List[int]): The shape of the level of the chunk.
+            next_shape (List[int]): The shape of the next level.
+            factors (List[int]): The downsampling factors of the next level.
+
+        Returns:
+            list: The (c, z, y, x) indices of the chunks of the next level.
+        """
+        chunks = self._get_level_chunks(shape)
+        next_chunks = self._get_level_chunks(next_shape)
+        axis_indices = [[chunk[0]]]
+        for axis in range(1, 4):
+            start = chunk[axis] * chunks[axis]
+            stop = min(start + chunks[axis], shape[axis])
+            # pixel i of the next level is downsampled from pixels [i * f, (i + 1) * f)
+            first = (start // factors[axis]) // next_chunks[axis]
+            last = ((stop - 1) // factors[axis]) // next_chunks[axis]
+            axis_indices.append(range(first, last + 1))
+        return [
+            (c, z, y, x)
+            for c in axis_indices[0]
+            for z in axis_indices[1]
+            for y in axis_indices[2]
+            for x in axis_indices[3]
+        ]
+
+    def _downsample_chunk(
+        self,
+        ds_zarr_array: ts.TensorStore,
+        ds_zarr_array_write: ts.TensorStore,
+        chunk: Tuple[int, int, int, int],
+        write_slots: threading.Semaphore,
+    ) -> ts.Future:
+        """
+        Starts writing a chunk of a level from the downsampled view of its source level.
+
+        The chunk is read, then written once one of the write slots is free. The slot is
+        released, together with the chunk buffer, when the write completes.
+
+        Args:
+            ds_zarr_array (ts.TensorStore): The downsampled view of the source level.
+            ds_zarr_array_write (ts.TensorStore): The level being written.
+            chunk (Tuple[int, int, int, int]): The (c, z, y, x) chunk index.
+            write_slots (threading.Semaphore): The writes that may be in flight.
+
+        Returns:
+            ts.Future: The future of the write.
+        """
+        c, z_index, y_index, x_index = chunk
+        [_, Z, Y, X] = ds_zarr_array.shape
+        [_, chunk_z, chunk_y, chunk_x] = self._get_level_chunks(ds_zarr_array.shape)
+        z = z_index * chunk_z
+        z_max = min([Z, z + chunk_z])
+        y = y_index * chunk_y
+        y_max = min([Y, y + chunk_y])
+        x = x_index * chunk_x
+        x_max = min([X, x + chunk_x])
+        image = ds_zarr_array[c, z:z_max, y:y_max, x:x_max].read().result()
+        write_slots.acquire()
+        try:
+            write_future = ds_zarr_array_write[c, z:z_max, y:y_max, x:x_max].write(image).commit
+        except BaseException:
+            write_slots.release()
+            raise
+        write_future.add_done_callback(lambda _: write_slots.release())
+        return write_future
+
+    def _run_chunk_tasks(
+        self,
+        tasks: Dict[Any, Callable[[], ts.Future]],
+        dependencies: Dict[Any, Any],
+        num_workers: int,
+    ) -> None:
+        """
+        Runs chunk tasks in a pool of threads, each task once all of its dependencies are done.
+
+        A task returns the future of its write, and is done when the write completes, so the
+        threads only wait for reads. After the first error, the queued tasks are dropped and
+        the writes already started are waited for, so that none of them is left holding a
+        write slot.
+
+        Args:
+            tasks (dict): The tasks, by key.
+            dependencies (dict): For every key, the keys of the tasks that wait for it. A task
+                runs once all the tasks it waits for are done.
+            num_workers (int): The number of threads.
+
+        Raises:
+            Exception: The first error raised by a task.
+        """
+        num_waiting: Dict[Any, int] = {}
+        for parents in dependencies.values():
+            for parent in parents:
+                num_waiting[parent] = num_waiting.get(parent, 0) + 1
+        ready: queue.Queue = queue.Queue()
+        for key in tasks:
+            if key not in num_waiting:
+                ready.put(key)
+
+        condition = threading.Condition()
+        state = {"done": 0, "writing": 0, "error": None}
+
+        def finish(key: Any, error: Optional[BaseException], is_write: bool = False) -> None:
+            with condition:
+                if is_write:
+                    state["writing"] -= 1
+                if error is not None:
+                    if state["error"] is None:
+                        state["error"] = error
+                else:
+                    state["done"] += 1
+                    for parent in dependencies.get(key, []):
+                        num_waiting[parent] -= 1
+                        if num_waiting[parent] == 0:
+                            ready.put(parent)
+                condition.notify_all()
+
+        def work() -> None:
+            while True:
+                key = ready.get()
+                if key is None:
+                    return
+                with condition:
+                    if state["error"] is not None:
+                        continue
+                try:
+                    write_future = tasks[key]()
+                except Exception as e:
+                    finish(key, e)
+                    continue
+                with condition:
+                    state["writing"] += 1
+                write_future.add_done_callback(
+                    lambda future, key=key: finish(key, future.exception(), True)
+                )
+
+        workers = [threading.Thread(target=work, daemon=True) for _ in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        with condition:
+            while state["done"] < len(tasks) and state["error"] is None:
+                condition.wait()
+        for _ in workers:
+            ready.put(None)
+        for worker in workers:
+            worker.join()
+        with condition:
+            while state["writing"] > 0:
+                condition.wait()
+        if state["error"] is not None:
+            raise state["error"]
+
+    def _open_base(self) -> ts.TensorStore:
+        """
+        Opens the base Zarr array, and takes the chunk shape of the levels from it if none
+        was given.
+        """
+        base = ts.open(
+            {
+                "driver": "zarr",
+                "kvstore": get_kvstore_spec(
+                    join_location(self._zarr_loc_dir, str(self._base_scale_key))
+                ),
+            }
+        ).result()
+        if self._chunk_shape is None:
+            self._chunk_shape = tuple(base.chunk_layout.read_chunk.shape[1:])
+        return base
+
+    def _read_base_attrs(self) -> Tuple[Optional[List[float]], Optional[List[dict]]]:
+        """
+        Returns the z, y and x scale of the base and the axes in the .zattrs file.
+
+        Returns:
+            tuple: The scale and the c, z, y and x axes, each None if it is not in the file.
+        """
+        attr_bytes = read_kvstore_file(self._zarr_loc_dir, ".zattrs")
+        if attr_bytes is None:
+            return None, None
+        multiscales = json.loads(attr_bytes).get("multiscales", [{}])[0]
+        axes = multiscales.get("axes")
+        if axes is not None and len(axes) != 4:
+            axes = None
+        for dataset in multiscales.get("datasets", []):
+            if dataset.get("path") != str(self._base_scale_key):
+                continue
+            for transform in dataset.get("coordinateTransformations", []):
+                if transform.get("type") == "scale" and len(transform["scale"]) == 4:
+                    return [float(size) for size in transform["scale"][1:]], axes
+        return None, axes
 
-    def _create_zattr_file(self, num_levels: int) -> None:        
+    def _get_base_scale(self) -> Tuple[float, float, float]:
+        """
+        Returns the z, y and x scale of the base, in the units of its axes.
+        """
+        if self._voxel_size is not None:
+            return self._voxel_size
+        scale, _ = self._read_base_attrs()
+        if scale is not None:
+            return tuple(scale)
+        return (1.0, 1.0, 1.0)
+
+    def _get_voxel_size(self) -> Tuple[float, float, float]:
+        """
+        Returns the z, y and x physical size of a voxel of the base, in meters when the units
+        of all the axes are known, so that axes in different units can be compared.
+        """
+        voxel_size = self._get_base_scale()
+        _, axes = self._read_base_attrs()
+        if axes is None:
+            return voxel_size
+        meters = [get_length_unit(axis.get("unit", ""))[1] for axis in axes[1:]]
+        if any(size is None for size in meters):
+            return voxel_size
+        return tuple(size * unit for size, unit in zip(voxel_size, meters))
+
+    def _get_downsample_factors(self, shape: List[int], num_levels: int) -> List[List[int]]:
+        """
+        Returns the downsampling factors of every level relative to the previous level.
+
+        At every level, the axes whose voxels are less than twice as large as the smallest
+        voxel size are downsampled by 2, and the others are kept, so anisotropic voxels become
+        closer to isotropic at every level. Axes of size 1 are never downsampled.
+
+        Args:
+            shape (List[int]): The shape of the base.
+            num_levels (int): Number of pyramid levels.
+
+        Returns:
+            list: The [c, z, y, x] factors of levels 1 to num_levels.
+        """
+        voxel_size = list(self._get_voxel_size())
+        extents = list(shape[1:])
+        factors = []
+        for _ in range(num_levels):
+            sizes = [size for size, extent in zip(voxel_size, extents) if extent > 1]
+            smallest_size = min(sizes) if sizes else 0.0
+            level_factors = [
+                2 if extent > 1 and size < 2 * smallest_size else 1
+                for size, extent in zip(voxel_size, extents)
+            ]
+            voxel_size = [size * f for size, f in zip(voxel_size, level_factors)]
+            extents = [math.ceil(extent / f) for extent, f in zip(extents, level_factors)]
+            factors.append([1] + level_factors)
+        return factors
+
+    def downsample_pyramid(
+        self,
+        level: int,
+        num_workers: Optional[int] = None,
+        max_in_flight_writes: Optional[int] = None,
+    ) -> None:
+        """
+        Downsamples the pyramid at the specified level.
+
+        This method creates a downsampled version of the base image at the given pyramid level.
+        It uses the TensorStore library to read the base image, downsample it, and write the
+        result to a new Zarr array. The chunks of the level are written by a pool of threads.
+
+        Args:
+            level (int): The pyramid level to generate. This determines the downsampling factor,
+                         which is 2^level in each dimension for isotropic voxels.
+            num_workers (int, optional): The number of threads, which is also the number of
+                reads in flight. Defaults to the number of CPUs.
+            max_in_flight_writes (int, optional): The maximum number of writes in flight.
+                Defaults to the one the generator was created with.
+        """
+        level_factors = self._get_downsample_factors(self._open_base().shape, level)
+        ds_spec: Dict[str, Any] = {
+            "driver": "downsample",
+            "downsample_factors": [math.prod(axis) for axis in zip(*level_factors)],
+            "downsample_method": "mean",
+            "base": {
+                "driver": "zarr",
+                "kvstore": get_kvstore_spec(
+                    join_location(self._zarr_loc_dir, str(self._base_scale_key))
+                ),
+            },
+        }
+
+        ds_zarr_array: ts.TensorStore = ts.open(ds_spec).result()
+        ds_zarr_array_write: ts.TensorStore = ts.open(
+            self._get_level_write_spec(level, ds_zarr_array.shape, ds_zarr_array.dtype.numpy_dtype)
+        ).result()
+        write_slots = threading.Semaphore(max_in_flight_writes or self._max_in_flight_writes)
+        tasks = {
+            chunk: functools.partial(
+                self._downsample_chunk, ds_zarr_array, ds_zarr_array_write, chunk, write_slots
+            )
+            for chunk in self._get_chunk_grid(ds_zarr_array.shape)
+        }
+        self._run_chunk_tasks(tasks, {}, num_workers or os.cpu_count() or 1)
+
+    def _create_zattr_file(self, num_levels: int, factors: Optional[List[List[int]]] = None) -> None:        
         """
         Creates a .zattrs file for the zarr pyramid.
+
+        Args:
+            num_levels (int): Number of pyramid levels.
+            factors (List[List[int]], optional): The downsampling factors of every level relative
+                to the previous level. Defaults to 2 on every axis.
         """
+        if factors is None:
+            factors = [[1, 2, 2, 2]] * num_levels
         attr_dict: dict = {}
 
         # add logic to constrain num_levels
 
-        axes_metadata = [
-            {"name": "c", "type": "channel"},
-            {"name": "z", "type": "space", "unit": "micrometer"},
-            {"name": "y", "type": "space", "unit": "micrometer"},
-            {"name": "x", "type": "space", "unit": "micrometer"},
-        ]
+        # the axes of the base, such as those written by VolumeGenerator, keep their units
+        _, axes_metadata = self._read_base_attrs()
+        if axes_metadata is None:
+            axes_metadata = [
+                {"name": "c", "type": "channel"},
+                {"name": "z", "type": "space", "unit": "micrometer"},
+                {"name": "y", "type": "space", "unit": "micrometer"},
+                {"name": "x", "type": "space", "unit": "micrometer"},
+            ]
         attr_dict["axes"] = axes_metadata
         multiscale_metadata: list = []
-        downsample_factor = 1
+        scale = [1] + list(self._get_base_scale())
         base_scale_metadata = {
             "coordinateTransformations": [
-                {"scale": [1, downsample_factor, downsample_factor, downsample_factor], "type": "scale"}
+                {"scale": list(scale), "type": "scale"}
             ],
             "path": f"{self._base_scale_key}",
         }
@@ -412,10 +1015,10 @@ class PyramidGenerator3D:
         multiscale_metadata.append(base_scale_metadata)
 
         for key in range(1, num_levels+1):
-            downsample_factor *= 2
+            scale = [size * f for size, f in zip(scale, factors[key - 1])]
             metadata = {
                 "coordinateTransformations": [
-                    {"scale": [1, downsample_factor, downsample_factor, downsample_factor], "type": "scale"}
+                    {"scale": list(scale), "type": "scale"}
                 ],
                 "path": f"{key}",
             }
@@ -428,21 +1031,63 @@ class PyramidGenerator3D:
 
         final_attr_dict = {"multiscales": [attr_dict]}
 
-        with open(f"{self._zarr_loc_dir}/.zattrs", "w") as json_file:
-            json.dump(final_attr_dict, json_file)
+        write_kvstore_file(self._zarr_loc_dir, ".zattrs", json.dumps(final_attr_dict))
 
-    def generate_pyramid(self, num_levels: int) -> None:
+    def generate_pyramid(
+        self,
+        num_levels: int,
+        num_workers: Optional[int] = None,
+        max_in_flight_writes: Optional[int] = None,
+    ) -> None:
         """
         Generate the multi-resolution pyramid.
 
         This method creates the .zattrs file for the pyramid and generates
         downsampled versions of the base image for each specified level.
 
+        Every level is downsampled from the previous level rather than from the base, so
+        the base is read once. Each axis is downsampled by 2, or kept when its voxels are
+        already at least twice as large as those of the finest axis, so anisotropic volumes
+        get closer to isotropic at every level. The chunks of all the levels are written by a single pool of
+        threads, and a chunk is written as soon as the chunks it is downsampled from are.
+
         Args:
             num_levels (int): Number of pyramid levels to generate.
+            num_workers (int, optional): The number of threads, which is also the number of
+                reads in flight. Defaults to the number of CPUs.
+            max_in_flight_writes (int, optional): The maximum number of writes in flight.
+                Defaults to the one the generator was created with.
         """
-        self._create_zattr_file(num_levels)
-        with concurrent.futures.ProcessPoolExecutor(
-            max_workers=os.cpu_count() // 2, mp_context=get_context("spawn")
-        ) as executor:
-            executor.map(self.downsample_pyramid, range(1, num_levels+1))
+        source: ts.TensorStore = self._open_base()
+        factors = self._get_downsample_factors(source.shape, num_levels)
+        self._create_zattr_file(num_levels, factors)
+        write_slots = threading.Semaphore(max_in_flight_writes or self._max_in_flight_writes)
+
+        tasks: Dict[Tuple[int, int, int, int, int], Callable[[], None]] = {}
+        dependencies: Dict[Tuple[int, int, int, int, int], List[Tuple[int, int, int, int, int]]] = {}
+        for level in range(1, num_levels + 1):
+            ds_zarr_array = ts.downsample(source, factors[level - 1], method="mean")
+            ds_zarr_array_write = ts.open(
+                self._get_level_write_spec(
+                    level, ds_zarr_array.shape, ds_zarr_array.dtype.numpy_dtype
+                )
+            ).result()
+            for chunk in self._get_chunk_grid(ds_zarr_array.shape):
+                tasks[(level,) + chunk] = functools.partial(
+                    self._downsample_chunk,
+                    ds_zarr_array,
+                    ds_zarr_array_write,
+                    chunk,
+                    write_slots,
+                )
+            if level > 1:
+                for chunk in self._get_chunk_grid(source.shape):
+                    dependencies[(level - 1,) + chunk] = [
+                        (level,) + next_chunk
+                        for next_chunk in self._get_next_level_chunks(
+                            chunk, source.shape, ds_zarr_array.shape, factors[level - 1]
+                        )
+                    ]
+            source = ds_zarr_array_write
+
+        self._run_chunk_tasks(tasks, dependencies, num_workers or os.cpu_count() or 1)
@@ -0,0 +1,56 @@
+import unittest
+import shutil
+import tempfile
+
+from argolid.chunk_index import ChunkIndex
+
+CHUNK_GRID = {0: (3, 5), 1: (2, 3)}
+
+
+class TestChunkIndex(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_shared_between_instances(self):
+        # two processes serving the same pyramid each open their own index
+        writer = ChunkIndex(self._dir, "composition_a", CHUNK_GRID, 2)
+        reader = ChunkIndex(self._dir, "composition_a", CHUNK_GRID, 2)
+        writer.add(0, [0, 1], 2, 4)
+        writer.add(1, [1], 0, 1)
+        assert reader.contains(0, 0, 2, 4)
+        assert reader.contains(0, 1, 2, 4)
+        assert reader.contains(1, 1, 0, 1)
+        assert not reader.contains(1, 0, 0, 1)
+        assert not reader.contains(0, 0, 2, 3)
+
+        reader.remove(0, [0], 2, 4)
+        assert not writer.contains(0, 0, 2, 4)
+        assert writer.contains(0, 1, 2, 4)
+
+    def test_reused_for_same_composition(self):
+        ChunkIndex(self._dir, "composition_a", CHUNK_GRID, 2).add(0, [0], 1, 1)
+        index = ChunkIndex(self._dir, "composition_a", CHUNK_GRID, 2)
+        assert index.contains(0, 0, 1, 1)
+
+    def test_reset_on_fingerprint_change(self):
+        ChunkIndex(self._dir, "composition_a", CHUNK_GRID, 2).add(0, [0, 1], 1, 1)
+        index = ChunkIndex(self._dir, "composition_b", CHUNK_GRID, 2)
+        assert not index.contains(0, 0, 1, 1)
+        assert not index.contains(0, 1, 1, 1)
+        # and reopening with the old fingerprint does not bring the chunks back
+        index = ChunkIndex(self._dir, "composition_a", CHUNK_GRID, 2)
+        assert not index.contains(0, 0, 1, 1)
+
+    def test_set_fingerprint_keeps_chunks(self):
+        index = ChunkIndex(self._dir, "composition_a", CHUNK_GRID, 2)
+        index.add(0, [0], 1, 1)
+        index.set_fingerprint("composition_b")
+        index = ChunkIndex(self._dir, "composition_b", CHUNK_GRID, 2)
+        assert index.contains(0, 0, 1, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,723 @@
+import unittest
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+import numpy as np
+import tensorstore as ts
+
+import argolid
+from argolid.prefetcher import ChunkPrefetcher, predict_chunks
+from argolid.pyramid_compositor import get_read_groups, get_zarr_context_spec
+
+IMAGE_SIZE = 1024
+
+
+BLOSC = {'id':'blosc', 'cname':'zstd', 'clevel':1, 'shuffle':1, 'blocksize':0}
+
+
+def write_input_pyramid(pyramid_dir, value, size=IMAGE_SIZE, num_levels=2, chunk_size=1024, compressor=BLOSC):
+    """Writes a constant image as an input pyramid of the compositor."""
+    for level in range(num_levels):
+        level_size = size // 2**level
+        zarr_array = ts.open({  'driver':'zarr',
+                                'kvstore':{'driver':'file', 'path':f'{pyramid_dir}/data.zarr/0/{level}'},
+                                'create':True,
+                                'metadata':{
+                                    'shape':[1, 1, 1, level_size, level_size],
+                                    'chunks':[1, 1, 1, chunk_size, chunk_size],
+                                    'dtype':'<u2',
+                                    'compressor':compressor,
+                                },
+                            }).result()
+        zarr_array.write(np.full((1, 1, 1, level_size, level_size), value, dtype=np.uint16)).result()
+    with open(f'{pyramid_dir}/data.zarr/0/.zattrs', 'w') as f:
+        f.write('{"multiscales": [{"datasets": [%s]}]}' % ", ".join(f'{{"path": "{l}"}}' for l in range(num_levels)))
+
+
+def output_chunk_file(output_dir, level, y_index, x_index):
+    return f'{output_dir}/plate.zarr/data.zarr/0/{level}/0.0.0.{y_index}.{x_index}'
+
+
+def read_output_chunk(output_dir, level, y_index, x_index):
+    zarr_array = ts.open({  'driver':'zarr',
+                            'kvstore':{'driver':'file', 'path':f'{output_dir}/plate.zarr/data.zarr/0/{level}'},
+                        }).result()
+    y_end = min((y_index + 1) * 1024, zarr_array.shape[3])
+    x_end = min((x_index + 1) * 1024, zarr_array.shape[4])
+    return zarr_array[0, 0, 0, y_index * 1024:y_end, x_index * 1024:x_end].read().result()
+
+
+class TestCompositorRecomposition(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        for name, value in [('bright', 999), ('dim', 7), ('blank', 0)]:
+            for chunk_size in [1024, 256]:
+                write_input_pyramid(f'{self._input_dir}/{name}_{chunk_size}', value, chunk_size=chunk_size)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_blank_image_replaces_earlier_composition(self):
+        # 1024 input chunks are copied to the output, 256 input chunks are assembled
+        for chunk_size in [1024, 256]:
+            compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+            compositor.set_composition({(0, 0, 0): f'{self._input_dir}/bright_{chunk_size}',
+                                        (1, 0, 0): f'{self._input_dir}/dim_{chunk_size}'})
+            compositor.materialize(levels=[0])
+            assert (read_output_chunk(self._output_dir, 0, 0, 0) == 999).all()
+
+            compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+            compositor.set_composition({(0, 0, 0): f'{self._input_dir}/blank_{chunk_size}',
+                                        (1, 0, 0): f'{self._input_dir}/dim_{chunk_size}'})
+            compositor.materialize(levels=[0])
+            assert (read_output_chunk(self._output_dir, 0, 0, 0) == 0).all()
+            assert (read_output_chunk(self._output_dir, 0, 0, 1) == 7).all()
+            shutil.rmtree(self._output_dir)
+
+    def test_missing_image_replaces_earlier_composition(self):
+        for chunk_size in [1024, 256]:
+            composition_map = {(0, 0, 0): f'{self._input_dir}/bright_{chunk_size}',
+                               (1, 0, 0): f'{self._input_dir}/dim_{chunk_size}'}
+            compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+            compositor.set_composition(composition_map)
+            compositor.materialize()
+            assert read_output_chunk(self._output_dir, 0, 0, 0).max() == 999
+
+            composition_map[(0, 0, 0)] = None
+            compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+            compositor.set_composition(composition_map)
+            compositor.materialize()
+            assert read_output_chunk(self._output_dir, 0, 0, 0).max() == 0
+            assert read_output_chunk(self._output_dir, 0, 0, 1).min() == 7
+            compositor.get_zarr_chunks([(0, 0, 0, 0), (0, 0, 0, 1)])
+            assert read_output_chunk(self._output_dir, 0, 0, 0).max() == 0
+            shutil.rmtree(self._output_dir)
+
+    def test_missing_image_replaces_earlier_batch(self):
+        composition_map = {(0, 0, 0): f'{self._input_dir}/bright_256',
+                           (1, 0, 0): f'{self._input_dir}/dim_256'}
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition(composition_map)
+        compositor.get_zarr_chunks([(0, 0, 0, 0), (0, 0, 0, 1)])
+
+        composition_map[(0, 0, 0)] = None
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition(composition_map)
+        compositor.get_zarr_chunks([(0, 0, 0, 0), (0, 0, 0, 1)])
+        assert read_output_chunk(self._output_dir, 0, 0, 0).max() == 0
+        assert read_output_chunk(self._output_dir, 0, 0, 1).min() == 7
+
+    def test_blank_batch_replaces_earlier_composition(self):
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition({(0, 0, 0): f'{self._input_dir}/bright_256',
+                                    (1, 0, 0): f'{self._input_dir}/dim_256'})
+        compositor.get_zarr_chunks([(0, 0, 0, 0), (0, 0, 0, 1)])
+
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition({(0, 0, 0): f'{self._input_dir}/blank_256',
+                                    (1, 0, 0): f'{self._input_dir}/dim_256'})
+        compositor.get_zarr_chunks([(0, 0, 0, 0), (0, 0, 0, 1)])
+        assert (read_output_chunk(self._output_dir, 0, 0, 0) == 0).all()
+        assert (read_output_chunk(self._output_dir, 0, 0, 1) == 7).all()
+
+
+class TestCompositorUpdate(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        write_input_pyramid(f'{self._input_dir}/dim', 7, chunk_size=256)
+        write_input_pyramid(f'{self._input_dir}/bright', 999, chunk_size=256)
+        write_input_pyramid(f'{self._input_dir}/small', 999, size=512, chunk_size=256)
+        # a 4096 x 4096 plate has 4 x 4 chunks at level 0 and 2 x 2 chunks at level 1
+        self._composition_map = {(x, y, 0): f'{self._input_dir}/dim' for x in range(4) for y in range(4)}
+        self._compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        self._compositor.set_composition(dict(self._composition_map))
+        self._compositor.materialize()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_swapped_image_removes_overlapping_chunks(self):
+        composition_map = dict(self._composition_map)
+        composition_map[(1, 2, 0)] = f'{self._input_dir}/bright'
+        self._compositor.update_composition(composition_map)
+        for level, num_chunks in [(0, 4), (1, 2)]:
+            for y_index in range(num_chunks):
+                for x_index in range(num_chunks):
+                    # the image at column 1 and row 2 is chunk (2, 1) at level 0 and a quarter
+                    # of chunk (1, 0) at level 1
+                    is_stale = (y_index, x_index) == ((2, 1) if level == 0 else (1, 0))
+                    assert os.path.exists(output_chunk_file(self._output_dir, level, y_index, x_index)) != is_stale
+
+        self._compositor.materialize()
+        assert (read_output_chunk(self._output_dir, 0, 2, 1) == 999).all()
+        level_1_chunk = read_output_chunk(self._output_dir, 1, 1, 0)
+        assert (level_1_chunk[:512, 512:] == 999).all()
+        assert level_1_chunk.sum() == 512 * 512 * 999 + 3 * 512 * 512 * 7
+
+    def test_image_of_another_shape_resets_composition(self):
+        composition_map = dict(self._composition_map)
+        composition_map[(0, 0, 0)] = f'{self._input_dir}/small'
+        self._compositor.update_composition(composition_map)
+        # the pyramid is composed again with 512 x 512 images
+        assert self._compositor._plate_image_shapes[0] == (1, 1, 1, 2048, 2048)
+        assert not os.path.exists(output_chunk_file(self._output_dir, 0, 3, 3))
+        assert not os.path.exists(output_chunk_file(self._output_dir, 1, 0, 0))
+
+
+class TestCompositorChunkBounds(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        write_input_pyramid(f'{self._input_dir}/dim', 7)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_last_chunk_bounds(self):
+        # a 2048 x 1024 plate has two chunks along x and one along y at level 0
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition({(0, 0, 0): f'{self._input_dir}/dim',
+                                    (1, 0, 0): f'{self._input_dir}/dim'})
+        compositor.get_zarr_chunk(0, 0, 0, 1)
+        assert (read_output_chunk(self._output_dir, 0, 0, 1) == 7).all()
+        with self.assertRaisesRegex(ValueError, 'x index'):
+            compositor.get_zarr_chunk(0, 0, 0, 2)
+        with self.assertRaisesRegex(ValueError, 'y index'):
+            compositor.get_zarr_chunk(0, 0, 1, 0)
+        with self.assertRaisesRegex(ValueError, 'y index'):
+            compositor.get_zarr_chunks([(0, 0, 0, 0), (0, 0, -1, 0)])
+        # at level 1 the plate fits in a single chunk
+        with self.assertRaisesRegex(ValueError, 'x index'):
+            compositor.get_zarr_chunk(1, 0, 0, 1)
+
+
+class TestReadGroups(unittest.TestCase):
+    def test_adjacent_regions_are_read_together(self):
+        row = [(slice(0, 1024), slice(x, x + 1024)) for x in range(0, 4096, 1024)]
+        assert get_read_groups(row) == [[0, 1, 2, 3]]
+        block = [(slice(y, y + 512), slice(x, x + 512)) for y in [0, 512] for x in [0, 512]]
+        assert get_read_groups(block) == [[0, 1, 2, 3]]
+
+    def test_sparse_regions_are_read_separately(self):
+        corners = [(slice(0, 1024), slice(0, 1024)), (slice(3072, 4096), slice(3072, 4096))]
+        assert get_read_groups(corners) == [[0], [1]]
+        # the bounding box of an L shape holds a chunk that was not requested
+        l_shape = [(slice(0, 1024), slice(0, 1024)), (slice(0, 1024), slice(1024, 2048)),
+                   (slice(1024, 2048), slice(1024, 2048))]
+        assert sorted(map(sorted, get_read_groups(l_shape))) == [[0, 1], [2]]
+
+
+class TestCompositorSparseBatch(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        write_input_pyramid(f'{self._input_dir}/large', 7, size=4096, chunk_size=256)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_sparse_batch(self):
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition({(0, 0, 0): f'{self._input_dir}/large'})
+        compositor.get_zarr_chunks([(0, 0, 0, 0), (0, 0, 3, 3), (0, 0, 3, 2)])
+        for y_index, x_index in [(0, 0), (3, 3), (3, 2)]:
+            assert (read_output_chunk(self._output_dir, 0, y_index, x_index) == 7).all()
+        assert (read_output_chunk(self._output_dir, 0, 1, 1) == 0).all()
+
+
+class TestCompositorPrefetch(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        write_input_pyramid(f'{self._input_dir}/dim', 7)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_close_stops_prefetching_threads(self):
+        num_threads = threading.active_count()
+        with argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr',
+                                       prefetch_budget=4, prefetch_workers=2) as compositor:
+            assert threading.active_count() == num_threads + 2
+            compositor.set_composition({(0, 0, 0): f'{self._input_dir}/dim',
+                                        (1, 0, 0): f'{self._input_dir}/dim'})
+            compositor.get_zarr_chunk(0, 0, 0, 0)
+        assert threading.active_count() == num_threads
+        # chunks can still be requested without prefetching
+        compositor.get_zarr_chunk(0, 0, 0, 1)
+        assert (read_output_chunk(self._output_dir, 0, 0, 1) == 7).all()
+        compositor.close()
+
+    def test_failed_prefetch_is_logged(self):
+        def fetch(level, channel, y_index, x_index):
+            raise RuntimeError("unreadable input")
+
+        prefetcher = ChunkPrefetcher(budget=1, num_workers=1)
+        try:
+            with self.assertLogs('argolid.prefetcher', level='WARNING') as logs:
+                prefetcher.begin_request()
+                prefetcher.end_request((0, 0, 0, 0), fetch)
+                for _ in range(100):
+                    if logs.records:
+                        break
+                    threading.Event().wait(0.01)
+        finally:
+            prefetcher.close()
+        assert 'unreadable input' in logs.output[0]
+
+    def test_predicted_chunks(self):
+        # the neighbours, then the parent, then the children
+        assert predict_chunks(1, 0, 1, 1) == [(1, 0, 1, 0), (1, 0, 1, 2), (1, 0, 0, 1), (1, 0, 2, 1),
+                                              (1, 0, 0, 0), (1, 0, 0, 2), (1, 0, 2, 0), (1, 0, 2, 2),
+                                              (2, 0, 0, 0),
+                                              (0, 0, 2, 2), (0, 0, 2, 3), (0, 0, 3, 2), (0, 0, 3, 3)]
+        # chunks before the first row and column are dropped, level 0 has no children
+        assert predict_chunks(0, 0, 0, 0) == [(0, 0, 0, 1), (0, 0, 1, 0), (0, 0, 1, 1), (1, 0, 0, 0)]
+
+    def test_queued_chunks_within_budget(self):
+        prefetcher = ChunkPrefetcher(budget=3, num_workers=1)
+        try:
+            # a second request in progress keeps the queued chunks from being generated
+            prefetcher.begin_request()
+            prefetcher.begin_request()
+            prefetcher.end_request((1, 0, 1, 1), lambda *chunk: None)
+            # the most likely chunks are kept, and the most likely one is generated first
+            assert list(prefetcher._pending) == [(1, 0, 0, 1), (1, 0, 1, 2), (1, 0, 1, 0)]
+        finally:
+            prefetcher.close()
+
+    def test_predicted_chunks_are_generated(self):
+        composition_map = {(x, y, 0): f'{self._input_dir}/dim' for x in range(3) for y in range(3)}
+        with argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr',
+                                       prefetch_budget=13) as compositor:
+            compositor.set_composition(composition_map)
+            compositor.get_zarr_chunk(0, 0, 1, 1)
+            # the neighbours and the parent, the chunks outside of the pyramid are ignored
+            predicted = [(0, y, x) for y in range(3) for x in range(3) if (y, x) != (1, 1)] + [(1, 0, 0)]
+            for _ in range(1000):
+                if all(os.path.exists(output_chunk_file(self._output_dir, *chunk)) for chunk in predicted):
+                    break
+                threading.Event().wait(0.01)
+        for chunk in predicted:
+            assert (read_output_chunk(self._output_dir, *chunk) == 7).all(), chunk
+
+    def test_prefetch_budget(self):
+        composition_map = {(x, y, 0): f'{self._input_dir}/dim' for x in range(3) for y in range(3)}
+        with argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr',
+                                       prefetch_budget=2) as compositor:
+            compositor.set_composition(composition_map)
+            compositor.get_zarr_chunk(0, 0, 1, 1)
+            # only the two most likely chunks are generated
+            predicted = [(0, 1, 0), (0, 1, 2)]
+            for _ in range(1000):
+                if all(os.path.exists(output_chunk_file(self._output_dir, *chunk)) for chunk in predicted):
+                    break
+                threading.Event().wait(0.01)
+        written = sorted(name for name in os.listdir(f'{self._output_dir}/plate.zarr/data.zarr/0/0')
+                         if not name.startswith('.'))
+        assert written == ['0.0.0.1.0', '0.0.0.1.1', '0.0.0.1.2']
+        assert not os.path.exists(f'{self._output_dir}/plate.zarr/data.zarr/0/1/0.0.0.0.0')
+
+
+class TestCompositorDiskBudget(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        write_input_pyramid(f'{self._input_dir}/dim', 7)
+        self._composition_map = {(x, y, 0): f'{self._input_dir}/dim' for x in range(2) for y in range(2)}
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_level_0_evicted_first(self):
+        # every chunk of the 2048 x 2048 plate is the same constant image, so all the chunk
+        # files have the same size
+        compositor = argolid.PyramidCompositor(self._input_dir, f'{self._dir}/probe', 'plate.zarr')
+        compositor.set_composition(self._composition_map)
+        compositor.get_zarr_chunk(0, 0, 0, 0)
+        chunk_file_size = os.path.getsize(output_chunk_file(f'{self._dir}/probe', 0, 0, 0))
+
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr',
+                                               disk_budget_bytes=int(3.5 * chunk_file_size))
+        compositor.set_composition(self._composition_map)
+        # the level 1 chunk is the least recently used, but the level 0 chunks are cheaper to
+        # generate again and are evicted first
+        compositor.get_zarr_chunk(1, 0, 0, 0)
+        compositor.get_zarr_chunk(0, 0, 0, 0)
+        compositor.get_zarr_chunk(0, 0, 0, 1)
+        compositor.get_zarr_chunk(0, 0, 1, 0)
+        assert os.path.exists(output_chunk_file(self._output_dir, 1, 0, 0))
+        assert not os.path.exists(output_chunk_file(self._output_dir, 0, 0, 0))
+        assert os.path.exists(output_chunk_file(self._output_dir, 0, 0, 1))
+        assert os.path.exists(output_chunk_file(self._output_dir, 0, 1, 0))
+
+        # an evicted chunk is generated again when it is requested
+        compositor.get_zarr_chunk(0, 0, 0, 0)
+        assert (read_output_chunk(self._output_dir, 0, 0, 0) == 7).all()
+        assert not os.path.exists(output_chunk_file(self._output_dir, 0, 0, 1))
+        assert os.path.exists(output_chunk_file(self._output_dir, 1, 0, 0))
+
+
+class TestCompositorVirtualLevel(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        for name, value in [('bright', 999), ('dim', 7)]:
+            write_input_pyramid(f'{self._input_dir}/{name}', value, chunk_size=256)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_virtual_level_matches_materialized_level(self):
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition({(0, 0, 0): f'{self._input_dir}/bright',
+                                    (1, 0, 0): f'{self._input_dir}/dim',
+                                    (0, 1, 0): f'{self._input_dir}/dim',
+                                    (1, 1, 0): f'{self._input_dir}/bright'})
+        compositor.materialize()
+        for level in range(2):
+            materialized = ts.open({'driver':'zarr',
+                                    'kvstore':{'driver':'file', 'path':f'{self._output_dir}/plate.zarr/data.zarr/0/{level}'},
+                                   }).result().read().result()
+            virtual = compositor.get_virtual_level(level).read().result()
+            assert virtual.shape == materialized.shape
+            assert (virtual == materialized).all()
+
+    def test_missing_positions_read_as_fill_value(self):
+        # nothing is materialized, the view reads the inputs and the fill of the missing positions
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition({(0, 0, 0): f'{self._input_dir}/bright',
+                                    (1, 1, 0): f'{self._input_dir}/dim'})
+        for level in range(2):
+            unit_size = IMAGE_SIZE // 2**level
+            virtual = compositor.get_virtual_level(level)
+            assert virtual.shape == (1, 1, 1, 2 * unit_size, 2 * unit_size)
+            assert (virtual[0, 0, 0, :unit_size, :unit_size].read().result() == 999).all()
+            assert (virtual[0, 0, 0, :unit_size, unit_size:].read().result() == 0).all()
+            assert (virtual[0, 0, 0, unit_size:, :unit_size].read().result() == 0).all()
+            assert (virtual[0, 0, 0, unit_size:, unit_size:].read().result() == 7).all()
+
+
+class TestCompositorChunkCopy(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        write_input_pyramid(f'{self._input_dir}/aligned', 7)
+        write_input_pyramid(f'{self._input_dir}/small_chunks', 7, chunk_size=256)
+        write_input_pyramid(f'{self._input_dir}/zlib', 7, compressor={'id':'zlib', 'level':1})
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_aligned_chunk_is_copied(self):
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition({(0, 0, 0): f'{self._input_dir}/aligned',
+                                    (1, 0, 0): f'{self._input_dir}/aligned'})
+        with mock.patch.object(ts.KvStore, 'open', wraps=ts.KvStore.open) as kvstore_open, \
+             mock.patch.object(compositor, '_assemble_zarr_chunk') as assemble:
+            compositor.get_zarr_chunk(0, 0, 0, 1)
+        assemble.assert_not_called()
+        # the input chunk is read with the context of the other source reads
+        assert kvstore_open.call_args.kwargs['context'] is compositor._source_context
+        with open(output_chunk_file(self._output_dir, 0, 0, 1), 'rb') as f:
+            output_chunk = f.read()
+        with open(f'{self._input_dir}/aligned/data.zarr/0/0/0.0.0.0.0', 'rb') as f:
+            assert output_chunk == f.read()
+        assert (read_output_chunk(self._output_dir, 0, 0, 1) == 7).all()
+
+    def test_other_encoding_is_assembled(self):
+        for name in ['small_chunks', 'zlib']:
+            output_dir = f'{self._output_dir}/{name}'
+            compositor = argolid.PyramidCompositor(self._input_dir, output_dir, 'plate.zarr')
+            compositor.set_composition({(0, 0, 0): f'{self._input_dir}/{name}',
+                                        (1, 0, 0): f'{self._input_dir}/{name}'})
+            assert compositor._get_copy_source(0, 0, 0, 1) is None
+            assemble = compositor._assemble_zarr_chunk
+            with mock.patch.object(compositor, '_assemble_zarr_chunk', side_effect=assemble) as counted:
+                compositor.get_zarr_chunk(0, 0, 0, 1)
+            counted.assert_called_once_with(0, 0, 0, 1)
+            assert (read_output_chunk(output_dir, 0, 0, 1) == 7).all()
+
+
+class TestCompositorMaterialize(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        write_input_pyramid(f'{self._input_dir}/dim', 7, chunk_size=256)
+        # a 4096 x 4096 plate has 4 x 4 chunks at level 0 and 2 x 2 chunks at level 1
+        self._compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        self._compositor.set_composition({(x, y, 0): f'{self._input_dir}/dim'
+                                          for x in range(4) for y in range(4)})
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def written_chunks(self, level):
+        level_dir = f'{self._output_dir}/plate.zarr/data.zarr/0/{level}'
+        return sorted(name for name in os.listdir(level_dir) if not name.startswith('.'))
+
+    def test_region(self):
+        progress = []
+        num_chunks = self._compositor.materialize(region=(1024, 2048, 1024, 3072),
+                                                  progress=lambda *p: progress.append(p))
+        assert num_chunks == 4
+        assert self.written_chunks(0) == ['0.0.0.1.1', '0.0.0.1.2']
+        # the region is halved at level 1
+        assert self.written_chunks(1) == ['0.0.0.0.0', '0.0.0.0.1']
+        assert (read_output_chunk(self._output_dir, 0, 1, 2) == 7).all()
+        # progress is reported once per chunk
+        assert progress == [(1, 4), (2, 4), (3, 4), (4, 4)]
+
+    def test_workers(self):
+        generate = self._compositor._generate_zarr_chunk
+        lock = threading.Lock()
+        active = [0]
+        max_active = [0]
+
+        def counting_generate(*chunk):
+            with lock:
+                active[0] += 1
+                max_active[0] = max(max_active[0], active[0])
+            try:
+                threading.Event().wait(0.05)
+                generate(*chunk)
+            finally:
+                with lock:
+                    active[0] -= 1
+
+        with mock.patch.object(self._compositor, '_generate_zarr_chunk', side_effect=counting_generate):
+            self._compositor.materialize(levels=[0], region=(0, 2048, 0, 2048), workers=1)
+            assert max_active[0] == 1
+            self._compositor.materialize(levels=[0], workers=4)
+            assert 1 < max_active[0] <= 4
+        assert len(self.written_chunks(0)) == 16
+
+
+class TestCompositorOpenSources(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        self._images = [f'{self._input_dir}/image_{x}' for x in range(3)]
+        for x, image in enumerate(self._images):
+            write_input_pyramid(image, x + 1, chunk_size=256)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_least_recently_used_source_is_closed(self):
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr',
+                                               max_open_sources=2)
+        compositor.set_composition({(x, 0, 0): image for x, image in enumerate(self._images)})
+        compositor.get_zarr_chunk(0, 0, 0, 0)
+        compositor.get_zarr_chunk(0, 0, 0, 1)
+        first = compositor._open_source(self._images[0], 0)
+        # the first image is the most recently used, so the second one is closed
+        compositor.get_zarr_chunk(0, 0, 0, 2)
+        assert list(compositor._open_sources) == [(self._images[0], 0), (self._images[2], 0)]
+        assert compositor._open_source(self._images[0], 0) is first
+        assert (read_output_chunk(self._output_dir, 0, 0, 2) == 3).all()
+
+        # a closed image is opened again when it is needed
+        compositor.get_zarr_chunk(1, 0, 0, 0)
+        assert len(compositor._open_sources) == 2
+        assert (read_output_chunk(self._output_dir, 1, 0, 0)[:, 512:1024] == 2).all()
+
+    def test_invalid_bound(self):
+        with self.assertRaises(ValueError):
+            argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr', max_open_sources=0)
+
+    def test_context_on_a_single_cpu(self):
+        with mock.patch('os.cpu_count', return_value=1):
+            context_spec = get_zarr_context_spec()
+        assert context_spec['data_copy_concurrency'] == {'limit': 1}
+        assert context_spec['file_io_concurrency'] == {'limit': 1}
+        ts.Context(ts.Context.Spec(context_spec))
+
+
+class TestCompositorInMemoryChunks(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        for name, value in [('bright', 999), ('dim', 7)]:
+            write_input_pyramid(f'{self._input_dir}/{name}', value, chunk_size=256)
+        self._composition_map = {(0, 0, 0): f'{self._input_dir}/bright',
+                                 (1, 0, 0): f'{self._input_dir}/dim',
+                                 (0, 1, 0): f'{self._input_dir}/dim'}
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_chunk_matches_written_chunk(self):
+        written = argolid.PyramidCompositor(self._input_dir, f'{self._dir}/written', 'plate.zarr')
+        written.set_composition(self._composition_map)
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        compositor.set_composition(self._composition_map)
+        for level, y_index, x_index in [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0)]:
+            written.get_zarr_chunk(level, 0, y_index, x_index)
+            chunk = compositor.read_zarr_chunk(level, 0, y_index, x_index)
+            assert chunk.shape[0] == 1
+            assert (chunk[0] == read_output_chunk(f'{self._dir}/written', level, y_index, x_index)).all()
+
+            encoded = compositor.read_zarr_chunk(level, 0, y_index, x_index, encoded=True)
+            with open(output_chunk_file(f'{self._dir}/written', level, y_index, x_index), 'rb') as f:
+                assert encoded == f.read()
+        # nothing is written without write_through
+        assert not os.path.exists(f'{self._output_dir}/plate.zarr/data.zarr/0/0/0.0.0.0.0')
+
+        compositor.read_zarr_chunk(0, 0, 0, 1, write_through=True)
+        assert (read_output_chunk(self._output_dir, 0, 0, 1) == 7).all()
+
+    def test_least_recently_used_chunk_is_evicted(self):
+        chunk_bytes = 1024 * 1024 * np.dtype(np.uint16).itemsize
+        compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr',
+                                               hot_chunk_cache_bytes=int(2.5 * chunk_bytes))
+        compositor.set_composition(self._composition_map)
+        first = compositor.read_zarr_chunk(0, 0, 0, 0)
+        compositor.read_zarr_chunk(0, 0, 0, 1)
+        # the first chunk is the most recently used, so the second one is evicted
+        assert compositor.read_zarr_chunk(0, 0, 0, 0) is first
+        compositor.read_zarr_chunk(0, 0, 1, 0)
+        assert list(compositor._hot_chunks) == [(0, 0, 0, 0, False), (0, 0, 1, 0, False)]
+        assert compositor._hot_chunks_size == 2 * chunk_bytes
+        assert compositor.read_zarr_chunk(0, 0, 0, 0) is first
+
+
+class TestCompositorAsync(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        for name, value in [('bright', 999), ('dim', 7)]:
+            for chunk_size in [1024, 256]:
+                write_input_pyramid(f'{self._input_dir}/{name}_{chunk_size}', value, chunk_size=chunk_size)
+        # the aligned inputs are copied, the others are assembled
+        self._composition_map = {(0, 0, 0): f'{self._input_dir}/bright_1024',
+                                 (1, 0, 0): f'{self._input_dir}/dim_256',
+                                 (0, 1, 0): f'{self._input_dir}/dim_1024'}
+        self._chunks = [(level, 0, y_index, x_index) for level in range(2)
+                        for y_index in range(2 // 2**level) for x_index in range(2 // 2**level)]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_async_matches_sync(self):
+        sync_compositor = argolid.PyramidCompositor(self._input_dir, f'{self._dir}/sync', 'plate.zarr')
+        sync_compositor.set_composition(self._composition_map)
+        for chunk in self._chunks:
+            sync_compositor.get_zarr_chunk(*chunk)
+
+        async_compositor = argolid.PyramidCompositor(self._input_dir, f'{self._dir}/async', 'plate.zarr')
+        async_compositor.set_composition(self._composition_map)
+
+        async def generate():
+            await async_compositor.get_zarr_chunk_async(0, 0, 0, 0)
+            await async_compositor.get_zarr_chunks_async(self._chunks[1:])
+
+        asyncio.run(generate())
+        for level, _, y_index, x_index in self._chunks:
+            assert (read_output_chunk(f'{self._dir}/async', level, y_index, x_index)
+                    == read_output_chunk(f'{self._dir}/sync', level, y_index, x_index)).all()
+        assert not os.path.exists(output_chunk_file(f'{self._dir}/async', 0, 1, 1))
+
+    def test_error_is_raised_in_awaiting_task(self):
+        compositor = argolid.PyramidCompositor(self._input_dir, f'{self._dir}/async', 'plate.zarr')
+        compositor.set_composition(self._composition_map)
+
+        async def generate(chunks):
+            tasks = [asyncio.create_task(compositor.get_zarr_chunk_async(*chunk)) for chunk in chunks]
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = asyncio.run(generate([(0, 0, 0, 0), (0, 0, 0, 2), (2, 0, 0, 0)]))
+        assert results[0] is None
+        assert isinstance(results[1], ValueError)
+        assert isinstance(results[2], ValueError)
+        assert (read_output_chunk(f'{self._dir}/async', 0, 0, 0) == 999).all()
+
+        with self.assertRaises(ValueError):
+            asyncio.run(compositor.get_zarr_chunks_async([(0, 0, 0, 1), (0, 0, 2, 0)]))
+
+
+class TestCompositorConcurrentRequests(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        write_input_pyramid(f'{self._input_dir}/dim', 7, chunk_size=256)
+        self._compositor = argolid.PyramidCompositor(self._input_dir, self._output_dir, 'plate.zarr')
+        self._compositor.set_composition({(0, 0, 0): f'{self._input_dir}/dim',
+                                          (1, 0, 0): f'{self._input_dir}/dim'})
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def request_from_threads(self, num_threads):
+        barrier = threading.Barrier(num_threads)
+        errors = []
+
+        def request():
+            barrier.wait()
+            try:
+                self._compositor.get_zarr_chunk(0, 0, 0, 0)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=request) for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_chunk_is_assembled_once(self):
+        assemble = self._compositor._assemble_zarr_chunk
+        calls = []
+
+        def counting_assemble(*args):
+            calls.append(args)
+            # keep the chunk in flight while the other requests arrive
+            threading.Event().wait(0.2)
+            return assemble(*args)
+
+        with mock.patch.object(self._compositor, '_assemble_zarr_chunk', side_effect=counting_assemble):
+            errors = self.request_from_threads(8)
+        assert errors == []
+        assert calls == [(0, 0, 0, 0)]
+        assert self._compositor._in_flight == {}
+        assert (read_output_chunk(self._output_dir, 0, 0, 0) == 7).all()
+
+    def test_failed_assembly_releases_the_claim(self):
+        def failing_assemble(*args):
+            threading.Event().wait(0.2)
+            raise RuntimeError("unreadable input")
+
+        with mock.patch.object(self._compositor, '_assemble_zarr_chunk', side_effect=failing_assemble):
+            errors = self.request_from_threads(4)
+        # the requests waiting for the chunk get the error of the request that assembled it
+        assert len(errors) == 4
+        assert all('unreadable input' in str(e) for e in errors)
+        assert self._compositor._in_flight == {}
+        assert not os.path.exists(output_chunk_file(self._output_dir, 0, 0, 0))
+
+        # the chunk is assembled again by the next request
+        self._compositor.get_zarr_chunk(0, 0, 0, 0)
+        assert (read_output_chunk(self._output_dir, 0, 0, 0) == 7).all()
+
+
+if __name__ == "__main__":
+    unittest.main()
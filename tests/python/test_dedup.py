@@ -0,0 +1,85 @@
+import unittest
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import tensorstore as ts
+
+import argolid
+from argolid.dedup import main
+
+
+def write_tiled_image(image_path):
+    """Writes a 4x4 chunk image whose top half is blank and whose bottom half repeats one tile."""
+    zarr_array = ts.open({  'driver':'zarr',
+                            'kvstore':{'driver':'file', 'path':image_path},
+                            'create':True,
+                            'metadata':{
+                                'shape':[256, 256],
+                                'chunks':[64, 64],
+                                'dtype':'<u2',
+                                'compressor':{'id':'blosc', 'cname':'zstd', 'clevel':1, 'shuffle':1, 'blocksize':0},
+                                'fill_value':7,
+                            },
+                        }).result()
+    image = np.zeros((256, 256), dtype=np.uint16)
+    tile = np.arange(64 * 64, dtype=np.uint16).reshape(64, 64)
+    image[128:, :] = np.tile(tile, (2, 4))
+    zarr_array.write(image).result()
+    return image
+
+
+def read_image(image_path):
+    zarr_array = ts.open({'driver':'zarr', 'kvstore':{'driver':'file', 'path':image_path}}).result()
+    return zarr_array.read().result()
+
+
+class TestDeduplicateChunks(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._pyramid_dir = f'{self._dir}/image.zarr'
+        self._image_path = f'{self._pyramid_dir}/data.zarr/0/0'
+        self._image = write_tiled_image(self._image_path)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def chunk_files(self):
+        return sorted(p for p in Path(self._image_path).iterdir() if p.name != '.zarray')
+
+    def test_hardlinks(self):
+        stats = argolid.deduplicate_chunks(self._pyramid_dir)
+        assert stats['chunks'] == 16
+        assert stats['unique_chunks'] == 2
+        assert stats['bytes_saved'] > 0
+        for chunk_file in self.chunk_files():
+            assert not chunk_file.is_symlink()
+            assert chunk_file.stat().st_nlink == 9
+        assert (read_image(self._image_path) == self._image).all()
+
+        # a second pass finds every chunk already linked
+        stats = argolid.deduplicate_chunks(self._pyramid_dir)
+        assert stats['unique_chunks'] == 2
+        assert stats['bytes_saved'] == 0
+
+    def test_symlinks(self):
+        blob_dir = f'{self._dir}/blobs'
+        stats = argolid.deduplicate_chunks(self._pyramid_dir, blob_dir=blob_dir, use_symlinks=True)
+        assert stats['chunks'] == 16
+        assert stats['unique_chunks'] == 2
+        for chunk_file in self.chunk_files():
+            assert chunk_file.is_symlink()
+            assert Path(os.path.realpath(chunk_file)).parent.parent == Path(blob_dir)
+        assert len(list(Path(blob_dir).glob('*/*'))) == 2
+        assert (read_image(self._image_path) == self._image).all()
+
+    def test_entry_point(self):
+        main([self._pyramid_dir, '--symlinks'])
+        assert all(chunk_file.is_symlink() for chunk_file in self.chunk_files())
+        assert (read_image(self._image_path) == self._image).all()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import tensorstore as ts
+
+import argolid
+
+
+class TestCommitKvstore(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._staging_dir = f'{self._dir}/staging'
+        os.makedirs(f'{self._staging_dir}/data.zarr/0/0')
+        self._files = {'data.zarr/0/.zattrs': b'{}', 'data.zarr/0/0/.zarray': b'{"zarr_format": 2}',
+                       'data.zarr/0/0/0.0.0.0.0': bytes(range(256))}
+        for key, data in self._files.items():
+            with open(f'{self._staging_dir}/{key}', 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_commit_to_memory(self):
+        context = ts.Context()
+        num_keys = argolid.commit_kvstore(self._staging_dir, 'memory://plate.zarr', destination_context=context,
+                                          max_in_flight=2)
+        assert num_keys == 3
+        destination = ts.KvStore.open('memory://plate.zarr/', context=context).result()
+        assert sorted(destination.list().result()) == sorted(key.encode() for key in self._files)
+        for key, data in self._files.items():
+            assert destination.read(key).result().value == data
+
+    def test_commit_to_local_path(self):
+        argolid.commit_kvstore(self._staging_dir, f'{self._dir}/out')
+        for key, data in self._files.items():
+            with open(f'{self._dir}/out/{key}', 'rb') as f:
+                assert f.read() == data
+
+
+if __name__ == "__main__":
+    unittest.main()
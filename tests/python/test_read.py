@@ -118,6 +118,205 @@ class TestMultipleChannelVivPyramidFromImageCollection(unittest.TestCase):
                                 })
         dataset = dataset_future.result()
         assert dataset.shape == (1, 4, 1, 2048, 3072)
+class TestChannelChunkedVivPyramidFromImageCollection(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        input_dir = f"{TEST_DIR}"
+        file_pattern = "test_image_r{x:d+}_c{y:d+}_ch{c:d}.ome.tiff"
+        output_dir = f"{TEST_DIR}"
+        image_name = "channel_chunked_image_viv"
+        self._image_name = image_name + ".zarr"
+        pyr_gen = argolid.PyramidGenerartor()
+        pyr_gen.set_log_level(4)
+        pyr_gen.generate_from_image_collection(input_dir, file_pattern, image_name, output_dir, 1024, "Viv", channel_chunk_size=4)
+
+    def test_channel_chunk_shape(self):
+        for i in range(2):
+            dataset = ts.open({  'driver':'zarr', 
+                                 'kvstore':
+                                    {'driver':'file', 
+                                     'path':f'{TEST_DIR}/{self._image_name}/data.zarr/0/{i}'
+                                    }
+                            }).result()
+            assert dataset.chunk_layout.read_chunk.shape[1] == 4
+
+    def test_base_layer_data(self):
+        dataset = ts.open({  'driver':'zarr', 
+                             'kvstore':
+                                {'driver':'file', 
+                                 'path':f'{TEST_DIR}/{self._image_name}/data.zarr/0/0'
+                                }
+                        }).result()
+        assert dataset.shape == (1, 4, 1, 2048, 3072)
+        assert (dataset[0, :, 0, 1034:1036, 10:12].read().result() == 1).all()
+
+
+class TestStagedVivPyramidFromImageCollection(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        input_dir = f"{TEST_DIR}"
+        file_pattern = "test_image_r{x:d+}_c{y:d+}_ch0.ome.tiff"
+        self._output_dir = TEST_DIR.joinpath("staged_output")
+        self._staging_dir = TEST_DIR.joinpath("staging")
+        # an unrelated file in the shared staging directory, which must survive the commit
+        self._staging_dir.mkdir(exist_ok=True)
+        self._staging_dir.joinpath("other_job.txt").write_text("in progress")
+        image_name = "staged_image_viv"
+        self._image_name = image_name + ".zarr"
+        pyr_gen = argolid.PyramidGenerartor()
+        pyr_gen.set_log_level(4)
+        pyr_gen.generate_from_image_collection(input_dir, file_pattern, image_name, f"{self._output_dir}", 512, "Viv",
+                                               staging_dir=f"{self._staging_dir}")
+
+    def test_committed_pyramid(self):
+        dataset = ts.open({  'driver':'zarr', 
+                             'kvstore':
+                                {'driver':'file', 
+                                 'path':f'{self._output_dir}/{self._image_name}/data.zarr/0/0'
+                                }
+                        }).result()
+        assert dataset.shape == (1, 1, 1, 2048, 3072)
+        assert (dataset[0, 0, 0, 1024:1026, 1024:1026].read().result() == 1).all()
+
+    def test_staging_dir_left_intact(self):
+        assert sorted(p.name for p in self._staging_dir.iterdir()) == ["other_job.txt"]
+
+
+class TestMemoryStagedVivPyramidFromImageCollection(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        input_dir = f"{TEST_DIR}"
+        file_pattern = "test_image_r{x:d+}_c{y:d+}_ch0.ome.tiff"
+        # the output is not on the local filesystem, so it is only written by the commit
+        self._staging_dir = TEST_DIR.joinpath("memory_staging")
+        pyr_gen = argolid.PyramidGenerartor()
+        pyr_gen.set_log_level(4)
+        pyr_gen.generate_from_image_collection(input_dir, file_pattern, "memory_staged_image_viv", "memory://staged",
+                                               512, "Viv", staging_dir=f"{self._staging_dir}")
+
+    def test_staging_dir_removed(self):
+        assert list(self._staging_dir.iterdir()) == []
+
+
+class TestMixedSizeVivPyramidFromImageCollection(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        # the chunks are the size of the first image, the other images are smaller or larger
+        input_dir = TEST_DIR.joinpath("mixed_size")
+        input_dir.mkdir(exist_ok=True)
+        for x, y, width, height, value in [(0, 0, 1024, 1024, 1), (1, 0, 512, 512, 2), (0, 1, 1536, 1024, 3)]:
+            with bfio.BioWriter(f"{input_dir}/mixed_x{x}_y{y}.ome.tiff", backend="python", X=width, Y=height, C=1, Z=1, T=1) as bw:
+                bw[0:height, 0:width, 0, 0, 0] = np.full((height, width), value, dtype=np.uint16)
+        file_pattern = "mixed_x{x:d}_y{y:d}.ome.tiff"
+        image_name = "mixed_size_image_viv"
+        self._image_name = image_name + ".zarr"
+        pyr_gen = argolid.PyramidGenerartor()
+        pyr_gen.set_log_level(4)
+        pyr_gen.generate_from_image_collection(f"{input_dir}", file_pattern, image_name, f"{TEST_DIR}", 1024, "Viv")
+
+    def test_base_layer_data(self):
+        dataset = ts.open({  'driver':'zarr', 
+                             'kvstore':
+                                {'driver':'file', 
+                                 'path':f'{TEST_DIR}/{self._image_name}/data.zarr/0/0'
+                                }
+                        }).result()
+        assert dataset.shape == (1, 1, 1, 2048, 2048)
+        base = dataset[0, 0, 0].read().result()
+        assert (base[0:1024, 0:1024] == 1).all()
+        assert (base[0:512, 1024:1536] == 2).all()
+        assert (base[512:1024, 1024:2048] == 0).all()
+        assert (base[0:512, 1536:2048] == 0).all()
+        # the image that is larger than a chunk is written in both of the chunks it covers
+        assert (base[1024:2048, 0:1536] == 3).all()
+        assert (base[1024:2048, 1536:2048] == 0).all()
+
+
+class TestUniformChunkVivPyramidFromImageCollection(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        # uniform quadrants, so that the lower levels are generated from the uniform chunks of
+        # the level above, and all zero images, which are not written
+        input_dir = TEST_DIR.joinpath("uniform")
+        input_dir.mkdir(exist_ok=True)
+        for x in range(8):
+            for y in range(8):
+                value = 3 if y >= 4 else (5 if x < 4 else 0)
+                image = np.full((256, 256), value, dtype=np.uint16)
+                if x == 6 and y == 6:
+                    image[0, 0] = 200
+                with bfio.BioWriter(f"{input_dir}/uniform_x{x}_y{y}.ome.tiff", backend="python", X=256, Y=256, C=1, Z=1, T=1) as bw:
+                    bw[0:256, 0:256, 0, 0, 0] = image
+        file_pattern = "uniform_x{x:d}_y{y:d}.ome.tiff"
+        image_name = "uniform_image_viv"
+        self._image_name = image_name + ".zarr"
+        pyr_gen = argolid.PyramidGenerartor()
+        pyr_gen.set_log_level(4)
+        pyr_gen.generate_from_image_collection(f"{input_dir}", file_pattern, image_name, f"{TEST_DIR}", 256, "Viv")
+
+    def test_downsampled_uniform_chunks(self):
+        for level in range(1, 5):
+            dataset = ts.open({  'driver':'zarr', 
+                                 'kvstore':
+                                    {'driver':'file', 
+                                     'path':f'{TEST_DIR}/{self._image_name}/data.zarr/0/{level}'
+                                    }
+                            }).result()
+            size = 2048 // 2**level
+            assert dataset.shape == (1, 1, 1, size, size)
+            image = dataset[0, 0, 0].read().result()
+            assert (image[:size//2, :size//2] == 5).all()
+            assert (image[:size//2, size//2:] == 0).all()
+            assert (image[size//2:, :size//2] == 3).all()
+            assert image[size*3//4, size*3//4] > 3
+
+
+class TestOmeTiffPyramidFromImageCollection(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        input_dir = f"{TEST_DIR}"
+        file_pattern = "test_image_r{x:d+}_c{y:d+}_ch{c:d}.ome.tiff"
+        output_dir = f"{TEST_DIR}"
+        image_name = "multiple_channel_image"
+        self._image_name = image_name + ".ome.tiff"
+        pyr_gen = argolid.PyramidGenerartor()
+        pyr_gen.set_log_level(4)
+        pyr_gen.generate_from_image_collection(input_dir, file_pattern, image_name, output_dir, 1024, "OmeTiff")
+
+    def test_single_output_file(self):
+        assert pathlib.Path(f"{TEST_DIR}/{self._image_name}").is_file() == True
+        assert pathlib.Path(f"{TEST_DIR}/multiple_channel_image_staging.zarr").exists() == False
+
+    def test_base_layer_data(self):
+        with bfio.BioReader(f"{TEST_DIR}/{self._image_name}", backend="python") as br:
+            assert br.X == 3072
+            assert br.Y == 2048
+            assert br.C == 4
+            assert (br[10:12, 10:12, 0, 3, 0] == 1).all()
+
+
+class TestOmeTiffPyramidFromMultiChannelImage(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self._output_dir = TEST_DIR.joinpath("single_ome_tiff")
+        self._output_dir.mkdir(exist_ok=True)
+        input_file = f"{TEST_DIR}/multi_channel_single.ome.tiff"
+        with bfio.BioWriter(input_file, backend="python", X=1024, Y=1024, C=2, Z=1, T=1) as bw:
+            for c in range(2):
+                bw[0:1024, 0:1024, 0, c, 0] = np.full((1024, 1024), c + 1, dtype=np.uint16)
+        pyr_gen = argolid.PyramidGenerartor()
+        pyr_gen.set_log_level(4)
+        pyr_gen.generate_from_single_image(input_file, f"{self._output_dir}", 512, "OmeTiff")
+
+    def test_all_channels_written(self):
+        output_files = list(self._output_dir.glob("*.ome.tiff"))
+        assert len(output_files) == 1
+        with bfio.BioReader(output_files[0], backend="python") as br:
+            assert br.C == 2
+            for c in range(2):
+                assert (br[10:12, 10:12, 0, c, 0] == c + 1).all()
+
+
 # test Viv compatible Zarr is produced
 # test OmeXml metadata
     # num channels
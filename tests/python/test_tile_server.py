@@ -0,0 +1,63 @@
+import unittest
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+
+import numpy as np
+import tensorstore as ts
+
+import argolid
+
+from .test_compositor import write_input_pyramid
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, b""
+
+
+class TestTileServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self._dir = tempfile.mkdtemp()
+        self._input_dir = f'{self._dir}/inputs'
+        self._output_dir = f'{self._dir}/out'
+        write_input_pyramid(f'{self._input_dir}/dim', 7)
+        self._server = argolid.TileServer(self._input_dir, self._output_dir, 'plate.zarr',
+                                          {(0, 0, 0): f'{self._input_dir}/dim',
+                                           (1, 0, 0): f'{self._input_dir}/dim'},
+                                          num_workers=1)
+        self._server.__enter__()
+
+    @classmethod
+    def tearDownClass(self):
+        self._server.__exit__(None, None, None)
+        shutil.rmtree(self._dir)
+
+    def test_served_tile(self):
+        status, body = get(f'{self._server.url}/data.zarr/0/0/0.0.0.0.1')
+        assert status == 200
+        with open(f'{self._output_dir}/plate.zarr/data.zarr/0/0/0.0.0.0.1', 'rb') as f:
+            assert body == f.read()
+
+        # the served pyramid reads as the composed image
+        zarr_array = ts.open({'driver':'zarr',
+                              'kvstore':{'driver':'http', 'base_url':f'{self._server.url}/data.zarr/0/0'},
+                             }).result()
+        assert zarr_array.shape == (1, 1, 1, 1024, 2048)
+        assert (zarr_array[0, 0, 0, :, 1024:].read().result() == np.uint16(7)).all()
+
+    def test_out_of_bounds_key(self):
+        for key in ['0/0.0.0.0.2', '0/0.0.0.1.0', '5/0.0.0.0.0', '0/0.1.0.0.0']:
+            status, _ = get(f'{self._server.url}/data.zarr/0/{key}')
+            assert status == 404, key
+        status, _ = get(f'{self._server.url}/../inputs/dim/data.zarr/0/.zattrs')
+        assert status == 404
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,343 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import bfio
+import numpy as np
+import tensorstore as ts
+
+import argolid
+
+
+def write_base_volume(zarr_loc_dir, volume, chunks):
+    """Writes a (c, z, y, x) volume as the base level of a 3D pyramid."""
+    zarr_array = ts.open({  'driver':'zarr',
+                            'kvstore':{'driver':'file', 'path':f'{zarr_loc_dir}/0'},
+                            'create':True,
+                            'metadata':{
+                                'shape':list(volume.shape),
+                                'chunks':list(chunks),
+                                'dtype':volume.dtype.str,
+                                'dimension_separator':'/',
+                            },
+                        }).result()
+    zarr_array.write(volume).result()
+
+
+def open_level(zarr_loc_dir, level):
+    return ts.open({'driver':'zarr', 'kvstore':{'driver':'file', 'path':f'{zarr_loc_dir}/{level}'}}).result()
+
+
+def read_level(zarr_loc_dir, level):
+    return open_level(zarr_loc_dir, level).read().result()
+
+
+def write_slices(source_dir, volume, physical_sizes=None):
+    """Writes every z-slice of a (z, y, x) volume to its own OME-TIFF file."""
+    Z, Y, X = volume.shape
+    for z in range(Z):
+        with bfio.BioWriter(f'{source_dir}/slice_z{z}.ome.tiff', backend="python", X=X, Y=Y, C=1, Z=1, T=1) as bw:
+            for axis, physical_size in (physical_sizes or {}).items():
+                setattr(bw, f'physical_size_{axis}', physical_size)
+            bw[0:Y, 0:X, 0, 0, 0] = volume[z]
+
+
+def read_zattrs(zarr_loc_dir):
+    with open(f'{zarr_loc_dir}/.zattrs') as f:
+        return json.load(f)['multiscales'][0]
+
+
+class TestPyramidGenerator3D(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._zarr_loc_dir = f'{self._dir}/volume.zarr'
+        # odd sizes, so that the last chunks and the last downsampled voxels are partial
+        rng = np.random.default_rng(0)
+        self._volume = rng.integers(0, 4096, size=(2, 9, 70, 45), dtype=np.uint16)
+        write_base_volume(self._zarr_loc_dir, self._volume, (1, 2, 32, 32))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_levels_match_downsample(self):
+        num_levels = 3
+        pyr_gen = argolid.PyramidGenerator3D(self._zarr_loc_dir, 0, chunk_shape=(2, 16, 16))
+        pyr_gen.generate_pyramid(num_levels, num_workers=3, max_in_flight_writes=2)
+
+        # every level is the mean downsampling of the previous one
+        expected = self._volume
+        for level in range(1, num_levels + 1):
+            expected = ts.downsample(ts.array(expected), [1, 2, 2, 2], method='mean').read().result()
+            level_image = read_level(self._zarr_loc_dir, level)
+            assert level_image.shape == expected.shape
+            assert (level_image == expected).all()
+
+    def test_downsample_pyramid_matches_downsample(self):
+        pyr_gen = argolid.PyramidGenerator3D(self._zarr_loc_dir, 0, chunk_shape=(2, 16, 16))
+        pyr_gen.downsample_pyramid(2, num_workers=2)
+        expected = ts.downsample(ts.array(self._volume), [1, 4, 4, 4], method='mean').read().result()
+        level_image = read_level(self._zarr_loc_dir, 2)
+        assert level_image.shape == expected.shape
+        assert (level_image == expected).all()
+
+    def test_default_chunk_shape_follows_base(self):
+        pyr_gen = argolid.PyramidGenerator3D(self._zarr_loc_dir, 0)
+        pyr_gen.generate_pyramid(2)
+        assert open_level(self._zarr_loc_dir, 1).chunk_layout.read_chunk.shape == (1, 2, 32, 23)
+        assert open_level(self._zarr_loc_dir, 2).chunk_layout.read_chunk.shape == (1, 2, 18, 12)
+
+
+class TestVolumeGeneratorZSlab(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._source_dir = f'{self._dir}/slices'
+        os.mkdir(self._source_dir)
+        # 10 slices do not fill the last slab of 4
+        rng = np.random.default_rng(1)
+        self._volume = rng.integers(0, 4096, size=(10, 48, 40), dtype=np.uint16)
+        write_slices(self._source_dir, self._volume)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_z_slab_ingest(self):
+        for ingest in ['process', 'thread']:
+            volume_gen = argolid.VolumeGenerator(self._source_dir, 'z', 'slice_z{z:d}.ome.tiff',
+                                                 self._dir, f'{ingest}.zarr', chunk_shape=(4, 32, 32))
+            volume_gen.generate_volume(ingest=ingest, num_workers=2)
+            zarr_loc_dir = f'{self._dir}/{ingest}.zarr'
+            base = open_level(zarr_loc_dir, 0)
+            assert base.chunk_layout.read_chunk.shape == (1, 4, 32, 32)
+            assert (base.read().result()[0] == self._volume).all()
+
+            # the levels keep the z-slabs of the base
+            pyr_gen = argolid.PyramidGenerator3D(zarr_loc_dir, 0)
+            pyr_gen.generate_pyramid(1)
+            assert open_level(zarr_loc_dir, 1).chunk_layout.read_chunk.shape == (1, 4, 24, 20)
+
+
+class TestVolumeGeneratorIngest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._source_dir = f'{self._dir}/slices'
+        os.mkdir(self._source_dir)
+        self._volume = np.arange(4 * 48 * 40, dtype=np.uint16).reshape(4, 48, 40)
+        write_slices(self._source_dir, self._volume)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_thread_ingest_report(self):
+        volume_gen = argolid.VolumeGenerator(self._source_dir, 'z', 'slice_z{z:d}.ome.tiff',
+                                             self._dir, 'volume.zarr', chunk_shape=(1, 32, 32))
+        volume_gen.init_base_zarr_file()
+        report = volume_gen.ingest_image_stack(num_workers=2)
+        assert report['errors'] == {}
+        assert len(report['files']) == 4
+        assert all(stats['bytes'] == 48 * 40 * 2 for stats in report['files'].values())
+        assert report['bytes'] == 4 * 48 * 40 * 2
+        assert (read_level(f'{self._dir}/volume.zarr', 0)[0] == self._volume).all()
+
+    def test_unreadable_file_is_reported(self):
+        with open(f'{self._source_dir}/slice_z2.ome.tiff', 'wb') as f:
+            f.write(b'not a tiff file')
+        volume_gen = argolid.VolumeGenerator(self._source_dir, 'z', 'slice_z{z:d}.ome.tiff',
+                                             self._dir, 'volume.zarr', chunk_shape=(1, 32, 32))
+        volume_gen.init_base_zarr_file()
+        report = volume_gen.ingest_image_stack(num_workers=2)
+        # the other files are still written
+        [bad_file] = report['errors']
+        assert bad_file.endswith('slice_z2.ome.tiff')
+        assert len(report['files']) == 3
+        volume = read_level(f'{self._dir}/volume.zarr', 0)[0]
+        assert (volume[[0, 1, 3]] == self._volume[[0, 1, 3]]).all()
+
+    def test_failed_files_are_raised(self):
+        # a slice wider than the first one does not fit in the volume
+        with bfio.BioWriter(f'{self._source_dir}/slice_z2.ome.tiff', backend="python", X=60, Y=48, C=1, Z=1, T=1) as bw:
+            bw[0:48, 0:60, 0, 0, 0] = np.ones((48, 60), dtype=np.uint16)
+        for ingest in ['process', 'thread']:
+            volume_gen = argolid.VolumeGenerator(self._source_dir, 'z', 'slice_z{z:d}.ome.tiff',
+                                                 self._dir, f'{ingest}.zarr', chunk_shape=(1, 32, 32))
+            with self.assertRaisesRegex(RuntimeError, 'Failed to write 1 files: .*slice_z2'):
+                volume_gen.generate_volume(ingest=ingest, num_workers=2)
+
+
+class TestAnisotropicDownsampling(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._source_dir = f'{self._dir}/slices'
+        os.mkdir(self._source_dir)
+        self._volume = np.ones((8, 32, 32), dtype=np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def generate(self, physical_sizes, num_levels=2):
+        write_slices(self._source_dir, self._volume, physical_sizes)
+        volume_gen = argolid.VolumeGenerator(self._source_dir, 'z', 'slice_z{z:d}.ome.tiff',
+                                             self._dir, 'volume.zarr', chunk_shape=(1, 32, 32))
+        volume_gen.generate_volume(ingest='thread')
+        zarr_loc_dir = f'{self._dir}/volume.zarr'
+        argolid.PyramidGenerator3D(zarr_loc_dir, 0).generate_pyramid(num_levels)
+        return zarr_loc_dir
+
+    def test_factors_follow_voxel_size(self):
+        pyr_gen = argolid.PyramidGenerator3D(f'{self._dir}/missing.zarr', 0, voxel_size=(2.0, 0.5, 0.5))
+        factors = pyr_gen._get_downsample_factors([1, 64, 64, 64], 3)
+        assert factors == [[1, 1, 2, 2], [1, 1, 2, 2], [1, 2, 2, 2]]
+        # axes of size 1 are never downsampled
+        factors = pyr_gen._get_downsample_factors([1, 1, 64, 64], 1)
+        assert factors == [[1, 1, 2, 2]]
+
+    def test_scale_follows_physical_sizes(self):
+        # a 2 micrometer z step is 4 times the xy size, so z is kept for two levels
+        zarr_loc_dir = self.generate({'x': (0.5, 'µm'), 'y': (0.5, 'µm'), 'z': (2.0, 'µm')}, num_levels=3)
+        multiscales = read_zattrs(zarr_loc_dir)
+        scales = [dataset['coordinateTransformations'][0]['scale'] for dataset in multiscales['datasets']]
+        assert scales == [[1, 2.0, 0.5, 0.5], [1, 2.0, 1.0, 1.0], [1, 2.0, 2.0, 2.0], [1, 4.0, 4.0, 4.0]]
+        assert open_level(zarr_loc_dir, 1).shape == (1, 8, 16, 16)
+        assert open_level(zarr_loc_dir, 2).shape == (1, 8, 8, 8)
+        assert open_level(zarr_loc_dir, 3).shape == (1, 4, 4, 4)
+
+    def test_missing_z_size_is_isotropic(self):
+        zarr_loc_dir = self.generate({'x': (0.5, 'µm'), 'y': (0.5, 'µm')})
+        multiscales = read_zattrs(zarr_loc_dir)
+        assert multiscales['datasets'][0]['coordinateTransformations'][0]['scale'] == [1, 0.5, 0.5, 0.5]
+        assert [axis.get('unit') for axis in multiscales['axes']] == [None, 'micrometer', 'micrometer', 'micrometer']
+        assert open_level(zarr_loc_dir, 1).shape == (1, 4, 16, 16)
+        assert open_level(zarr_loc_dir, 2).shape == (1, 2, 8, 8)
+
+    def test_units_of_the_reader(self):
+        # the z step is given in nanometers
+        zarr_loc_dir = self.generate({'x': (0.5, 'µm'), 'y': (0.5, 'µm'), 'z': (2000.0, 'nm')}, num_levels=3)
+        multiscales = read_zattrs(zarr_loc_dir)
+        assert [axis.get('unit') for axis in multiscales['axes']] == [None, 'nanometer', 'micrometer', 'micrometer']
+        scales = [dataset['coordinateTransformations'][0]['scale'] for dataset in multiscales['datasets']]
+        assert scales == [[1, 2000.0, 0.5, 0.5], [1, 2000.0, 1.0, 1.0], [1, 2000.0, 2.0, 2.0], [1, 4000.0, 4.0, 4.0]]
+        assert open_level(zarr_loc_dir, 2).shape == (1, 8, 8, 8)
+        assert open_level(zarr_loc_dir, 3).shape == (1, 4, 4, 4)
+
+
+class CountingSlots:
+    """Wraps the write slots of a level and records the largest number of writes in flight."""
+
+    def __init__(self, write_slots):
+        self._write_slots = write_slots
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def acquire(self):
+        self._write_slots.acquire()
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._write_slots.release()
+
+
+class CountingPyramidGenerator3D(argolid.PyramidGenerator3D):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slots = {}
+
+    def _downsample_chunk(self, ds_zarr_array, ds_zarr_array_write, chunk, write_slots):
+        counting_slots = self.slots.setdefault(id(write_slots), CountingSlots(write_slots))
+        return super()._downsample_chunk(ds_zarr_array, ds_zarr_array_write, chunk, counting_slots)
+
+
+class FailingPyramidGenerator3D(CountingPyramidGenerator3D):
+    """Fails on the third chunk."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_calls = 0
+
+    def _downsample_chunk(self, ds_zarr_array, ds_zarr_array_write, chunk, write_slots):
+        self.num_calls += 1
+        if self.num_calls == 3:
+            raise RuntimeError("unreadable chunk")
+        return super()._downsample_chunk(ds_zarr_array, ds_zarr_array_write, chunk, write_slots)
+
+
+class RecordedWrite:
+    def __init__(self, writes):
+        self._writes = writes
+        self._writes.in_flight += 1
+        self._writes.max_in_flight = max(self._writes.max_in_flight, self._writes.in_flight)
+        self._done = False
+
+    def result(self):
+        if not self._done:
+            self._done = True
+            self._writes.in_flight -= 1
+
+
+class RecordingArray:
+    """Stands in for a zarr array and records the writes that have not been awaited."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.num_writes = 0
+
+    def __getitem__(self, index):
+        return self
+
+    def write(self, image):
+        self.num_writes += 1
+        return RecordedWrite(self)
+
+
+class TestInFlightWrites(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._zarr_loc_dir = f'{self._dir}/volume.zarr'
+        volume = np.arange(2 * 8 * 64 * 64, dtype=np.uint16).reshape(2, 8, 64, 64)
+        write_base_volume(self._zarr_loc_dir, volume, (1, 1, 64, 64))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_pyramid_writes_are_bounded(self):
+        pyr_gen = CountingPyramidGenerator3D(self._zarr_loc_dir, 0, chunk_shape=(1, 8, 8),
+                                             max_in_flight_writes=2)
+        pyr_gen.generate_pyramid(2, num_workers=8)
+        [slots] = pyr_gen.slots.values()
+        assert 1 <= slots.max_in_flight <= 2
+        assert slots.in_flight == 0
+
+    def test_volume_writes_are_bounded(self):
+        volume_gen = argolid.VolumeGenerator(self._dir, 'z', 'image_z{z:d}.ome.tiff', self._dir,
+                                             'volume', chunk_shape=(1, 16, 16), max_in_flight_writes=3)
+        zarr_array = RecordingArray()
+        tile_readers = [lambda y, y_max, x, x_max: np.zeros((y_max - y, x_max - x), dtype=np.uint16)]
+        volume_gen._write_layers(zarr_array, tile_readers, 64, 64, 0, 0)
+        assert zarr_array.num_writes == 16
+        assert zarr_array.max_in_flight == 3
+        assert zarr_array.in_flight == 0
+
+    def test_failed_chunk_cancels_queued_chunks(self):
+        pyr_gen = FailingPyramidGenerator3D(self._zarr_loc_dir, 0, chunk_shape=(1, 8, 8),
+                                            max_in_flight_writes=2)
+        with self.assertRaisesRegex(RuntimeError, 'unreadable chunk'):
+            pyr_gen.generate_pyramid(2, num_workers=1)
+        # no chunk is started after the failure, and the started writes are done
+        assert pyr_gen.num_calls == 3
+        [slots] = pyr_gen.slots.values()
+        assert slots.in_flight == 0
+
+    def test_invalid_bound(self):
+        with self.assertRaises(ValueError):
+            argolid.PyramidGenerator3D(self._zarr_loc_dir, 0, max_in_flight_writes=0)
+
+
+if __name__ == "__main__":
+    unittest.main()